@@ -1,5 +1,115 @@
 #!/usr/bin/env python3
-import abc, datetime
+import abc, atexit, datetime, multiprocessing.pool, threading, time
+import metrics
+# This is the number of agencies that may prepare for an origin and a
+# destination in the background at the same time.
+MAX_CONCURRENT_PREPARATIONS = 4
+_pool = None
+
+def get_pool():
+    '''
+    Returns the thread pool on which agencies prepare for origins and
+    destinations in the background. It is created on first use.
+    '''
+    global _pool
+    if _pool is None:
+        _pool = multiprocessing.pool.ThreadPool(MAX_CONCURRENT_PREPARATIONS)
+        atexit.register(_pool.terminate)
+    return _pool
+
+class QueryContext:
+    '''
+    The state of one query. It is passed to the methods of the agencies so
+    that queries that run at the same time, e.g. on different threads, do not
+    interfere with each other. Agencies keep everything that depends on the
+    query, e.g. their preparations for the origin and destination, in the
+    context instead of in class members.
+    '''
+    def __init__(
+        self,
+        origin=None,
+        destination=None,
+        args_parsed=None,
+        stats=None
+    ):
+        '''
+        Arguments:
+            origin, destination:
+                the origin and destination of the query
+            args_parsed:
+                the parsed command line arguments of the query, which must
+                have been passed to the handle_parsed_arguments method of
+                every agency, or None to use the defaults
+            stats:
+                a search_stats.SearchStats object that the search and the
+                agencies add their statistics to, or None to not collect
+                statistics
+        '''
+        self.origin = origin
+        self.destination = destination
+        self.args_parsed = args_parsed
+        self.stats = stats
+        self._states = {}
+        self._preparations = {}
+        self._lock = threading.Lock()
+    def arg(self, name, default=None):
+        '''
+        Returns the parsed command line argument with the given name, or
+        default if it was not parsed.
+        '''
+        return getattr(self.args_parsed, name, default)
+    def prepare(self, agency, origin, destination):
+        '''
+        Calls the use_origin_destination_async method of the agency with this
+        context and returns what it returned. Later calls with the same
+        arguments return the same thing without preparing again, so queries
+        that share a context and an origin and destination share the
+        preparation.
+        '''
+        key = (agency, origin, destination)
+        with self._lock:
+            try:
+                return self._preparations[key]
+            except KeyError:
+                pass
+        stats = self.stats
+        if stats is not None:
+            start = time.perf_counter()
+        with metrics.span(
+            "use_origin_destination",
+            agency=agency.__name__
+        ):
+            preparation = agency.use_origin_destination_async(
+                origin,
+                destination,
+                self
+            )
+        if stats is not None:
+            stats.agency(agency).prepare_seconds += \
+                time.perf_counter() - start
+        with self._lock:
+            return self._preparations.setdefault(key, preparation)
+    def state(self, agency, factory=dict):
+        '''
+        Returns the state that the agency keeps for this query. The first time,
+        it is created by calling factory with no arguments.
+        '''
+        with self._lock:
+            try:
+                return self._states[agency]
+            except KeyError:
+                state = factory()
+                self._states[agency] = state
+                return state
+# This context is used when no context is passed to an agency, as when only
+# one query runs at a time.
+default_context = QueryContext()
+
+def get_context(context):
+    '''
+    Returns context, or default_context if context is None.
+    '''
+    return default_context if context is None else context
 
 class Agency(abc.ABC):
     @classmethod
@@ -18,9 +128,10 @@ class Agency(abc.ABC):
     def handle_parsed_arguments(cls, args_parsed, arg_parser_error):
         '''
         Call this function after parsing command line arguments. This function
-        will read the parsed arguments and may make changes to class members
-        based on the parsed arguments. By default, this function does nothing;
-        subclasses may override it.
+        checks the parsed arguments and calls arg_parser_error if they are
+        invalid. Agencies read the arguments from the QueryContext of each
+        query, so this function must not change class members. By default,
+        this function does nothing; subclasses may override it.
         
         Arguments:
             args_parsed:
@@ -32,12 +143,41 @@ class Agency(abc.ABC):
                 argparse.ArgumentParser
         '''
     @classmethod
-    def use_origin_destination(cls, origin, destination):
+    def use_origin_destination(cls, origin, destination, context=None):
         '''
         This function will use the origin and destination to optimize calls to
-        get_edge. It must be called before the first call to get_edge after the
-        origin or destination changes.
+        get_edge. It must be called before the first call to get_edge with the
+        same context. Its results are kept in the context, which is a
+        QueryContext or None for default_context.
+        '''
+    @classmethod
+    def use_origin_destination_async(cls, origin, destination, context=None):
+        '''
+        This function does the same thing as use_origin_destination, but it
+        may do it in the background. If it does, it returns an object with the
+        ready() and wait() methods of multiprocessing.pool.AsyncResult, and
+        get_edge may be called before the preparation is ready as long as
+        neither from_node nor to_node is the origin or the destination. If the
+        preparation is complete when this function returns, it returns None.
+        
+        By default, this function calls use_origin_destination and returns
+        None. Agencies whose preparation is slow, e.g. because it uses the
+        network, should override it.
+        '''
+        cls.use_origin_destination(origin, destination, context)
+        return None
+    @classmethod
+    def min_seconds(cls, from_node, to_node, context=None):
+        '''
+        Returns a lower bound on the number of seconds between the departure
+        and the arrival of any edge that get_edge would yield from from_node to
+        to_node. The search uses this to put off waiting for an agency whose
+        preparation is not ready. If an edge were shorter than this, the
+        itinerary might not be optimal.
+        
+        By default, this function returns zero, which is always correct.
         '''
+        return 0.0
     @classmethod
     @abc.abstractmethod
     def get_edge(
@@ -46,7 +186,8 @@ class Agency(abc.ABC):
         to_node,
         datetime_depart=datetime.datetime.min,
         datetime_arrive=datetime.datetime.max,
-        consecutive_agency=None
+        consecutive_agency=None,
+        context=None
     ):
         '''
         Yields edges from from_node to to_node after datetime_depart and before
@@ -77,12 +218,14 @@ class Agency(abc.ABC):
             consecutive_agency (optional):
                 the agency that provided the edge leading to from_node if
                 depart is True or to_node otherwise
+            context (optional):
+                the QueryContext of the query, or None for default_context
         Yields:
             A Weight object
         '''
         raise NotImplementedError
     @classmethod
-    def get_pickup(cls, from_node, datetime_depart):
+    def get_pickup(cls, from_node, datetime_depart, context=None):
         '''
         Finds trips that depart from from_node after datetime_depart. Yields a
         WeightedEdge from from_node to the trip's final destination for each
@@ -1,14 +1,51 @@
 #!/usr/bin/env python3
-import collections, datetime, heapq, itertools, pickle
+import collections, datetime, heapq, itertools, pickle, sys
 from agency_common import Agency
 from common import NodeAndTime, Weight, WeightedEdge
-from common_nyu import NYU_PICKLE
+from common_nyu import NYU_NETWORK, NYU_PICKLE
+import data_snapshot, network_file
 JUST_BEFORE_MIDNIGHT = datetime.timedelta(microseconds=-1)
 MIDNIGHT = datetime.time()
 ONE_DAY = datetime.timedelta(days=1)
 
-with open(NYU_PICKLE, "rb") as f:
-    schedule_by_day = pickle.load(f)
+def load_schedules():
+    '''
+    Loads the schedules and returns a (network, schedule_by_day) tuple, where
+    network is a network_file.NYUNetwork, or None if the compiled network file
+    cannot be used.
+    '''
+    # Prefer the compiled network file, which loads much faster than the
+    # pickle.
+    try:
+        network = network_file.NYUNetwork(NYU_NETWORK)
+    except (OSError, network_file.NetworkFileError) as e:
+        if not isinstance(e, FileNotFoundError):
+            print("Cannot use ", NYU_NETWORK, ": ", e, sep="", file=sys.stderr)
+        with open(NYU_PICKLE, "rb") as f:
+            schedule_by_day = pickle.load(f)
+        for schedules_on_day in schedule_by_day:
+            for schedule in schedules_on_day:
+                schedule.index_header()
+        return None, schedule_by_day
+    return network, network.schedule_by_day
+# The schedules are loaded on first use so that importing this module is fast.
+# They are reloaded when the files are rebuilt.
+schedules = data_snapshot.Data(
+    "the NYU bus schedules",
+    (NYU_NETWORK, NYU_PICKLE),
+    load_schedules
+)
+
+def schedules_serving(dow, node):
+    '''
+    Returns the schedules on the given day of the week. If the compiled
+    network file is used, only the schedules that include the node are
+    returned.
+    '''
+    network, schedule_by_day = schedules.current().data
+    if network is None:
+        return schedule_by_day[dow]
+    return network.schedules_serving(dow, node)
 
 def timedelta_after_midnight(dt):
     '''
@@ -63,8 +100,10 @@ class AgencyNYU(Agency):
         to_node,
         datetime_depart=datetime.datetime.min,
         datetime_arrive=datetime.datetime.max,
-        consecutive_agency=None
+        consecutive_agency=None,
+        context=None
     ):
+        stats = None if context is None else context.stats
         backwards = \
             datetime_depart == datetime.datetime.min and \
             datetime_arrive != datetime.datetime.max
@@ -119,9 +158,11 @@ class AgencyNYU(Agency):
                     date_depart,
                     MIDNIGHT
                 )
-                for schedule in schedule_by_day[
-                    (date_arrive if backwards else date_depart).weekday()
-                ]:
+                heap_size = len(edges_heap)
+                for schedule in schedules_serving(
+                    (date_arrive if backwards else date_depart).weekday(),
+                    from_node
+                ):
                     for from_node_index, to_node_index \
                         in schedule.get_columns_indices(from_node, to_node):
                         # Filter out the rows with None for either stop and
@@ -228,6 +269,9 @@ class AgencyNYU(Agency):
                                 elif trip_d > last_departure:
                                     last_departure = trip_d
                                 days_without_edges = 0
+                if stats is not None:
+                    stats.agency(cls).trips_materialized += \
+                        len(edges_heap) - heap_size
                 if backwards:
                     # Decrement the day and continue.
                     try:
@@ -259,7 +303,8 @@ class AgencyNYU(Agency):
             else:
                 break
     @classmethod
-    def get_pickup(cls, from_node, datetime_depart):
+    def get_pickup(cls, from_node, datetime_depart, context=None):
+        stats = None if context is None else context.stats
         date_depart, timedelta_depart = timedelta_after_midnight(
             datetime_depart
         )
@@ -291,7 +336,11 @@ class AgencyNYU(Agency):
             ) and not date_overflowed:
                 days_without_edges += 1
                 day_start = datetime.datetime.combine(date_depart, MIDNIGHT)
-                for schedule in schedule_by_day[date_depart.weekday()]:
+                heap_size = len(edges_heap)
+                for schedule in schedules_serving(
+                    date_depart.weekday(),
+                    from_node
+                ):
                     for from_node_index \
                         in schedule.get_column_indices(from_node):
                         # Filter out the rows where the vehicle will not stop
@@ -364,6 +413,7 @@ class AgencyNYU(Agency):
                                                 )
                                                 if trip_w
                                             ),
+                                            agency=cls,
                                             from_node=from_node,
                                             to_node=schedule.header_row[
                                                 from_node_index + len(row) - 1
@@ -374,6 +424,9 @@ class AgencyNYU(Agency):
                                 if trip_d > last_departure:
                                     last_departure = trip_d
                                 days_without_edges = 0
+                if stats is not None:
+                    stats.agency(cls).trips_materialized += \
+                        len(edges_heap) - heap_size
                 # Increment the day and continue.
                 try:
                     date_depart += ONE_DAY
@@ -1,141 +1,429 @@
-import datetime, json, keyring, os, pickle, requests
+import collections, datetime, math, threading, time
+import agency_common
+from agency_common import get_context
 from agency_walking import AgencyWalking
 from common import Weight
-import stops
-import time
-
-try:
-    _apikey = os.environ["GMAPS_DISTANCE_MATRIX_KEY"]
-except KeyError:
-    _apikey = \
-        keyring.get_password("google_maps", "distance_matrix") or \
-        keyring.get_password("google_maps", "default")
+import gazetteer, google_maps, metrics, stops, walking_estimator
 
 ONE_MINUTE = datetime.timedelta(minutes=1)
+# This is the default number of seconds that one query may spend waiting for
+# the Distance Matrix API.
+DEFAULT_API_BUDGET_SECONDS = 5.0
+# This is the number of walking times from the API that are kept for later
+# queries at most.
+MAX_SHARED_EDGES = 100000
 
+class QueryState:
+        '''
+        The state that AgencyWalkingDynamic keeps for one query
+        '''
+        def __init__(self):
+                # The walking times from the API that this query uses. They are
+                # copied from AgencyWalkingDynamic.edges, so that they are kept
+                # until the query finishes even if other queries push them out
+                # of it.
+                self.edges = {}
+                # Walking times that were estimated because the API did not
+                # answer in time. They are kept apart from edges so that they
+                # are requested again once the API recovers.
+                self.estimated_edges = {}
+                # The locations of origins and destinations, or None where they
+                # are not known
+                self.points = {}
+class EdgeCache:
+        '''
+        A thread-safe mapping from (from_node, to_node) tuples to walking times
+        that keeps at most max_entries of them and forgets the least recently
+        used ones
+        '''
+        def __init__(self, max_entries):
+                self.max_entries = max_entries
+                self._lock = threading.Lock()
+                self._entries = collections.OrderedDict()
+        def get(self, key):
+                '''
+                Returns the walking time of the key and marks it as the most
+                recently used, or returns None if there is none.
+                '''
+                with self._lock:
+                    try:
+                        edge = self._entries[key]
+                    except KeyError:
+                        return None
+                    self._entries.move_to_end(key)
+                    return edge
+        def __setitem__(self, key, edge):
+                with self._lock:
+                    self._entries[key] = edge
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+        def items(self):
+                with self._lock:
+                    return list(self._entries.items())
 class AgencyWalkingDynamic(AgencyWalking):
-        edges = {}
-        stop_coords = list(stops.geo_str_to_name.keys())
-        stop_names = stops.names_sorted
+        # The walking times from the API. They do not depend on the query, so
+        # they are shared by all queries, which copy the ones that they use.
+        edges = EdgeCache(MAX_SHARED_EDGES)
         def display_dict(cls):
                 ##this is just a tester method to make sure the dictionary is correct
                 ##not to be used in production
                 for k,v in cls.edges.items():
                         print("Origin: {} Destination: {} Distance: {} Travel Time: {} ".format(k[0], k[1], v[0], v[1]))
+        @classmethod
+        def add_arguments(cls, arg_parser_add_argument):
+                AgencyWalking.add_arguments(arg_parser_add_argument)
+                arg_parser_add_argument(
+                    "--walking-api-timeout",
+                    type=float,
+                    default=DEFAULT_API_BUDGET_SECONDS,
+                    metavar="seconds",
+                    help=
+                        "the longest period of time to wait for walking "
+                        "directions from the origin and to the destination "
+                        "before estimating them"
+                )
+                arg_parser_add_argument(
+                    "--walking-offline",
+                    action="store_true",
+                    help=
+                        "estimate walking directions from the origin and to "
+                        "the destination instead of asking Google Maps for "
+                        "them"
+                )
+        @classmethod
+        def handle_parsed_arguments(cls, args_parsed, arg_parser_error):
+                AgencyWalking.handle_parsed_arguments(
+                    args_parsed,
+                    arg_parser_error
+                )
+                if args_parsed.walking_api_timeout < 0.0:
+                    arg_parser_error(
+                        "--walking-api-timeout must not be negative"
+                    )
+        @classmethod
+        def query_state(cls, context):
+                '''
+                Returns the QueryState of the query that the context belongs
+                to.
+                '''
+                return get_context(context).state(cls, QueryState)
         @staticmethod
-        def matrix_api_call(origins, destinations):
-                api_key = _apikey
-                # Google Distance Matrix base URL to which all other parameters are attached
-                base_url = 'https://maps.googleapis.com/maps/api/distancematrix/json?'
-                if (len(origins) >= 25 and len(destinations) >= 25) or ((len(origins) + len(destinations)) > 100):
-                    print("Too many origins/destinations")
-                    return
-                payload= {
-                                'units': 'imperial',
-                                'region': 'us', ##It's most likely that the location is in the US so we give it precedence
-                                'origins' : '|'.join(origins),
-                                'destinations' : '|'.join(destinations),
-                                'mode' : 'walking',
-                                'api_key' : api_key
-                }
-                current_delay = 0.1  # Set the initial retry delay to 100ms.
-                max_delay = 600  # Set the maximum retry delay to 10 minutes.
-                while True:
-                    try:
-                        r = requests.get(base_url, params = payload)
-                    except IOError:
-                        pass
-                    else:
-                        matrix = json.loads(r.text)
-                        if matrix['status'] == 'OK':
-                            return matrix
-                        elif matrix['status'] != 'UNKNOWN_ERROR':
-                            # Many API errors cannot be fixed by a retry, e.g. INVALID_REQUEST or
-                            # ZERO_RESULTS. There is no point retrying these requests.
-                            print(matrix['error_message']) #TODO send errors some place so we are notified
-
-                    if current_delay > max_delay:
-                        print('Too many retry attempts.')
-                    print ('Waiting' + str(current_delay) + 'seconds before retrying.')
-                    time.sleep(current_delay)
-                    current_delay *= 2  # Increase the delay each time we retry.
-
-
+        def api_budget_seconds(context):
+                '''
+                Returns the number of seconds that the query may spend waiting
+                for the Distance Matrix API.
+                '''
+                return get_context(context).arg(
+                    "walking_api_timeout",
+                    DEFAULT_API_BUDGET_SECONDS
+                )
+        @staticmethod
+        def offline(context):
+                '''
+                Returns True if walking times are always estimated for the
+                query, and the API is never used.
+                '''
+                return get_context(context).arg("walking_offline", False)
+        @classmethod
+        def estimate_edges(cls, pairs, context=None):
+                '''
+                Estimates the walking times between the given (from_node,
+                to_node) pairs from the straight-line distances between them
+                and stores them in the estimated_edges of the query. Pairs with
+                a node whose location is not known are skipped.
+                '''
+                estimated_edges = cls.query_state(context).estimated_edges
+                estimator = walking_estimator.get_estimator()
+                for from_node, to_node in pairs:
+                    from_point = walking_estimator.node_to_point(from_node)
+                    to_point = walking_estimator.node_to_point(to_node)
+                    if from_point is not None and to_point is not None:
+                        seconds = round(
+                            estimator.estimate_seconds(from_point, to_point)
+                        )
+                        estimated_edges[(from_node, to_node)] = (
+                            walking_estimator.distance_text(seconds),
+                            cls.at_least_min_seconds(
+                                from_node,
+                                to_node,
+                                seconds,
+                                context
+                            ),
+                            to_node
+                        )
+        @classmethod
+        def estimate_origin(cls, origin, origin_point, context=None):
+                '''
+                Estimates the walking times from the origin, which is at
+                origin_point, to every bus stop and stores them in the
+                estimated_edges of the query.
+                '''
+                estimated_edges = cls.query_state(context).estimated_edges
+                estimator = walking_estimator.get_estimator()
+                for stop, seconds in estimator.estimate_stops(origin_point):
+                    estimated_edges[(origin, stop)] = (
+                        walking_estimator.distance_text(seconds),
+                        cls.at_least_min_seconds(
+                            origin,
+                            stop,
+                            round(seconds),
+                            context
+                        ),
+                        stop
+                    )
+        @classmethod
+        def estimate_destination(
+            cls,
+            destination,
+            destination_point,
+            context=None
+        ):
+                '''
+                Estimates the walking times from every bus stop to the
+                destination, which is at destination_point, and stores them in
+                the estimated_edges of the query.
+                '''
+                estimated_edges = cls.query_state(context).estimated_edges
+                estimator = walking_estimator.get_estimator()
+                for stop, seconds in estimator.estimate_stops(
+                    destination_point
+                ):
+                    estimated_edges[(stop, destination)] = (
+                        walking_estimator.distance_text(seconds),
+                        cls.at_least_min_seconds(
+                            stop,
+                            destination,
+                            round(seconds),
+                            context
+                        ),
+                        destination
+                    )
+        @classmethod
+        def point(cls, node, context=None):
+                '''
+                Returns the location of the node, or None if it is not known.
+                The locations of nodes other than bus stops are remembered in
+                the points of the query.
+                '''
+                try:
+                    return stops.name_to_point[node]
+                except KeyError:
+                    pass
+                points = cls.query_state(context).points
+                try:
+                    return points[node]
+                except KeyError:
+                    point = walking_estimator.node_to_point(node)
+                    points[node] = point
+                    return point
+        @classmethod
+        def min_seconds(cls, from_node, to_node, context=None):
+                from_point = cls.point(from_node, context)
+                to_point = cls.point(to_node, context)
+                if from_point is None or to_point is None:
+                    return 0.0
+                return walking_estimator.min_seconds(from_point, to_point)
+        @classmethod
+        def at_least_min_seconds(
+            cls,
+            from_node,
+            to_node,
+            seconds,
+            context=None
+        ):
+                '''
+                Returns seconds, or min_seconds(from_node, to_node) rounded up
+                if it is greater. This keeps the promise that min_seconds makes
+                even for rounded or surprising walking times.
+                '''
+                return max(
+                    seconds,
+                    math.ceil(cls.min_seconds(from_node, to_node, context))
+                )
         @classmethod
-        def use_origin_destination(cls,origin, destination):
+        def local_point(cls, node, context=None):
+                '''
+                Returns the location of the node if walking times to and from
+                it should be estimated instead of requested from the API. That
+                is the case for places that the gazetteer knows and, in offline
+                mode, for every place whose location is known. Otherwise, None
+                is returned.
+                '''
+                if node in stops.name_to_point:
+                    return None
+                if cls.offline(context):
+                    return cls.point(node, context)
+                place = gazetteer.resolve(node)
+                return None if place is None else place.point
+        @classmethod
+        def use_origin_destination_async(
+            cls,
+            origin,
+            destination,
+            context=None
+        ):
+                # The API may be slow, so do this in the background.
+                return agency_common.get_pool().apply_async(
+                    cls.use_origin_destination_background,
+                    (origin, destination, context)
+                )
+        @classmethod
+        def use_origin_destination_background(
+            cls,
+            origin,
+            destination,
+            context=None
+        ):
+                with metrics.span(
+                    "use_origin_destination_background",
+                    agency=cls.__name__
+                ):
+                    cls.use_origin_destination(origin, destination, context)
+        @classmethod
+        def use_origin_destination(cls, origin, destination, context=None):
+                # Known places do not need the API at all.
+                origin_point = cls.local_point(origin, context)
+                destination_point = cls.local_point(destination, context)
+                if origin_point is not None:
+                    cls.estimate_origin(origin, origin_point, context)
+                if destination_point is not None:
+                    cls.estimate_destination(
+                        destination,
+                        destination_point,
+                        context
+                    )
+                if destination not in stops.name_to_point and (
+                    origin_point is not None or destination_point is not None
+                ):
+                    cls.estimate_edges(((origin, destination),), context)
+                if cls.offline(context):
+                    return
+                # The time budget starts now, so that the whole query waits for
+                # the API no longer than api_budget_seconds.
+                deadline = time.monotonic() + cls.api_budget_seconds(context)
+                # When only one of the origin and the destination is a known
+                # place, the API is asked about its coordinates instead of its
+                # name.
+                api_names = {}
+                origin_api = origin
+                destination_api = destination
+                if origin_point is not None:
+                    origin_api = str(origin_point)
+                    api_names[origin_api] = origin
+                if destination_point is not None:
+                    destination_api = str(destination_point)
+                    api_names[destination_api] = destination
+                query_edges = cls.query_state(context).edges
+                def known(key):
+                    # Walking times that earlier queries got from the API are
+                    # reused.
+                    edge = cls.edges.get(key)
+                    if edge is not None:
+                        query_edges[key] = edge
+                    return key in query_edges
                 #This is from the origin to bus stops
                 new_stops_origin = []
                 new_stops_dest = []
-                for stop in cls.stop_names: ##don't need to make an api call for edges already in the dict
-                    if (origin, stop) not in cls.edges:
+                for stop in stops.names_sorted: ##don't need to make an api call for edges already in the dict
+                    if not known((origin, stop)):
                         new_stops_origin.append(stop)
-                    if (stop, destination) not in cls.edges:
+                    if not known((stop, destination)):
                         new_stops_dest.append(stop)
-
-                if destination not in stops.name_to_point and (origin, destination) not in cls.edges: ## have the origin route to the destination too, but only add if it's not already a stop
-                    new_stops_origin.append(destination)
-                #This is from the origin to bus stops
+                # The walk from the origin to the destination is requested
+                # along with whichever side is not a known place.
+                if destination not in stops.name_to_point and \
+                    not known((origin, destination)) and \
+                    (origin_point is None or destination_point is None):
+                    if origin_point is None:
+                        new_stops_origin.append(destination_api)
+                    else:
+                        new_stops_dest.append(origin_api)
                 #if origin isn't a bus stop and every edge for this stop is already cached 
                 #we wont make an api request   
-                if origin not in stops.name_to_point and len(new_stops_origin) != 0: 
-                        origin_from_nodes = [origin]
-                        origin_to_nodes = new_stops_origin
-                        orig = cls.matrix_api_call(origin_from_nodes, origin_to_nodes)
-                        if orig:
-                            for to_node_i, to_node in enumerate(orig['destination_addresses']): ## bus stops are destinations
-                                    row = orig['rows'][0]
-                                    cell = row['elements'][to_node_i]
-                                    from_node = origin
-                                    to_node_name = origin_to_nodes[to_node_i] ##we have to get the bus stop name
-
-                                    if cell['status'] == 'OK':
-                                            key = (from_node, to_node_name)
-                                            ##the distance is being sent in text form as that is to be read by humans while the duration is sent
-                                            ##by value as it is only considered by the computer
-                                            ##I think I will change this though to just send cell['distance'] and cell['duration']
-                                            cls.edges[key] = (cell['distance']['text'], cell['duration']['value'], to_node)
-                                    else:
-                                            print("Error with edge")
-
-                #This is from the bus stops to destination
-                if destination not in stops.name_to_point and len(new_stops_dest) != 0:
-                        dest_from_nodes = new_stops_dest
-                        dest_to_nodes = [destination]
-                        dest = cls.matrix_api_call(dest_from_nodes, dest_to_nodes)
-                        if dest:
-                            for from_node_i, from_node in enumerate(dest['origin_addresses']):
-                                    row = dest['rows'][from_node_i]
-                                    cell = row['elements'][0]
-                                    to_node = destination
-                                    from_node_name = dest_from_nodes[from_node_i]
-                                    if cell['status'] == 'OK':
-                                            key = (from_node_name, destination)
-                                            ##the distance is being sent in text form as that is to be read by humans while the duration is sent
-                                            ##by value as it is only considered by the computer
-                                            ##I think I will change this though to just send cell['distance'] and cell['duration']
-                                            cls.edges[key] = (cell['distance']['text'], cell['duration']['value'], dest['destination_addresses'][0])
-                                    else:
-                                            print("Error with edge")
-
-
-
-
+                requested = []
+                if origin not in stops.name_to_point and \
+                    origin_point is None and len(new_stops_origin) != 0:
+                    #This is from the origin to bus stops
+                    requested.append(([origin_api], new_stops_origin))
+                if destination not in stops.name_to_point and \
+                    destination_point is None and len(new_stops_dest) != 0:
+                    #This is from the bus stops to destination
+                    requested.append((new_stops_dest, [destination_api]))
+                if google_maps.breaker.is_open():
+                    # The API has been failing. Do not wait for it at all.
+                    cls.estimate_edges(
+                        (
+                            (
+                                api_names.get(from_node, from_node),
+                                api_names.get(to_node, to_node)
+                            )
+                            for from_nodes, to_nodes in requested
+                            for from_node in from_nodes
+                            for to_node in to_nodes
+                        ),
+                        context
+                    )
+                    return
+                # Both directions are requested at the same time.
+                failed = []
+                for from_node, to_node, cell, address in \
+                    google_maps.matrix_api_call_chunked(requested, deadline):
+                    key = (
+                        api_names.get(from_node, from_node),
+                        api_names.get(to_node, to_node)
+                    )
+                    if cell is None:
+                        failed.append(key)
+                    elif cell['status'] == 'OK':
+                        ##the distance is being sent in text form as that is to be read by humans while the duration is sent
+                        ##by value as it is only considered by the computer
+                        edge = (
+                            cell['distance']['text'],
+                            cls.at_least_min_seconds(
+                                key[0],
+                                key[1],
+                                cell['duration']['value'],
+                                context
+                            ),
+                            address
+                        )
+                        cls.edges[key] = edge
+                        query_edges[key] = edge
+                        cls.query_state(context).estimated_edges.pop(
+                            key,
+                            None
+                        )
+                    else:
+                        # There is no walk between these places, e.g.
+                        # because one of them was not found.
+                        metrics.count(
+                            "walking_edge_errors",
+                            status=cell['status']
+                        )
+                cls.estimate_edges(failed, context)
         @classmethod
         def get_edge(cls, from_node, to_node,
-                datetime_depart=datetime.datetime.min,
-                datetime_arrive=datetime.datetime.max,
-                consecutive_agency=None
+            datetime_depart=datetime.datetime.min,
+            datetime_arrive=datetime.datetime.max,
+            consecutive_agency=None,
+            context=None
         ):
                 key = (from_node, to_node)
 
                 if consecutive_agency is None or not issubclass(consecutive_agency, AgencyWalking):
                         ##check consecutive agency we don't want to repeat agencies
                         #the nodes must be in the dictionary otherwise we can't do anything.
+                        state = cls.query_state(context)
                         try:
-                                distance, seconds, address = cls.edges[key]
+                            distance, seconds, address = state.edges[key]
                         except KeyError:
+                            try:
+                                distance, seconds, address = \
+                                    state.estimated_edges[key]
+                            except KeyError:
                                     return
-                        if seconds < cls.max_seconds: # the distance between the two nodes isn't impossible
+                        if seconds < cls.get_max_seconds(context): # the distance between the two nodes isn't impossible
                             travel_duration = datetime.timedelta(seconds=seconds)
                             if datetime_depart == datetime.datetime.min and \
                                datetime_arrive != datetime.datetime.max: ##arrival time passed in
@@ -170,7 +458,6 @@ class AgencyWalkingDynamic(AgencyWalking):
                                             datetime_depart += ONE_MINUTE
                                             datetime_arrive += ONE_MINUTE
 if __name__ == "__main__":
-    print(_apikey)
     bus_st = "6 MetroTech"
     origin = "Kimmel Center For University Life"
     dest = "5 MetroTech"
@@ -203,8 +490,6 @@ if __name__ == "__main__":
             break
 
         # print("THIS SHOULDN'T WORK bus_st2 to bus_st: " )
-        # for e in s.get_edge(bus_st_2 ,bus_st, datetime.datetime.now()):       
+        # for e in s.get_edge(bus_st_2 ,bus_st, datetime.datetime.now()):
         #     print(e.human_readable_instruction)
         #     break
-
-
@@ -1,13 +1,36 @@
 #!/usr/bin/env python3
-import datetime, pickle
+import datetime, pickle, sys
 from agency_walking import AgencyWalking
 from common import Weight
-from common_walking_static import WALKING_TIMES_PICKLE
+from common_walking_static import WALKING_TIMES_NETWORK, WALKING_TIMES_PICKLE
+import data_snapshot, network_file
 
 ONE_MINUTE = datetime.timedelta(minutes=1)
 
-with open(WALKING_TIMES_PICKLE, "rb") as f:
-    WALKING_TIMES = pickle.load(f)
+def load_walking_times():
+    '''
+    Loads a mapping from (from, to) tuples to (seconds, filename) tuples.
+    '''
+    # Prefer the compiled network file, which loads much faster than the
+    # pickle.
+    try:
+        return network_file.WalkingNetwork(WALKING_TIMES_NETWORK).walking_times
+    except (OSError, network_file.NetworkFileError) as e:
+        if not isinstance(e, FileNotFoundError):
+            print(
+                "Cannot use ", WALKING_TIMES_NETWORK, ": ", e,
+                sep="",
+                file=sys.stderr
+            )
+        with open(WALKING_TIMES_PICKLE, "rb") as f:
+            return pickle.load(f)
+# The walking times are loaded on first use so that importing this module is
+# fast. They are reloaded when the files are rebuilt.
+walking_times = data_snapshot.Data(
+    "the static walking times",
+    (WALKING_TIMES_NETWORK, WALKING_TIMES_PICKLE),
+    load_walking_times
+)
 
 class AgencyWalkingStatic(AgencyWalking):
     @classmethod
@@ -17,12 +40,15 @@ class AgencyWalkingStatic(AgencyWalking):
         to_node,
         datetime_depart=datetime.datetime.min,
         datetime_arrive=datetime.datetime.max,
-        consecutive_agency=None
+        consecutive_agency=None,
+        context=None
     ):
         if consecutive_agency is None or \
             not issubclass(consecutive_agency, AgencyWalking):
             try:
-                seconds, directions_file = WALKING_TIMES[(from_node, to_node)]
+                seconds, directions_file = walking_times.current().data[
+                    (from_node, to_node)
+                ]
             except KeyError:
                 # Walking directions are not available between these two nodes
                 # in this direction. Yield nothing.
@@ -30,7 +56,7 @@ class AgencyWalkingStatic(AgencyWalking):
             else:
                 # Walking directions don't change based on the time.
                 # Yield trips one minute apart.
-                if seconds < cls.max_seconds:
+                if seconds < cls.get_max_seconds(context):
                     travel_duration = datetime.timedelta(seconds=seconds)
                     if datetime_depart == datetime.datetime.min and \
                         datetime_arrive != datetime.datetime.max:
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+'''
+This module answers many queries at once for get_itinerary.py --batch.
+
+Every line of the input is a JSON object in the same format as the queries of
+itinerary_server, e.g.
+    {"id": 7, "origin": "715 Broadway", "destination": "6 MetroTech",
+     "datetime": "2019-04-15 9:00", "depart": true}
+The id is optional; it defaults to the line number, starting at 1. For every
+query, one line is written: a JSON object with the id and either the answer,
+like the responses of itinerary_server, or "error".
+
+The data is loaded before the worker processes are forked, so they share it.
+The queries are read in windows. Within a window, queries with the same
+origin are sent to the same worker together, and queries that also have the
+same destination and options share one agency_common.QueryContext, so the
+agencies prepare for the origin and destination once. The answers are
+written in the order of the input unless ordered is False. Every worker keeps
+the answers of recent queries in a result_cache.ResultCache, so queries that
+are repeated exactly are only searched once per worker. If cache_path is set,
+the workers also share answers, with each other and with later runs, through
+a result_cache.DiskCache. Times are only put in buckets if bucket_seconds is
+set, so by default every answer is the same as without the caches.
+'''
+import collections, json, multiprocessing, sys
+import get_itinerary, itinerary_server, result_cache
+# This is the number of queries that are grouped together at a time. A larger
+# window finds more queries with the same origin but delays the first answers.
+WINDOW = 4096
+# Groups that are larger than this are split so that all workers stay busy.
+MAX_GROUP = 256
+# These arguments do not affect how the agencies prepare for a query, so
+# queries that differ only in them can share a context.
+PER_QUERY_ARGUMENTS = (
+    "datetime",
+    "depart",
+    "list_departures",
+    "number_of_itineraries",
+    "stats",
+    "trace"
+)
+
+def read_queries(lines):
+    '''
+    Yields an (id, query) tuple for every line that is not blank. If a line
+    is not a JSON object, the query is a string that describes the error.
+    '''
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            query = json.loads(line)
+        except ValueError as e:
+            yield line_number, "invalid JSON: " + str(e)
+            continue
+        if not isinstance(query, dict):
+            yield line_number, "The query must be a JSON object."
+            continue
+        yield query.pop("id", line_number), query
+def context_key(args_parsed):
+    return tuple(sorted(
+        (name, repr(value))
+        for name, value in vars(args_parsed).items()
+        if name not in PER_QUERY_ARGUMENTS
+    ))
+def answer_group(group):
+    '''
+    Answers a list of (index, id, query) tuples in a worker process. Returns
+    a list of (index, answer) tuples, where every answer is a dictionary that
+    can be encoded as JSON.
+    '''
+    contexts = {}
+    answers = []
+    for index, query_id, query in group:
+        answer = {"id": query_id}
+        try:
+            if isinstance(query, str):
+                raise itinerary_server.QueryError(query)
+            args_parsed = get_itinerary.parse_args(
+                get_itinerary.AGENCIES,
+                itinerary_server.query_to_args(query),
+                itinerary_server.QueryArgumentParser
+            )
+            key = context_key(args_parsed)
+            try:
+                context = contexts[key]
+            except KeyError:
+                context = get_itinerary.query_context(args_parsed)
+                contexts[key] = context
+            answer.update(itinerary_server.run_query(args_parsed, context))
+        except itinerary_server.QueryError as e:
+            answer["error"] = str(e)
+        except Exception as e:
+            # One bad query must not stop the whole batch.
+            answer["error"] = "{}: {}".format(type(e).__name__, e)
+        answers.append((index, answer))
+    return answers
+def groups(window):
+    '''
+    Splits a list of (index, id, query) tuples into lists of queries with the
+    same origin.
+    '''
+    by_origin = collections.OrderedDict()
+    for item in window:
+        query = item[2]
+        origin = query.get("origin") if isinstance(query, dict) else None
+        by_origin.setdefault(repr(origin), []).append(item)
+    for group in by_origin.values():
+        for i in range(0, len(group), MAX_GROUP):
+            yield group[i:i + MAX_GROUP]
+def windows(queries, size=WINDOW):
+    '''
+    Yields lists of up to size (index, id, query) tuples.
+    '''
+    window = []
+    for index, (query_id, query) in enumerate(queries):
+        window.append((index, query_id, query))
+        if len(window) >= size:
+            yield window
+            window = []
+    if window:
+        yield window
+def run(
+    lines,
+    output,
+    processes=None,
+    ordered=True,
+    cache_path=None,
+    bucket_seconds=0
+):
+    '''
+    Answers the queries in lines, which is an iterable of strings, and writes
+    the answers to output, which is a text file, one per line. Returns the
+    number of queries.
+    '''
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    # Load the data before forking so that the workers share its pages.
+    itinerary_server.warm()
+    itinerary_server.cache = result_cache.ResultCache(
+        bucket_seconds=bucket_seconds,
+        backing=None if cache_path is None else
+            result_cache.DiskCache(cache_path, bucket_seconds=bucket_seconds)
+    )
+    try:
+        context = multiprocessing.get_context("fork")
+    except ValueError:
+        context = multiprocessing.get_context()
+    count = 0
+    with context.Pool(processes, initializer=itinerary_server.warm) as pool:
+        for window in windows(read_queries(lines)):
+            # Answers that arrive early wait here until the answers before
+            # them have been written.
+            waiting = {}
+            next_index = window[0][0]
+            for answers in pool.imap_unordered(answer_group, groups(window)):
+                for index, answer in answers:
+                    if ordered:
+                        waiting[index] = answer
+                    else:
+                        output.write(json.dumps(answer) + "\n")
+                while next_index in waiting:
+                    output.write(json.dumps(waiting.pop(next_index)) + "\n")
+                    next_index += 1
+                output.flush()
+            count += len(window)
+    return count
+def main(
+    path,
+    processes=None,
+    ordered=True,
+    cache_path=None,
+    bucket_seconds=0
+):
+    '''
+    Answers the queries in the file at path, or in standard input if path is
+    "-", and writes the answers to standard output.
+    '''
+    if path == "-":
+        run(
+            sys.stdin,
+            sys.stdout,
+            processes,
+            ordered,
+            cache_path,
+            bucket_seconds
+        )
+    else:
+        with open(path, "r", encoding="UTF-8") as f:
+            run(f, sys.stdout, processes, ordered, cache_path, bucket_seconds)
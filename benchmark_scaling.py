@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+'''
+Runs the scenarios of benchmark_suite on made-up networks of several sizes
+from generate_network and reports how their times grow with the size, so that
+it is known what becomes too slow first as more routes and stops are added.
+
+For every scale, a network with scale times as many routes and stops as a
+network of scale 1 (see generate_network.NetworkSize.scaled) is generated.
+Then, in new processes:
+    the schedules, the walking times and the stop locations are loaded and
+    timed, including decoding every schedule and reading every walking time,
+    and the peak memory of the process is measured
+    every scenario of benchmark_suite runs on its own with a time limit. A
+    scenario that does not finish in time, or fails, e.g. because memory ran
+    out, is not run at larger scales.
+
+The growth of every measurement is reported as an exponent k, so that the
+measurement is roughly proportional to scale ** k: 1 is linear, 2 is
+quadratic. There is an exponent between every two consecutive scales, and one
+that is fitted by least squares to all the scales where the measurement was
+made. The medians of the samples of the scenarios are used.
+
+Usage: benchmark_scaling.py [--scale N]... [--queries N] [--repeat N]
+                            [--scenario NAME]... [--timeout SECONDS]
+                            [--directory DIRECTORY] [--json FILE]
+                            [--stops-per-route N] [--trips-per-day N]
+                            [--pattern NAME]... [--walking-radius METERS]
+                            [--seed N]
+'''
+import argparse, json, math, os, platform, subprocess, sys, tempfile, time
+import attr
+from common import file_in_this_dir
+import benchmark_suite, generate_network
+DEFAULT_SCALES = (1.0, 10.0, 100.0)
+DEFAULT_QUERIES = 5
+DEFAULT_REPEAT = 1
+DEFAULT_TIMEOUT_SECONDS = 300.0
+# The import of get_itinerary does not depend on the data.
+DEFAULT_SCENARIOS = tuple(
+    name for name in benchmark_suite.SCENARIOS
+    if name != "import_get_itinerary"
+)
+# This code runs in a new process with NYU_DATA_DIRECTORY set. It prints the
+# times that loading the data took in milliseconds and the peak memory in
+# megabytes as JSON. The compiled network files are memory-mapped and decoded
+# on first use, so every schedule and walking time is read, as the queries
+# would read them, to measure what loading them really costs.
+LOAD = '''
+import json, time
+import agency_nyu, agency_walking_static, stops
+def load_schedules():
+    network, schedule_by_day = agency_nyu.schedules.current().data
+    for schedules_on_day in schedule_by_day:
+        pass
+def load_walking_times():
+    walking_times = agency_walking_static.walking_times.current().data
+    for item in walking_times.items():
+        pass
+results = {}
+for name, load in (
+    ("load_schedules", load_schedules),
+    ("load_walking_times", load_walking_times),
+    ("load_stops", stops.load)
+):
+    start = time.perf_counter()
+    load()
+    results[name] = (time.perf_counter() - start) * 1000.0
+try:
+    import resource
+except ImportError:
+    pass
+else:
+    # ru_maxrss is in kilobytes on Linux.
+    results["peak_memory_mb"] = \\
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+print(json.dumps(results))
+'''
+
+def run_in_data(arguments, directory, timeout):
+    '''
+    Runs Python with the arguments in a new process that uses the data in the
+    directory and returns what it printed, decoded as JSON.
+    subprocess.TimeoutExpired and subprocess.CalledProcessError are raised if
+    it takes longer than timeout seconds or fails.
+    '''
+    result = subprocess.run(
+        [sys.executable] + arguments,
+        cwd=file_in_this_dir(""),
+        env=dict(os.environ, NYU_DATA_DIRECTORY=os.path.abspath(directory)),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        timeout=timeout,
+        check=True
+    )
+    return json.loads(result.stdout)
+def exponent(points):
+    '''
+    Returns the slope of the least-squares line through the logarithms of a
+    list of (scale, value) tuples, or None if there are not two different
+    scales with positive values.
+    '''
+    logs = [
+        (math.log(scale), math.log(value))
+        for scale, value in points if value is not None and value > 0.0
+    ]
+    if len({x for x, y in logs}) < 2:
+        return None
+    mean_x = sum(x for x, y in logs) / len(logs)
+    mean_y = sum(y for x, y in logs) / len(logs)
+    return sum((x - mean_x) * (y - mean_y) for x, y in logs) / \
+        sum((x - mean_x) ** 2 for x, y in logs)
+def run(
+    scales=DEFAULT_SCALES,
+    scenarios=DEFAULT_SCENARIOS,
+    query_count=DEFAULT_QUERIES,
+    repeat=DEFAULT_REPEAT,
+    timeout=DEFAULT_TIMEOUT_SECONDS,
+    directory=None,
+    size_arguments=None,
+    log=sys.stderr
+):
+    '''
+    Generates a network for every scale, measures it and returns the results
+    as a dictionary that can be encoded as JSON.
+
+    Arguments:
+        directory:
+            the directory in which a directory is created for the network of
+            every scale and kept, or None to use a temporary directory
+        size_arguments:
+            other arguments of generate_network.NetworkSize
+        log:
+            a text file to which progress is written, or None
+    '''
+    def progress(*args):
+        if log is not None:
+            print(*args, file=log, flush=True)
+    if directory is None:
+        with tempfile.TemporaryDirectory() as temporary:
+            return run(
+                scales,
+                scenarios,
+                query_count,
+                repeat,
+                timeout,
+                temporary,
+                size_arguments,
+                log
+            )
+    results = []
+    # The scenarios that timed out or failed, with what happened
+    stopped = {}
+    for scale in sorted(scales):
+        size = generate_network.NetworkSize.scaled(
+            scale,
+            **(size_arguments or {})
+        )
+        data = os.path.join(directory, "scale_{:g}".format(scale))
+        progress("Generating a network of scale {:g}...".format(scale))
+        start = time.perf_counter()
+        network = generate_network.generate(size)
+        generate_network.write(data, network)
+        result = {
+            "scale": scale,
+            "counts": network.counts(),
+            "generate_seconds": time.perf_counter() - start,
+            "measurements": {},
+            "stopped": {}
+        }
+        del network
+        groups = [("load", ["-c", LOAD])] + [
+            (
+                name,
+                [
+                    file_in_this_dir("benchmark_suite.py"),
+                    "--json", "-",
+                    "--queries", str(query_count),
+                    "--repeat", str(repeat),
+                    "--scenario", name
+                ]
+            )
+            for name in scenarios
+        ]
+        for name, arguments in groups:
+            if name in stopped:
+                result["stopped"][name] = stopped[name]
+                continue
+            progress("  Running", name, "at scale {:g}...".format(scale))
+            try:
+                output = run_in_data(arguments, data, timeout)
+            except subprocess.TimeoutExpired:
+                stopped[name] = "took longer than {:g} s at scale {:g}".format(
+                    timeout,
+                    scale
+                )
+            except subprocess.CalledProcessError as e:
+                stopped[name] = "failed at scale {:g}: {}".format(
+                    scale,
+                    (e.stderr.strip().splitlines() or ["?"])[-1]
+                )
+            else:
+                if name == "load":
+                    result["measurements"].update(output)
+                else:
+                    for scenario, r in output["scenarios"].items():
+                        result["measurements"][scenario] = r["p50"]
+                continue
+            result["stopped"][name] = stopped[name]
+            progress("    It", stopped[name] + ".")
+        results.append(result)
+    names = []
+    for result in results:
+        for name in result["measurements"]:
+            if name not in names:
+                names.append(name)
+    exponents = {}
+    for name in names:
+        points = [
+            (result["scale"], result["measurements"].get(name))
+            for result in results
+        ]
+        exponents[name] = {
+            "fit": exponent(points),
+            "steps": [
+                exponent([a, b]) for a, b in zip(points, points[1:])
+            ]
+        }
+    return {
+        "python": platform.python_version(),
+        "queries": query_count,
+        "repeat": repeat,
+        "timeout": timeout,
+        "size": {
+            name: value
+            for name, value in attr.asdict(
+                generate_network.NetworkSize.scaled(
+                    1.0,
+                    **(size_arguments or {})
+                )
+            ).items()
+            if name not in ("routes", "stops")
+        },
+        "scales": results,
+        "exponents": exponents
+    }
+def print_results(results):
+    scales = results["scales"]
+    def row(label, values, fit=""):
+        print(
+            "{:<24}".format(label) +
+            "".join("{:>11}".format(v) for v in values) +
+            "{:>8}".format(fit)
+        )
+    def number(value, digits):
+        return "-" if value is None else "{:.{}f}".format(value, digits)
+    row("Scale", ("{:g}".format(s["scale"]) for s in scales), "k")
+    for name in scales[0]["counts"]:
+        row(name.capitalize(), (s["counts"][name] for s in scales))
+    row(
+        "Generating (s)",
+        (number(s["generate_seconds"], 2) for s in scales)
+    )
+    print()
+    print("Medians in milliseconds, peak memory in megabytes:")
+    for name, e in results["exponents"].items():
+        row(
+            name,
+            (number(s["measurements"].get(name), 2) for s in scales),
+            number(e["fit"], 2)
+        )
+    print()
+    print("Exponents between consecutive scales:")
+    for name, e in results["exponents"].items():
+        row(name, ("",) + tuple(number(k, 2) for k in e["steps"]))
+    stopped = {}
+    for s in scales:
+        stopped.update(s["stopped"])
+    if stopped:
+        print()
+        for name, reason in stopped.items():
+            print("{} {}.".format(name, reason))
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description=
+            "Measures how the time of the benchmarks grows with the size of "
+            "the network."
+    )
+    arg_parser.add_argument(
+        "--scale",
+        action="append",
+        type=float,
+        help=
+            "a scale of the network to measure; may be given more than once "
+            "(default: {})".format(
+                ", ".join("{:g}".format(s) for s in DEFAULT_SCALES)
+            )
+    )
+    arg_parser.add_argument(
+        "--queries",
+        type=int,
+        default=DEFAULT_QUERIES,
+        metavar="N",
+        help="the number of queries in every scenario"
+    )
+    arg_parser.add_argument(
+        "--repeat",
+        type=int,
+        default=DEFAULT_REPEAT,
+        metavar="N",
+        help="the number of times to run every query"
+    )
+    arg_parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=benchmark_suite.SCENARIOS,
+        help=
+            "run only this scenario; may be given more than once (default: "
+            "all but import_get_itinerary)"
+    )
+    arg_parser.add_argument(
+        "--timeout",
+        type=float,
+        default=DEFAULT_TIMEOUT_SECONDS,
+        metavar="SECONDS",
+        help=
+            "the longest that a scenario may take at one scale before it is "
+            "not run at larger scales"
+    )
+    arg_parser.add_argument(
+        "--directory",
+        metavar="DIRECTORY",
+        help=
+            "keep the networks in DIRECTORY instead of a temporary directory"
+    )
+    arg_parser.add_argument(
+        "--json",
+        metavar="FILE",
+        help="also write the results to FILE as JSON (- for standard output)"
+    )
+    arg_parser.add_argument(
+        "--stops-per-route",
+        type=int,
+        default=generate_network.DEFAULT_STOPS_PER_ROUTE,
+        metavar="N",
+        help="the number of stops on each route"
+    )
+    arg_parser.add_argument(
+        "--trips-per-day",
+        type=int,
+        default=generate_network.DEFAULT_TRIPS_PER_DAY,
+        metavar="N",
+        help="the number of trips of each route on weekdays"
+    )
+    arg_parser.add_argument(
+        "--pattern",
+        action="append",
+        choices=generate_network.PATTERNS,
+        help="a pattern of routes; may be given more than once"
+    )
+    arg_parser.add_argument(
+        "--walking-radius",
+        type=float,
+        default=generate_network.DEFAULT_WALKING_RADIUS,
+        metavar="METERS",
+        help=
+            "the greatest distance between stops with walking times; 0 for "
+            "every pair of stops"
+    )
+    arg_parser.add_argument(
+        "--seed",
+        type=int,
+        default=generate_network.DEFAULT_SEED
+    )
+    args = arg_parser.parse_args()
+    scales = args.scale or DEFAULT_SCALES
+    if any(scale <= 0.0 for scale in scales):
+        arg_parser.error("--scale must be greater than 0")
+    if args.queries < 1:
+        arg_parser.error("--queries must be 1 or more")
+    if args.repeat < 1:
+        arg_parser.error("--repeat must be 1 or more")
+    size_arguments = {
+        "stops_per_route": args.stops_per_route,
+        "trips_per_day": args.trips_per_day,
+        "patterns": args.pattern or generate_network.PATTERNS,
+        "walking_radius": args.walking_radius or None,
+        "seed": args.seed
+    }
+    try:
+        generate_network.NetworkSize.scaled(1.0, **size_arguments)
+    except ValueError as e:
+        arg_parser.error(str(e))
+    results = run(
+        scales,
+        args.scenario or DEFAULT_SCENARIOS,
+        args.queries,
+        args.repeat,
+        args.timeout,
+        args.directory,
+        size_arguments
+    )
+    if args.json == "-":
+        json.dump(results, sys.stdout, indent=4)
+        print()
+    else:
+        if args.json is not None:
+            with open(args.json, "w", encoding="UTF-8") as f:
+                json.dump(results, f, indent=4)
+        print_results(results)
+
+if __name__ == "__main__":
+    main()
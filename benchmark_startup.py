@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+'''
+Measures how long it takes to import get_itinerary, which is most of the time
+that a short query takes, and fails if it takes longer than the budget.
+
+The import is timed with python -X importtime in fresh processes, and the
+median is compared to the budget. This script also checks that importing
+get_itinerary does not load any schedules or walking times, read the stop
+locations, or import modules that are only needed for some queries.
+
+Usage: benchmark_startup.py [--budget MILLISECONDS] [--runs N] [--top N]
+'''
+import argparse, statistics, subprocess, sys
+from common import file_in_this_dir
+MODULE = "get_itinerary"
+# The import of get_itinerary may take this many milliseconds. Raise it only
+# if a slower import is really needed.
+DEFAULT_BUDGET_MILLISECONDS = 150.0
+# These modules are slow to import and are only needed by some queries.
+DEFERRED_MODULES = ("dateutil", "keyring", "requests")
+# This code runs in a new process after get_itinerary has been imported. It
+# prints the data that was loaded anyway.
+CHECK_LAZY = '''
+import sys
+import agency_nyu, agency_walking_static, stops
+loaded = []
+if agency_nyu.schedules.loaded():
+    loaded.append("agency_nyu.schedules")
+if agency_walking_static.walking_times.loaded():
+    loaded.append("agency_walking_static.walking_times")
+if "names_sorted" in vars(stops):
+    loaded.append("stops.names_sorted")
+for name in {!r}:
+    if name in sys.modules:
+        loaded.append(name)
+print("\\n".join(loaded))
+'''.format(DEFERRED_MODULES)
+
+def import_times(module):
+    '''
+    Imports the module in a new process and returns a dictionary from the
+    names of the modules that were imported to their cumulative import times
+    in microseconds.
+    '''
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + module],
+        cwd=file_in_this_dir(""),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            cumulative = int(fields[1])
+        except ValueError:
+            # This is the header line.
+            continue
+        times[fields[2].strip()] = cumulative
+    return times
+def loaded_eagerly(module):
+    '''
+    Imports the module in a new process and returns a list of the data and
+    modules that should have been deferred but were loaded.
+    '''
+    result = subprocess.run(
+        [sys.executable, "-c", "import " + module + "\n" + CHECK_LAZY],
+        cwd=file_in_this_dir(""),
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True
+    )
+    return result.stdout.split()
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description="Checks the time that it takes to import " + MODULE + "."
+    )
+    arg_parser.add_argument(
+        "--budget",
+        type=float,
+        default=DEFAULT_BUDGET_MILLISECONDS,
+        metavar="MILLISECONDS",
+        help="the longest median import time that is allowed"
+    )
+    arg_parser.add_argument(
+        "--runs",
+        type=int,
+        default=11,
+        metavar="N",
+        help="the number of times to import " + MODULE
+    )
+    arg_parser.add_argument(
+        "--top",
+        type=int,
+        default=10,
+        metavar="N",
+        help="the number of slowest modules to print"
+    )
+    args = arg_parser.parse_args()
+    if args.runs < 1:
+        arg_parser.error("--runs must be 1 or more")
+    runs = [import_times(MODULE) for i in range(args.runs)]
+    median = statistics.median(times[MODULE] for times in runs) / 1000.0
+    print("Slowest modules (median cumulative time):")
+    medians = {
+        name: statistics.median(times.get(name, 0) for times in runs)
+        for name in runs[0]
+    }
+    for name in sorted(medians, key=medians.get, reverse=True)[:args.top]:
+        print("  {:>8.1f} ms  {}".format(medians[name] / 1000.0, name))
+    print(
+        "Import of {}: {:.1f} ms (budget: {:.1f} ms)".format(
+            MODULE,
+            median,
+            args.budget
+        )
+    )
+    failed = False
+    for name in loaded_eagerly(MODULE):
+        print("Loaded at import time:", name)
+        failed = True
+    if median > args.budget:
+        print("The import took longer than the budget.")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+'''
+Measures how long the main operations take on fixed data, so that every
+optimization can be compared to a baseline.
+
+The benchmarks run offline. The Distance Matrix API is replaced by a stub
+that answers every request at once with made-up walking times that depend
+only on the origin and destination, so the results do not depend on the
+network. The queries are chosen from the bus stops with a fixed seed, and
+their times are fixed, so every run on the same data asks the same queries.
+
+To benchmark frozen copies of NYU.pickle (or NYU.network), WalkingStatic.pickle
+and Stop Locations.csv, put them in a directory and pass it with --data, which
+sets NYU_DATA_DIRECTORY (see common.py). The SHA-256 hashes of the data files
+are part of the results so that results on different data are not compared
+by mistake.
+
+Scenarios:
+    find_itinerary_depart, find_itinerary_arrive:
+        itinerary_finder.find_itinerary between pairs of bus stops
+    find_itinerary_address:
+        itinerary_finder.find_itinerary from an address that is not known, so
+        the Distance Matrix API stub is asked, and from scratch every time
+    find_itineraries_N:
+        all N itineraries of itinerary_finder.find_itineraries
+    nyu_get_edge:
+        the first edge of AgencyNYU.get_edge, or the time that it takes to
+        find that there is none
+    nyu_get_pickup:
+        the first edge of AgencyNYU.get_pickup
+    departure_list:
+        departure_lister.departure_list with 5 departures
+    import_get_itinerary:
+        the import of get_itinerary in a new process (see benchmark_startup)
+
+For every scenario, the time of every query is a sample, in milliseconds, and
+the results have the number of samples, their mean, standard deviation,
+minimum, maximum and 50th, 90th and 99th percentiles.
+
+Usage: benchmark_suite.py [--data DIRECTORY] [--repeat N] [--queries N]
+                          [--scenario NAME]... [--json FILE]
+                          [--baseline FILE]
+'''
+import argparse, datetime, hashlib, json, math, os, platform, random, \
+    statistics, sys, time, zlib
+# The modules of the itinerary finder are imported after --data has been
+# handled, because the paths of the data are fixed when common is imported.
+DEFAULT_REPEAT = 5
+DEFAULT_QUERIES = 20
+SEED = 20190415
+# Every query is on one of these days at one of these times.
+DATES = (
+    datetime.date(2019, 4, 15),
+    datetime.date(2019, 4, 17),
+    datetime.date(2019, 4, 20)
+)
+TIMES = (
+    datetime.time(7, 40),
+    datetime.time(9, 5),
+    datetime.time(12, 30),
+    datetime.time(17, 55),
+    datetime.time(23, 10)
+)
+ADDRESS = "1 Benchmark Plaza, New York, NY"
+ITINERARY_COUNTS = (2, 4, 8)
+
+def stub_matrix_api_call(origins, destinations, deadline):
+    '''
+    Stands in for google_maps.matrix_api_call. Every walk takes between 2 and
+    30 minutes, depending on a checksum of its origin and destination.
+    '''
+    rows = []
+    for origin in origins:
+        elements = []
+        for destination in destinations:
+            seconds = 120 + zlib.crc32(
+                (origin + "|" + destination).encode("UTF-8")
+            ) % 1680
+            elements.append({
+                "status": "OK",
+                "distance": {
+                    "text": "{:.1f} mi".format(seconds / 1200.0),
+                    "value": seconds * 1.34
+                },
+                "duration": {"value": seconds}
+            })
+        rows.append({"elements": elements})
+    return {
+        "status": "OK",
+        "origin_addresses": list(origins),
+        "destination_addresses": list(destinations),
+        "rows": rows
+    }
+def file_hash(path):
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+def data_hashes():
+    '''
+    Returns a dictionary from the names of the data files to their SHA-256
+    hashes, or to None for files that do not exist.
+    '''
+    from common import NODE_LIST_TXT, STOP_LOCATIONS_CSV
+    from common_nyu import NYU_NETWORK, NYU_PICKLE
+    from common_walking_static import WALKING_TIMES_NETWORK, \
+        WALKING_TIMES_PICKLE
+    return {
+        os.path.basename(path): file_hash(path)
+        for path in (
+            NYU_NETWORK,
+            NYU_PICKLE,
+            WALKING_TIMES_NETWORK,
+            WALKING_TIMES_PICKLE,
+            STOP_LOCATIONS_CSV,
+            NODE_LIST_TXT
+        )
+    }
+def summarize(samples):
+    '''
+    Returns the statistics of a list of samples in milliseconds.
+    '''
+    samples = sorted(samples)
+    def percentile(p):
+        return samples[max(0, math.ceil(p / 100.0 * len(samples)) - 1)]
+    return {
+        "samples": len(samples),
+        "mean": statistics.mean(samples),
+        "stdev": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        "min": samples[0],
+        "p50": percentile(50),
+        "p90": percentile(90),
+        "p99": percentile(99),
+        "max": samples[-1]
+    }
+def timed(function, arguments):
+    '''
+    Calls function with every tuple of arguments and returns a list of the
+    times that the calls took, in milliseconds.
+    '''
+    samples = []
+    for args in arguments:
+        start = time.perf_counter()
+        function(*args)
+        samples.append((time.perf_counter() - start) * 1000.0)
+    return samples
+
+class Scenarios:
+    '''
+    The scenarios, which share the queries. Every method whose name starts
+    with scenario_ returns a dictionary from the names of scenarios to lists
+    of samples.
+    '''
+    def __init__(self, query_count, repeat):
+        import agency_common, agency_nyu, agency_walking_dynamic, \
+            departure_lister, get_itinerary, google_maps, itinerary_finder, \
+            stops
+        self.agency_common = agency_common
+        self.agency_nyu = agency_nyu
+        self.agency_walking_dynamic = agency_walking_dynamic
+        self.departure_lister = departure_lister
+        self.itinerary_finder = itinerary_finder
+        self.agencies = get_itinerary.AGENCIES
+        self.agencies_to_vary = get_itinerary.AGENCIES_TO_VARY
+        self.repeat = repeat
+        google_maps.matrix_api_call = stub_matrix_api_call
+        names = stops.names_sorted
+        if len(names) < 2:
+            raise ValueError("There must be at least two bus stops.")
+        r = random.Random(SEED)
+        self.pairs = []
+        self.origins = []
+        for i in range(query_count):
+            origin, destination = r.sample(names, 2)
+            when = datetime.datetime.combine(r.choice(DATES), r.choice(TIMES))
+            self.pairs.append((origin, destination, when))
+            self.origins.append((origin, when))
+        # Load everything before anything is timed.
+        agency_nyu.schedules.current()
+        for agency in self.agencies:
+            agency.use_origin_destination(names[0], names[1])
+    def context(self, origin, destination):
+        return self.agency_common.QueryContext(origin, destination)
+    def find_itinerary(self, origin, destination, when, depart):
+        try:
+            self.itinerary_finder.find_itinerary(
+                self.agencies,
+                origin,
+                destination,
+                when,
+                depart,
+                context=self.context(origin, destination)
+            )
+        except self.itinerary_finder.ItineraryNotPossible:
+            pass
+    def repeated(self, function, arguments):
+        samples = []
+        for i in range(self.repeat):
+            samples.extend(timed(function, arguments))
+        return samples
+    def scenario_find_itinerary(self):
+        return {
+            "find_itinerary_depart": self.repeated(
+                self.find_itinerary,
+                [p + (True,) for p in self.pairs]
+            ),
+            "find_itinerary_arrive": self.repeated(
+                self.find_itinerary,
+                [p + (False,) for p in self.pairs]
+            )
+        }
+    def scenario_find_itinerary_address(self):
+        def find(destination, when):
+            # Forget the walks that the stub gave before so that the API is
+            # asked every time.
+            self.agency_walking_dynamic.AgencyWalkingDynamic.edges.clear()
+            self.find_itinerary(ADDRESS, destination, when, True)
+        return {
+            "find_itinerary_address": self.repeated(
+                find,
+                [(destination, when) for _, destination, when in self.pairs]
+            )
+        }
+    def scenario_find_itineraries(self):
+        results = {}
+        for count in ITINERARY_COUNTS:
+            def find(origin, destination, when):
+                for itinerary in self.itinerary_finder.find_itineraries(
+                    self.agencies_to_vary,
+                    self.agencies,
+                    origin,
+                    destination,
+                    when,
+                    True,
+                    max_count=count,
+                    context=self.context(origin, destination)
+                ):
+                    pass
+            results["find_itineraries_{}".format(count)] = \
+                self.repeated(find, self.pairs)
+        return results
+    def scenario_nyu_get_edge(self):
+        def first_edge(origin, destination, when):
+            for edge in self.agency_nyu.AgencyNYU.get_edge(
+                origin,
+                destination,
+                datetime_depart=when
+            ):
+                break
+        return {"nyu_get_edge": self.repeated(first_edge, self.pairs)}
+    def scenario_nyu_get_pickup(self):
+        def first_pickup(origin, when):
+            for edge in self.agency_nyu.AgencyNYU.get_pickup(origin, when):
+                break
+        return {"nyu_get_pickup": self.repeated(first_pickup, self.origins)}
+    def scenario_departure_list(self):
+        def departures(origin, when):
+            list(self.departure_lister.departure_list(
+                self.agencies,
+                origin,
+                when,
+                5,
+                self.context(origin, None)
+            ))
+        return {"departure_list": self.repeated(departures, self.origins)}
+    def scenario_import_get_itinerary(self):
+        import benchmark_startup
+        return {
+            "import_get_itinerary": [
+                benchmark_startup.import_times(benchmark_startup.MODULE)[
+                    benchmark_startup.MODULE
+                ] / 1000.0
+                for i in range(self.repeat)
+            ]
+        }
+SCENARIOS = (
+    "find_itinerary",
+    "find_itinerary_address",
+    "find_itineraries",
+    "nyu_get_edge",
+    "nyu_get_pickup",
+    "departure_list",
+    "import_get_itinerary"
+)
+
+def run(
+    scenarios=SCENARIOS,
+    query_count=DEFAULT_QUERIES,
+    repeat=DEFAULT_REPEAT
+):
+    '''
+    Runs the scenarios and returns the results as a dictionary that can be
+    encoded as JSON.
+    '''
+    s = Scenarios(query_count, repeat)
+    results = {}
+    for name in scenarios:
+        for scenario, samples in getattr(s, "scenario_" + name)().items():
+            results[scenario] = summarize(samples)
+    return {
+        "data": data_hashes(),
+        "python": platform.python_version(),
+        "queries": query_count,
+        "repeat": repeat,
+        "unit": "ms",
+        "scenarios": results
+    }
+def print_results(results, baseline=None):
+    print(
+        "{:<24} {:>8} {:>9} {:>9} {:>9} {:>9}{}".format(
+            "Scenario",
+            "Samples",
+            "p50",
+            "p90",
+            "p99",
+            "Mean",
+            "" if baseline is None else "  vs. baseline (p50)"
+        )
+    )
+    for name, r in results["scenarios"].items():
+        comparison = ""
+        if baseline is not None:
+            b = baseline["scenarios"].get(name)
+            if b is not None and b["p50"] > 0.0:
+                comparison = "  {:+.1%}".format(r["p50"] / b["p50"] - 1.0)
+        print(
+            "{:<24} {:>8} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}{}".format(
+                name,
+                r["samples"],
+                r["p50"],
+                r["p90"],
+                r["p99"],
+                r["mean"],
+                comparison
+            )
+        )
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description=
+            "Measures how long finding itineraries and departures takes on "
+            "fixed data."
+    )
+    arg_parser.add_argument(
+        "--data",
+        metavar="DIRECTORY",
+        help=
+            "the directory of the data files (default: NYU_DATA_DIRECTORY or "
+            "the directory of this script)"
+    )
+    arg_parser.add_argument(
+        "--repeat",
+        type=int,
+        default=DEFAULT_REPEAT,
+        metavar="N",
+        help="the number of times to run every query"
+    )
+    arg_parser.add_argument(
+        "--queries",
+        type=int,
+        default=DEFAULT_QUERIES,
+        metavar="N",
+        help="the number of queries in every scenario"
+    )
+    arg_parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=SCENARIOS,
+        help="run only this scenario; may be given more than once"
+    )
+    arg_parser.add_argument(
+        "--json",
+        metavar="FILE",
+        help="also write the results to FILE as JSON (- for standard output)"
+    )
+    arg_parser.add_argument(
+        "--baseline",
+        metavar="FILE",
+        help="compare the results to those in FILE, which --json wrote"
+    )
+    args = arg_parser.parse_args()
+    if args.repeat < 1:
+        arg_parser.error("--repeat must be 1 or more")
+    if args.queries < 1:
+        arg_parser.error("--queries must be 1 or more")
+    if args.data is not None:
+        os.environ["NYU_DATA_DIRECTORY"] = os.path.abspath(args.data)
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline, "r", encoding="UTF-8") as f:
+            baseline = json.load(f)
+    results = run(args.scenario or SCENARIOS, args.queries, args.repeat)
+    if args.json == "-":
+        json.dump(results, sys.stdout, indent=4)
+        print()
+    else:
+        if args.json is not None:
+            with open(args.json, "w", encoding="UTF-8") as f:
+                json.dump(results, f, indent=4)
+        if baseline is not None and baseline.get("data") != results["data"]:
+            print(
+                "The baseline was measured on other data, so it cannot be "
+                "compared.",
+                file=sys.stderr
+            )
+            baseline = None
+        print_results(results, baseline)
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
-import json, keyring, urllib.parse, urllib.request
+import json, urllib.parse, urllib.request
 from datetime import datetime, time
-_apikey = keyring.get_password("bing_maps", "default")
+_apikey = None
 TIME_TYPE_ARRIVE = 0
 TIME_TYPE_DEPART = 1
 TIME_TYPE_LAST_AVAIL = 2
@@ -18,6 +18,16 @@ _travel_mode_map = {
     TRAVEL_MODE_TRANSIT: "Transit",
     TRAVEL_MODE_DRIVING: "Driving"
 }
+def get_apikey():
+    '''
+    Returns the API key. It is looked up on first use because importing
+    keyring and asking it for a password is slow.
+    '''
+    global _apikey
+    if _apikey is None:
+        import keyring
+        _apikey = keyring.get_password("bing_maps", "default")
+    return _apikey
 def get_route(
     waypoints, time_type=TIME_TYPE_ARRIVE, dt=datetime.now(),
     travel_mode=TRAVEL_MODE_TRANSIT, metric_system=True, decode_json=True
@@ -56,7 +66,7 @@ def get_route(
         'dateTime': dt.strftime("%Y-%m-%d %I:%M %p"),
         'timeType': _time_type_map[time_type],
         'distanceUnit': "km" if metric_system else "mi",
-        'key': _apikey
+        'key': get_apikey()
     })
     url = "https://dev.virtualearth.net/REST/v1/Routes/" + \
         _travel_mode_map[travel_mode] + \
@@ -4,9 +4,15 @@ from agency_common import Agency
 
 def file_in_this_dir(name):
     return os.path.join(os.path.dirname(__file__), name)
+# The schedules, walking times and stop locations are read from and written to
+# this directory. Set the environment variable NYU_DATA_DIRECTORY to use other
+# data, e.g. fixtures for benchmarks.
+DATA_DIRECTORY = os.environ.get("NYU_DATA_DIRECTORY") or file_in_this_dir("")
+def data_file(name):
+    return os.path.join(DATA_DIRECTORY, name)
 
-NODE_LIST_TXT = file_in_this_dir("Node List.txt")
-STOP_LOCATIONS_CSV = file_in_this_dir("Stop Locations.csv")
+NODE_LIST_TXT = data_file("Node List.txt")
+STOP_LOCATIONS_CSV = data_file("Stop Locations.csv")
 
 @attr.s
 class Point:
@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 import attr, collections, datetime
-from common import file_in_this_dir
-NYU_PICKLE = file_in_this_dir("NYU.pickle")
+from common import data_file
+NYU_PICKLE = data_file("NYU.pickle")
+# The same schedules in the format of network_file
+NYU_NETWORK = data_file("NYU.network")
 DAYS_OF_WEEK = (
     "Monday",
     "Tuesday",
@@ -11,6 +13,28 @@ DAYS_OF_WEEK = (
     "Saturday",
     "Sunday"
 )
+# Abbreviations in the names of stops are expanded to these words. This is used
+# when reading the timetables and when matching what users type to places.
+ABBREVIATION_EXPANSION = {
+    "&": "At",
+    "at": "At",
+    "N": "North",
+    "E": "East",
+    "S": "South",
+    "W": "West",
+    "NB": "Northbound",
+    "EB": "Eastbound",
+    "SB": "Southbound",
+    "WB": "Westbound",
+    "Ave": "Avenue",
+    "St": "Street",
+    "street": "Street",
+    "Pl": "Place",
+    "Metrotech": "MetroTech",
+    "First": "1st",
+    "Second": "2nd",
+    "Third": "3rd",
+}
 
 def _deques_increasing_first(list_of_deques, greater_than=None):
     '''
@@ -54,6 +78,20 @@ class NYUSchedule:
     header_row = attr.ib(validator=attr.validators.instance_of(list))
     other_rows = attr.ib(validator=attr.validators.instance_of(list))
     days_of_week = attr.ib()
+    def index_header(self):
+        '''
+        Builds an index of self.header_row so that get_columns_indices and
+        get_column_indices look up the columns of a node instead of comparing
+        the node with every header. Call this function only when the header
+        row will not change anymore, e.g. after the schedule has been loaded
+        by an agency.
+        '''
+        header_index = {}
+        for index, header in enumerate(self.header_row):
+            header_index.setdefault(header, []).append(index)
+        # This is not an attribute of the class so that it does not affect
+        # comparisons or repr.
+        self.__dict__["_header_index"] = header_index
     def get_columns_indices(self, *nodes):
         '''
         Yields tuples of indices. In each tuple, the nth item is an index of
@@ -65,11 +103,17 @@ class NYUSchedule:
         # We assume that vehicles travel to the stops in the order in which
         # they are stored in the schedule from left to right; each node must be
         # to the right of the last.
-        nodes_occurrences = [collections.deque() for _ in nodes]
-        for index, header in enumerate(self.header_row):
-            for occurrences, node in zip(nodes_occurrences, nodes):
-                if header == node:
-                    occurrences.append(index)
+        header_index = self.__dict__.get("_header_index")
+        if header_index is not None:
+            nodes_occurrences = [
+                collections.deque(header_index.get(node, ())) for node in nodes
+            ]
+        else:
+            nodes_occurrences = [collections.deque() for _ in nodes]
+            for index, header in enumerate(self.header_row):
+                for occurrences, node in zip(nodes_occurrences, nodes):
+                    if header == node:
+                        occurrences.append(index)
         # Find combinations of indices. Each combination contains one index of
         # an occurrence of each requested node. We can take advantage of the
         # fact that the lists of indices of occurrences are sorted.
@@ -79,6 +123,10 @@ class NYUSchedule:
         Yields the indices that correspond to values in self.header_row that
         are equal to from_node.
         '''
+        header_index = self.__dict__.get("_header_index")
+        if header_index is not None:
+            yield from header_index.get(from_node, ())
+            return
         for i, v in enumerate(self.header_row):
             if v == from_node:
                 yield i
@@ -1,3 +1,5 @@
 #!/usr/bin/env python3
-from common import file_in_this_dir
-WALKING_TIMES_PICKLE = file_in_this_dir("WalkingStatic.pickle")
+from common import data_file
+WALKING_TIMES_PICKLE = data_file("WalkingStatic.pickle")
+# The same walking times in the format of network_file
+WALKING_TIMES_NETWORK = data_file("WalkingStatic.network")
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+'''
+This module lets long-running processes pick up rebuilt schedules and walking
+times without restarting.
+
+Each kind of data that the agencies read, e.g. the NYU bus schedules, is a
+Data object. Agencies never keep the data themselves; they call current() on
+the Data object, which returns the current Snapshot. A Snapshot never changes.
+When the files change, reload() builds the next Snapshot, including its
+indexes, without blocking queries and then swaps it in at once.
+
+A query that runs inside pinned() sees the same Snapshot of each kind of data
+from the first time that it uses the data until it finishes, even if a new
+Snapshot is swapped in meanwhile. Queries that start after the swap see the
+new Snapshot. pinned() must not be active while a generator is suspended,
+because the pin belongs to the thread and would also apply to whatever the
+consumer does in between. Generators use pinned_iterator instead, which pins
+their Snapshots only while they compute each value.
+'''
+import attr, contextlib, itertools, os, sys, threading, time, weakref
+_pins = threading.local()
+_versions = itertools.count(1)
+datasets = []
+# Functions that are called with the Data object after it is reloaded, e.g. to
+# clear caches of results that were computed from the old Snapshot. A listener
+# may also be a weak reference, such as a weakref.WeakMethod, to a function;
+# it is removed once the function is gone.
+reload_listeners = []
+
+@attr.s(frozen=True)
+class Snapshot:
+    # The data that the load function returned
+    data = attr.ib()
+    # For each file that the data was loaded from, a (path, modification
+    # time, size) tuple, or (path, None, None) if it did not exist
+    signature = attr.ib()
+    # A number that is greater for newer snapshots
+    version = attr.ib()
+
+def file_signature(paths):
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            signature.append((path, None, None))
+        else:
+            signature.append((path, stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+class Data:
+    '''
+    One kind of data that the agencies use. It is loaded on first use.
+    '''
+    def __init__(self, name, paths, load):
+        '''
+        Arguments:
+            name:
+                a human-readable name of the data
+            paths:
+                the files that the data is loaded from; if one of them
+                changes, reload_if_changed reloads the data
+            load:
+                a function that takes no arguments and returns the data,
+                which must not be changed afterwards
+        '''
+        self.name = name
+        self.paths = tuple(paths)
+        self._load = load
+        self._snapshot = None
+        # This lock is held while a snapshot is built so that the data is
+        # never loaded twice at the same time.
+        self._lock = threading.Lock()
+        datasets.append(self)
+    def _build(self):
+        signature = file_signature(self.paths)
+        return Snapshot(self._load(), signature, next(_versions))
+    def current(self):
+        '''
+        Returns the current Snapshot. Inside pinned(), the Snapshot that this
+        thread used first is returned.
+        '''
+        pins = getattr(_pins, "snapshots", None)
+        if pins is not None:
+            try:
+                return pins[self]
+            except KeyError:
+                pass
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._snapshot = self._build()
+                snapshot = self._snapshot
+        if pins is not None:
+            pins[self] = snapshot
+        return snapshot
+    def signature(self):
+        '''
+        Returns the signature of the current Snapshot without loading it. If
+        it has not been loaded, the signature of the files is returned.
+        '''
+        pins = getattr(_pins, "snapshots", None)
+        snapshot = None if pins is None else pins.get(self)
+        if snapshot is None:
+            snapshot = self._snapshot
+        if snapshot is None:
+            return file_signature(self.paths)
+        return snapshot.signature
+    def loaded(self):
+        '''
+        Returns True if a Snapshot has been loaded.
+        '''
+        return self._snapshot is not None
+    def reload(self):
+        '''
+        Builds a new Snapshot and swaps it in. Queries that are running keep
+        the Snapshot that they have. If the data cannot be loaded, the
+        exception is raised, and the current Snapshot is kept.
+        '''
+        with self._lock:
+            self._snapshot = self._build()
+        for listener in list(reload_listeners):
+            if isinstance(listener, weakref.ref):
+                function = listener()
+                if function is None:
+                    try:
+                        reload_listeners.remove(listener)
+                    except ValueError:
+                        pass
+                    continue
+                function(self)
+            else:
+                listener(self)
+    def reload_if_changed(self):
+        '''
+        Reloads the data if it has been loaded and one of its files has
+        changed since then. Returns True if the data was reloaded.
+        '''
+        snapshot = self._snapshot
+        if snapshot is None or \
+            file_signature(self.paths) == snapshot.signature:
+            return False
+        self.reload()
+        return True
+def signatures():
+    '''
+    Returns a tuple of the signature of every Data object: the signature of
+    the current Snapshot if it has been loaded, or else of its files as they
+    are now, which is what would be loaded. Results that were computed from
+    the data can be cached under this tuple, even by other processes.
+    '''
+    return tuple(data.signature() for data in datasets)
+def reload_all_if_changed():
+    '''
+    Calls reload_if_changed on every Data object. Errors are printed, and the
+    data that could not be reloaded keeps its current Snapshot. Returns a list
+    of the Data objects that were reloaded.
+    '''
+    reloaded = []
+    for data in datasets:
+        try:
+            if data.reload_if_changed():
+                reloaded.append(data)
+        except Exception as e:
+            print("Cannot reload ", data.name, ": ", e, sep="", file=sys.stderr)
+    return reloaded
+def watch(interval_seconds=10.0):
+    '''
+    Starts a daemon thread that checks the files of every Data object every
+    interval_seconds and reloads the data whose files changed. Returns the
+    thread.
+    '''
+    def run():
+        while True:
+            time.sleep(interval_seconds)
+            reload_all_if_changed()
+    thread = threading.Thread(
+        target=run,
+        name="data_snapshot.watch",
+        daemon=True
+    )
+    thread.start()
+    return thread
+@contextlib.contextmanager
+def pinned():
+    '''
+    While this context manager is active, the current thread keeps the
+    Snapshots that it uses. It can also be used as a function decorator.
+    Nesting it has no further effect.
+    '''
+    if getattr(_pins, "snapshots", None) is not None:
+        yield
+        return
+    _pins.snapshots = {}
+    try:
+        yield
+    finally:
+        _pins.snapshots = None
+class Pins:
+    '''
+    The Snapshots that one query uses, which can be pinned on a thread several
+    times, e.g. once for each value that a generator computes
+    '''
+    def __init__(self):
+        self.snapshots = {}
+    @contextlib.contextmanager
+    def active(self):
+        '''
+        While this context manager is active, the current thread uses these
+        Snapshots and adds the Snapshots that it uses first to them. If the
+        thread is already inside pinned(), the Snapshots that it pinned are
+        shared.
+        '''
+        outer = getattr(_pins, "snapshots", None)
+        if outer is not None:
+            for data, snapshot in outer.items():
+                self.snapshots.setdefault(data, snapshot)
+        _pins.snapshots = self.snapshots
+        try:
+            yield
+        finally:
+            _pins.snapshots = outer
+            if outer is not None:
+                for data, snapshot in self.snapshots.items():
+                    outer.setdefault(data, snapshot)
+def pinned_iterator(iterator, pins=None):
+    '''
+    Yields the values of the iterator. Each value is computed inside
+    pins.active(), so the whole iteration uses the same Snapshots, but nothing
+    is pinned while the consumer handles a value.
+
+    Arguments:
+        pins:
+            the Pins object to use, or None to use a new one
+    '''
+    if pins is None:
+        pins = Pins()
+    while True:
+        with pins.active():
+            try:
+                value = next(iterator)
+            except StopIteration:
+                return
+        yield value
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+'''
+This module matches what the user typed as the origin or destination to a
+known place without asking any API. The known places are the bus stops in
+"Stop Locations.csv" and the buildings in "Building Locations.csv".
+
+Names are normalized before they are compared: they are split into words,
+abbreviations are expanded like they are in the timetables, and case is
+ignored. resolve only returns a place whose name or an alias equals the name
+after both are normalized, because a query for another place than the user
+meant would be answered for the wrong place. suggest also returns places that
+match by these rules, for the user to choose from:
+    1. Every word of the name is a word of a place, except that the last word
+       only needs to be the beginning of a word. This allows partially typed
+       names.
+    2. The name shares enough trigrams (sequences of three characters) with a
+       place. This allows small typos.
+Words with digits, such as house numbers, must always match whole words,
+because "725 Broadway" is not near "721 Broadway". If several places match,
+places with fewer words and then bus stops are preferred.
+'''
+import attr, bisect, collections, csv, re
+from common import Point, file_in_this_dir
+from common_nyu import ABBREVIATION_EXPANSION
+import stops
+BUILDING_LOCATIONS_CSV = file_in_this_dir("Building Locations.csv")
+WORD = re.compile(r"&|\w+")
+# Two names are similar enough if the number of trigrams that they share
+# divided by the number of distinct trigrams in both of them is at least this.
+TRIGRAM_THRESHOLD = 0.6
+_expansion = {
+    k.casefold(): v.casefold() for k, v in ABBREVIATION_EXPANSION.items()
+}
+
+@attr.s(frozen=True)
+class Place:
+    # The name under which the place is known, e.g. the name of the bus stop
+    name = attr.ib(converter=str)
+    point = attr.ib(validator=attr.validators.instance_of(Point))
+    # True if this place is a bus stop
+    stop = attr.ib(default=False, validator=attr.validators.instance_of(bool))
+
+def normalize(text):
+    '''
+    Returns a tuple of the normalized words in the text.
+    '''
+    return tuple(
+        _expansion.get(w, w) for w in WORD.findall(text.casefold())
+    )
+def trigrams(words):
+    s = " " + " ".join(words) + " "
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+class Gazetteer:
+    '''
+    An index of places by their normalized names and aliases.
+    '''
+    def __init__(self):
+        self._places = []
+        self._words = []
+        self._exact = {}
+        self._by_word = collections.defaultdict(set)
+        self._by_trigram = collections.defaultdict(set)
+        self._vocabulary = []
+    def add(self, place, aliases=()):
+        '''
+        Adds a place under its name and under every alias.
+        '''
+        for name in (place.name,) + tuple(aliases):
+            words = normalize(name)
+            if not words:
+                continue
+            i = len(self._places)
+            self._places.append(place)
+            self._words.append(words)
+            self._exact.setdefault(words, []).append(i)
+            for w in words:
+                if w not in self._by_word:
+                    bisect.insort(self._vocabulary, w)
+                self._by_word[w].add(i)
+            for t in trigrams(words):
+                self._by_trigram[t].add(i)
+    def _best(self, indices):
+        '''
+        Returns the preferred place among the given indices.
+        '''
+        if not indices:
+            return None
+        return self._places[
+            min(
+                indices,
+                key=lambda i: (
+                    len(self._words[i]),
+                    not self._places[i].stop,
+                    self._places[i].name
+                )
+            )
+        ]
+    def _words_with_prefix(self, prefix):
+        start = bisect.bisect_left(self._vocabulary, prefix)
+        for w in self._vocabulary[start:]:
+            if not w.startswith(prefix):
+                break
+            yield w
+    def _ranked(self, indices):
+        '''
+        Returns the distinct places among the given indices, preferred first.
+        '''
+        places = []
+        for i in sorted(
+            indices,
+            key=lambda i: (
+                len(self._words[i]),
+                not self._places[i].stop,
+                self._places[i].name
+            )
+        ):
+            if self._places[i] not in places:
+                places.append(self._places[i])
+        return places
+    def resolve(self, text):
+        '''
+        Returns the Place whose name or alias equals the text after both are
+        normalized, or None if there is none.
+        '''
+        return self._best(self._exact.get(normalize(text)))
+    def suggest(self, text, max_count=5):
+        '''
+        Returns a list of at most max_count Places that the text might refer
+        to, best first. The Place that resolve returns is first.
+        '''
+        words = normalize(text)
+        if not words:
+            return []
+        # Words with digits must be whole words of every suggestion.
+        numbers = [w for w in words if any(c.isdigit() for c in w)]
+        allowed = None
+        for w in numbers:
+            matches = self._by_word.get(w, set())
+            allowed = matches if allowed is None else allowed & matches
+        if allowed is not None and not allowed:
+            return []
+        suggestions = self._ranked(self._exact.get(words, ()))
+        # Every word matches, and the last word may be a prefix.
+        candidates = allowed
+        for w in words[:-1]:
+            matches = self._by_word.get(w, set())
+            candidates = \
+                matches if candidates is None else candidates & matches
+        if words[-1] in numbers:
+            last = self._by_word.get(words[-1], set())
+        else:
+            last = set()
+            for w in self._words_with_prefix(words[-1]):
+                last |= self._by_word[w]
+        candidates = last if candidates is None else candidates & last
+        suggestions.extend(
+            p for p in self._ranked(candidates) if p not in suggestions
+        )
+        # Trigram similarity of the other words
+        query = trigrams(w for w in words if w not in numbers)
+        shared = collections.Counter()
+        for t in query:
+            for i in self._by_trigram.get(t, ()):
+                if allowed is None or i in allowed:
+                    shared[i] += 1
+        scores = {}
+        for i, count in shared.items():
+            score = count / (
+                len(query) +
+                len(trigrams(w for w in self._words[i] if w not in numbers)) -
+                count
+            )
+            if score >= TRIGRAM_THRESHOLD:
+                scores[i] = score
+        suggestions.extend(
+            p for p in self._ranked(
+                sorted(scores, key=scores.get, reverse=True)
+            ) if p not in suggestions
+        )
+        return suggestions[:max_count]
+    @classmethod
+    def load(cls, name_to_point, buildings_csv=BUILDING_LOCATIONS_CSV):
+        '''
+        Creates a Gazetteer of the given bus stops and of the buildings in the
+        given CSV file. The file has the columns Name, Aliases, Latitude and
+        Longitude; aliases are separated by semicolons. If the file does not
+        exist, only the bus stops are included.
+        '''
+        gazetteer = cls()
+        for name, point in name_to_point.items():
+            gazetteer.add(Place(name, point, True))
+        try:
+            with open(buildings_csv, "r", newline="", encoding="UTF-8") as f:
+                for row in csv.DictReader(f):
+                    gazetteer.add(
+                        Place(
+                            row["Name"],
+                            Point(row["Latitude"], row["Longitude"])
+                        ),
+                        [a for a in row["Aliases"].split(";") if a.strip()]
+                    )
+        except FileNotFoundError:
+            pass
+        return gazetteer
+
+_gazetteer = None
+
+def get_gazetteer():
+    '''
+    Returns a Gazetteer of all bus stops and buildings. It is created on first
+    use.
+    '''
+    global _gazetteer
+    if _gazetteer is None:
+        _gazetteer = Gazetteer.load(stops.name_to_point)
+    return _gazetteer
+def resolve(text):
+    '''
+    Returns the Place that the text refers to, or None.
+    '''
+    return get_gazetteer().resolve(text)
+def suggest(text, max_count=5):
+    '''
+    Returns a list of at most max_count Places that the text might refer to.
+    '''
+    return get_gazetteer().suggest(text, max_count)
+def canonical_name(text):
+    '''
+    Returns the name of the place whose name or alias the text is. Otherwise,
+    the text is returned unchanged.
+    '''
+    # Bus stops are looked up first so that the buildings are only read when
+    # they are needed.
+    if text in stops.name_to_point:
+        return text
+    place = resolve(text)
+    return text if place is None else place.name
+
+if __name__ == "__main__":
+    import sys
+    for text in sys.argv[1:]:
+        print(repr(text), "->", resolve(text))
+        for place in suggest(text):
+            print("    Did you mean {!r}?".format(place.name))
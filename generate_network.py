@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+'''
+Generates made-up bus networks of any size, so that the itinerary finder can
+be measured on much more data than NYU has, e.g. before more campuses are
+added. The files are the same as those that pickle_nyu, match_stops_locations
+and pickle_walking_static write:
+    NYU.pickle and NYU.network:
+        the schedules, as lists of common_nyu.NYUSchedule objects
+    WalkingStatic.pickle and WalkingStatic.network:
+        the walking times between the bus stops
+    Stop Locations.csv and Node List.txt:
+        the bus stops
+Use them by setting NYU_DATA_DIRECTORY (see common.py) to the directory, e.g.
+with benchmark_suite.py --data DIRECTORY. benchmark_scaling runs the
+benchmarks on networks of several sizes.
+
+The stops are on a jittered square grid that grows with the number of stops,
+so that the stops are as dense as in a city. Every route is a random walk over
+neighbouring stops and starts at a stop that no route serves yet, if there is
+one. Routes follow one of these patterns:
+    loop:
+        the route returns to its first stop, which is in the header row
+        twice
+    out_and_back:
+        the route returns the way it came, so every stop but the last is in
+        the header row twice
+    one_way:
+        the route ends at its last stop
+On weekdays, every route runs trips_per_day trips between FIRST_TRIP and
+LAST_TRIP, which is after midnight. On weekends, every route runs half as
+many. Walking times are only generated between stops that are at most
+walking_radius meters apart, so that the number of walks grows linearly with
+the number of stops. A dense matrix of walking times is written to
+WalkingStatic.network only if there are at most MAX_NETWORK_WALKING_STOPS
+stops, because its size grows with the square of the number of stops; above
+that, only the pickle is written.
+
+The same arguments always generate the same network.
+
+Usage: generate_network.py DIRECTORY [--scale N] [--routes N] [--stops N]
+                           [--stops-per-route N] [--trips-per-day N]
+                           [--pattern NAME]... [--walking-radius METERS]
+                           [--seed N]
+'''
+import argparse, csv, datetime, math, os, pickle, random
+import attr
+from common import NODE_LIST_TXT, STOP_LOCATIONS_CSV, Point
+from common_nyu import NYU_NETWORK, NYU_PICKLE, NYUSchedule, NYUTime
+from common_walking_static import WALKING_TIMES_NETWORK, WALKING_TIMES_PICKLE
+import network_file, walking_estimator
+# The size of a network of scale 1, which is about as large as the NYU bus
+# system. Larger scales have proportionally more routes and stops.
+REFERENCE_ROUTES = 8
+REFERENCE_STOPS = 60
+DEFAULT_STOPS_PER_ROUTE = 10
+DEFAULT_TRIPS_PER_DAY = 40
+PATTERNS = ("loop", "out_and_back", "one_way")
+DEFAULT_WALKING_RADIUS = 1600.0
+DEFAULT_SEED = 20190415
+# The grid of stops starts here and extends north and east.
+ORIGIN = Point(lat=40.69, lng=-74.01)
+STOP_SPACING_METERS = 400.0
+# Every stop is moved by up to this fraction of the spacing in each direction.
+STOP_JITTER = 0.3
+# Buses take this long to travel a meter and stop for DWELL at every stop.
+# Times in the schedules are rounded up to whole minutes.
+BUS_SECONDS_PER_METER = 1.0 / 6.0
+DWELL = datetime.timedelta(seconds=30)
+FIRST_TRIP = datetime.timedelta(hours=7)
+LAST_TRIP = datetime.timedelta(hours=25)
+# This fraction of the stops are soft, i.e. riders must signal the driver.
+SOFT_FRACTION = 0.1
+WEEKDAYS = range(0, 5)
+WEEKEND = (5, 6)
+MAX_NETWORK_WALKING_STOPS = 5000
+
+@attr.s
+class NetworkSize:
+    routes = attr.ib(validator=attr.validators.instance_of(int))
+    stops = attr.ib(validator=attr.validators.instance_of(int))
+    stops_per_route = attr.ib(
+        default=DEFAULT_STOPS_PER_ROUTE,
+        validator=attr.validators.instance_of(int)
+    )
+    trips_per_day = attr.ib(
+        default=DEFAULT_TRIPS_PER_DAY,
+        validator=attr.validators.instance_of(int)
+    )
+    # The routes follow these patterns in turn.
+    patterns = attr.ib(default=PATTERNS, converter=tuple)
+    # None generates walking times between every pair of stops.
+    walking_radius = attr.ib(default=DEFAULT_WALKING_RADIUS)
+    seed = attr.ib(default=DEFAULT_SEED)
+    @patterns.validator
+    def _check_patterns(self, attribute, value):
+        if not value or any(p not in PATTERNS for p in value):
+            raise ValueError(
+                "The patterns must be some of " + ", ".join(PATTERNS) + "."
+            )
+    def __attrs_post_init__(self):
+        if self.stops < 2 or self.stops_per_route < 2:
+            raise ValueError(
+                "There must be at least two stops and two stops per route."
+            )
+        if self.routes < 1 or self.trips_per_day < 1:
+            raise ValueError(
+                "There must be at least one route and one trip per day."
+            )
+    @classmethod
+    def scaled(cls, scale, **kwargs):
+        '''
+        Returns the size of a network with scale times as many routes and
+        stops as a network of scale 1. The other arguments are passed to the
+        constructor.
+        '''
+        return cls(
+            routes=max(1, round(REFERENCE_ROUTES * scale)),
+            stops=max(2, round(REFERENCE_STOPS * scale)),
+            **kwargs
+        )
+@attr.s
+class Network:
+    # A dictionary from the names of the stops to Point objects
+    name_to_point = attr.ib()
+    # A list of the NYUSchedule objects on each day of the week
+    schedule_by_day = attr.ib()
+    # A dictionary from (from, to) tuples to (seconds, filename) tuples, like
+    # the one that pickle_walking_static pickles
+    walking_times = attr.ib()
+    def counts(self):
+        '''
+        Returns a dictionary of the numbers of things in the network.
+        '''
+        schedules = {id(s): s for day in self.schedule_by_day for s in day}
+        return {
+            "stops": len(self.name_to_point),
+            "routes": len({s.route for s in schedules.values()}),
+            "schedules": len(schedules),
+            "trips": sum(len(s.other_rows) for s in schedules.values()),
+            "cells": sum(
+                len(s.header_row) * len(s.other_rows)
+                for s in schedules.values()
+            ),
+            "walks": len(self.walking_times)
+        }
+
+def offset_point(point, north_meters, east_meters):
+    '''
+    Returns the Point that is the given distances from point.
+    '''
+    lat = point.lat + north_meters / walking_estimator.METERS_PER_DEGREE
+    return Point(
+        lat=lat,
+        lng=point.lng + east_meters / (
+            walking_estimator.METERS_PER_DEGREE * math.cos(math.radians(lat))
+        )
+    )
+def place_stops(size, r):
+    '''
+    Returns a dictionary from the names of the stops to Point objects and a
+    dictionary from the names to their (row, column) cells in the grid.
+    '''
+    side = math.ceil(math.sqrt(size.stops))
+    width = len(str(size.stops - 1))
+    name_to_point = {}
+    name_to_cell = {}
+    for i in range(size.stops):
+        row, column = divmod(i, side)
+        name = "Stop {:0{}d}".format(i, width)
+        name_to_point[name] = offset_point(
+            ORIGIN,
+            (row + r.uniform(-STOP_JITTER, STOP_JITTER)) *
+                STOP_SPACING_METERS,
+            (column + r.uniform(-STOP_JITTER, STOP_JITTER)) *
+                STOP_SPACING_METERS
+        )
+        name_to_cell[name] = (row, column)
+    return name_to_point, name_to_cell
+def route_paths(size, name_to_cell, r):
+    '''
+    Yields a list of the names of the stops that each route passes, in order,
+    without the stops that the pattern adds to the end.
+    '''
+    cell_to_name = {cell: name for name, cell in name_to_cell.items()}
+    names = list(name_to_cell)
+    unserved = names[:]
+    r.shuffle(unserved)
+    served = set()
+    for i in range(size.routes):
+        while unserved and unserved[-1] in served:
+            unserved.pop()
+        path = [unserved.pop() if unserved else r.choice(names)]
+        visited = {path[0]}
+        while len(path) < size.stops_per_route:
+            row, column = name_to_cell[path[-1]]
+            neighbours = [
+                cell_to_name[row + d_row, column + d_column]
+                for d_row in (-1, 0, 1)
+                for d_column in (-1, 0, 1)
+                if (row + d_row, column + d_column) in cell_to_name and
+                    cell_to_name[row + d_row, column + d_column] not in visited
+            ]
+            if not neighbours:
+                # The walk is stuck in a corner, so the route is shorter.
+                break
+            path.append(r.choice(neighbours))
+            visited.add(path[-1])
+        served.update(path)
+        yield path
+def header_row(path, pattern):
+    if len(path) < 2 or pattern == "one_way":
+        return list(path)
+    if pattern == "loop":
+        return path + path[:1]
+    return path + path[-2::-1]
+def schedule(route, header, name_to_point, trips, days_of_week, r):
+    '''
+    Returns an NYUSchedule with the given number of trips.
+    '''
+    # The number of minutes from each stop to the next
+    legs = []
+    for from_name, to_name in zip(header, header[1:]):
+        seconds = walking_estimator.haversine_meters(
+            name_to_point[from_name],
+            name_to_point[to_name]
+        ) * BUS_SECONDS_PER_METER + DWELL.total_seconds()
+        legs.append(datetime.timedelta(minutes=math.ceil(seconds / 60.0)))
+    soft = [r.random() < SOFT_FRACTION for name in header]
+    headway = (LAST_TRIP - FIRST_TRIP) / trips
+    first = FIRST_TRIP + datetime.timedelta(
+        minutes=r.randrange(max(1, math.floor(headway.total_seconds() / 60.0)))
+    )
+    other_rows = []
+    for trip in range(trips):
+        time = first + datetime.timedelta(
+            minutes=math.floor(trip * headway.total_seconds() / 60.0)
+        )
+        row = []
+        for column, name in enumerate(header):
+            if column:
+                time += legs[column - 1]
+            # Riders cannot board at the end of the route.
+            row.append(
+                NYUTime(time, column < len(header) - 1, soft[column])
+            )
+        other_rows.append(row)
+    return NYUSchedule(route, list(header), other_rows, days_of_week)
+def walking_times(size, name_to_point, name_to_cell):
+    '''
+    Returns a dictionary from (from, to) tuples to (seconds, filename) tuples
+    for the stops that are at most size.walking_radius meters apart. The
+    filenames are None because there are no API responses.
+    '''
+    if size.walking_radius is None:
+        def candidates(name):
+            return name_to_point
+    else:
+        # Only the stops in nearby cells of the grid can be close enough.
+        reach = math.ceil(
+            size.walking_radius / STOP_SPACING_METERS + 2 * STOP_JITTER
+        )
+        cell_to_name = {cell: name for name, cell in name_to_cell.items()}
+        def candidates(name):
+            row, column = name_to_cell[name]
+            for d_row in range(-reach, reach + 1):
+                for d_column in range(-reach, reach + 1):
+                    other = cell_to_name.get((row + d_row, column + d_column))
+                    if other is not None:
+                        yield other
+    result = {}
+    for from_name, from_point in name_to_point.items():
+        for to_name in candidates(from_name):
+            if to_name == from_name:
+                continue
+            meters = walking_estimator.haversine_meters(
+                from_point,
+                name_to_point[to_name]
+            )
+            if size.walking_radius is None or meters <= size.walking_radius:
+                seconds = meters * walking_estimator.DEFAULT_SECONDS_PER_METER
+                result[(from_name, to_name)] = (round(seconds), None)
+    return result
+def generate(size):
+    '''
+    Returns a Network of the given NetworkSize.
+    '''
+    r = random.Random(size.seed)
+    name_to_point, name_to_cell = place_stops(size, r)
+    schedule_by_day = [[] for day in range(7)]
+    route_width = len(str(size.routes - 1))
+    for i, path in enumerate(route_paths(size, name_to_cell, r)):
+        route = "R{:0{}d}".format(i, route_width)
+        header = header_row(path, size.patterns[i % len(size.patterns)])
+        for trips, days_of_week in (
+            (size.trips_per_day, WEEKDAYS),
+            (size.trips_per_day // 2, WEEKEND)
+        ):
+            if trips:
+                s = schedule(
+                    route,
+                    header,
+                    name_to_point,
+                    trips,
+                    days_of_week,
+                    r
+                )
+                for day in days_of_week:
+                    schedule_by_day[day].append(s)
+    return Network(
+        name_to_point,
+        schedule_by_day,
+        walking_times(size, name_to_point, name_to_cell)
+    )
+def write(directory, network):
+    '''
+    Writes the files of a Network to a directory, which is created if it does
+    not exist.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    def path(data_path):
+        return os.path.join(directory, os.path.basename(data_path))
+    with open(path(STOP_LOCATIONS_CSV), "w", newline="", encoding="UTF-8") \
+        as f:
+        writer = csv.writer(f)
+        writer.writerow(
+            ("From PDFs", "From API", "Score", "Latitude", "Longitude")
+        )
+        for name, point in network.name_to_point.items():
+            writer.writerow((name, name, 0, point.lat, point.lng))
+    with open(path(NODE_LIST_TXT), "w", encoding="UTF-8") as f:
+        for name in sorted(network.name_to_point):
+            print(name, file=f)
+    with open(path(NYU_PICKLE), "wb") as f:
+        pickle.dump(network.schedule_by_day, f)
+    network_file.write_nyu(path(NYU_NETWORK), network.schedule_by_day)
+    with open(path(WALKING_TIMES_PICKLE), "wb") as f:
+        pickle.dump(network.walking_times, f)
+    if len(network.name_to_point) <= MAX_NETWORK_WALKING_STOPS:
+        network_file.write_walking(
+            path(WALKING_TIMES_NETWORK),
+            network.walking_times
+        )
+    else:
+        # An old network file would be used instead of the pickle.
+        try:
+            os.remove(path(WALKING_TIMES_NETWORK))
+        except FileNotFoundError:
+            pass
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description="Generates a made-up bus network for benchmarks."
+    )
+    arg_parser.add_argument(
+        "directory",
+        help="the directory to write the data files to"
+    )
+    arg_parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help=
+            "the number of routes and stops as a multiple of those of a "
+            "network about as large as NYU's (default: 1)"
+    )
+    arg_parser.add_argument(
+        "--routes",
+        type=int,
+        help="the number of routes (default: depends on --scale)"
+    )
+    arg_parser.add_argument(
+        "--stops",
+        type=int,
+        help="the number of stops (default: depends on --scale)"
+    )
+    arg_parser.add_argument(
+        "--stops-per-route",
+        type=int,
+        default=DEFAULT_STOPS_PER_ROUTE,
+        metavar="N",
+        help="the number of stops on each route"
+    )
+    arg_parser.add_argument(
+        "--trips-per-day",
+        type=int,
+        default=DEFAULT_TRIPS_PER_DAY,
+        metavar="N",
+        help="the number of trips of each route on weekdays"
+    )
+    arg_parser.add_argument(
+        "--pattern",
+        action="append",
+        choices=PATTERNS,
+        help=
+            "a pattern of routes; the routes follow the patterns in turn; may "
+            "be given more than once (default: all of them)"
+    )
+    arg_parser.add_argument(
+        "--walking-radius",
+        type=float,
+        default=DEFAULT_WALKING_RADIUS,
+        metavar="METERS",
+        help=
+            "the greatest distance between stops with walking times; 0 for "
+            "every pair of stops"
+    )
+    arg_parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    args = arg_parser.parse_args()
+    if args.scale <= 0.0:
+        arg_parser.error("--scale must be greater than 0")
+    try:
+        size = NetworkSize.scaled(
+            args.scale,
+            stops_per_route=args.stops_per_route,
+            trips_per_day=args.trips_per_day,
+            patterns=args.pattern or PATTERNS,
+            walking_radius=args.walking_radius or None,
+            seed=args.seed
+        )
+        size = attr.evolve(
+            size,
+            routes=size.routes if args.routes is None else args.routes,
+            stops=size.stops if args.stops is None else args.stops
+        )
+    except ValueError as e:
+        arg_parser.error(str(e))
+    network = generate(size)
+    write(args.directory, network)
+    for name, n in network.counts().items():
+        print("{:<10} {:>12}".format(name.capitalize(), n))
+
+if __name__ == "__main__":
+    main()
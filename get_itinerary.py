@@ -1,11 +1,37 @@
 #!/usr/bin/env python3
-import argparse, datetime, dateutil.parser, warnings
+import argparse, datetime, importlib.util, sys, warnings
 import agency_common, agency_nyu, agency_walking_static, \
-    agency_walking_dynamic, departure_lister, itinerary_finder
+    agency_walking_dynamic, departure_lister, gazetteer, itinerary_finder, \
+    metrics, search_stats
 TIME_FORMAT = "%I:%M %p on %A"
+AGENCIES = (
+    agency_nyu.AgencyNYU,
+    agency_walking_static.AgencyWalkingStatic,
+    agency_walking_dynamic.AgencyWalkingDynamic,
+)
+AGENCIES_TO_VARY = (
+    agency_nyu.AgencyNYU,
+)
 
-def parse_args(agencies=()):
-    arg_parser = argparse.ArgumentParser(
+def parse_args(
+    agencies=(),
+    args=None,
+    arg_parser_class=argparse.ArgumentParser
+):
+    '''
+    Parses and checks the command line arguments and passes them to the
+    agencies.
+
+    Arguments:
+        agencies:
+            the agencies that may add their own arguments
+        args:
+            a list of the arguments, or None to use sys.argv
+        arg_parser_class:
+            argparse.ArgumentParser or a subclass of it; override its error
+            method to handle invalid arguments without exiting
+    '''
+    arg_parser = arg_parser_class(
         description=
             "Given an origin, a destination, an arrival or departure time, "
             "and optional restrictions (see below), returns directions on how "
@@ -60,11 +86,79 @@ def parse_args(agencies=()):
             "causes N different itineraries to be printed instead of just the "
             "one that is the most optimal"
     )
+    arg_parser.add_argument(
+        "--batch",
+        metavar="FILE",
+        help=
+            "instead of answering one query, reads queries as JSON lines "
+            "from FILE (- for standard input) and writes the answers as JSON "
+            "lines; see batch_queries.py"
+    )
+    arg_parser.add_argument(
+        "--processes",
+        type=int,
+        metavar="N",
+        help=
+            "(only with --batch) the number of worker processes (default: "
+            "the number of CPUs)"
+    )
+    arg_parser.add_argument(
+        "--unordered",
+        action="store_true",
+        help=
+            "(only with --batch) write the answers as soon as they are ready "
+            "instead of in the order of the queries"
+    )
+    arg_parser.add_argument(
+        "--format",
+        choices=("text", "json", "jsonl", "msgpack"),
+        default="text",
+        help=
+            "the output format: text for people, or json, jsonl (one "
+            "itinerary or departure per line) or msgpack (one MessagePack "
+            "object per itinerary or departure) for programs; see "
+            "itinerary_json.py"
+    )
+    arg_parser.add_argument(
+        "--stats",
+        action="store_true",
+        help=
+            "prints statistics about the search, such as the number of nodes "
+            "settled and the time spent by each agency, to standard error; "
+            "see search_stats.py"
+    )
+    arg_parser.add_argument(
+        "--trace",
+        action="store_true",
+        help=
+            "prints how long each stage of the query took, such as the "
+            "preparations of the agencies, the Distance Matrix API requests "
+            "and the search, to standard error; see metrics.py"
+    )
+    arg_parser.add_argument(
+        "--cache",
+        metavar="FILE",
+        help=
+            "keeps answers in the SQLite database FILE, which is created if "
+            "it does not exist, so that later runs and other processes that "
+            "ask the same query do not search again; see result_cache.py"
+    )
+    arg_parser.add_argument(
+        "--cache-bucket",
+        type=int,
+        default=0,
+        metavar="seconds",
+        help=
+            "(only with --cache) queries for times in the same bucket of this "
+            "many seconds share answers, which depart no earlier and arrive "
+            "no later than was asked for (default: 0, i.e. only exactly the "
+            "same time)"
+    )
     # Allow agencies to add their own arguments.
     for agency in agencies:
         agency.add_arguments(arg_parser.add_argument)
     # Parse the arguments.
-    args_parsed = arg_parser.parse_args()
+    args_parsed = arg_parser.parse_args(args)
     args_parsed.origin = args_parsed.origin.strip()
     args_parsed.destination = args_parsed.destination.strip()
     # Check that the destination or --list-departures was specified and that
@@ -86,10 +180,14 @@ def parse_args(agencies=()):
     # Check that --number-of-itineraries is at least 1 or that it is 0.
     if args_parsed.number_of_itineraries < 0:
         arg_parser.error("--number-of-itineraries must be 1 or more")
+    if args_parsed.cache_bucket < 0:
+        arg_parser.error("--cache-bucket must be 0 or more")
     # Convert the datetime argument to a datetime.
     if args_parsed.datetime.lower() == "now":
         args_parsed.datetime = datetime.datetime.now()
     else:
+        # dateutil is slow to import, and it is not needed for "now".
+        import dateutil.parser
         try:
             with warnings.catch_warnings():
                 warnings.simplefilter("error")
@@ -104,6 +202,10 @@ def parse_args(agencies=()):
         except dateutil.parser._parser.UnknownTimezoneWarning:
             # Time zones are not currently supported by this software.
             arg_parser.error("time zones are not supported")
+    # MessagePack is optional.
+    if args_parsed.format == "msgpack" and \
+        importlib.util.find_spec("msgpack") is None:
+        arg_parser.error("--format msgpack needs the msgpack package")
     # Pass the parsed arguments to the agencies.
     for agency in agencies:
         agency.handle_parsed_arguments(args_parsed, arg_parser.error)
@@ -137,79 +239,198 @@ def print_weighted_edge(edge, bullet):
             edge.to_node
         )
     )
-def main():
-    agencies = (
-        agency_nyu.AgencyNYU,
-        agency_walking_static.AgencyWalkingStatic,
-        agency_walking_dynamic.AgencyWalkingDynamic,
+def query_context(args_parsed):
+    '''
+    Returns the agency_common.QueryContext of a query whose arguments were
+    parsed by parse_args. If --stats was given, its stats member is a
+    search_stats.SearchStats object.
+    '''
+    stats = None
+    if args_parsed.stats:
+        stats = search_stats.SearchStats()
+    return agency_common.QueryContext(
+        args_parsed.origin,
+        args_parsed.destination,
+        args_parsed,
+        stats
     )
-    agencies_to_vary = (
-        agency_nyu.AgencyNYU,
+def canonical_names(args_parsed):
+    '''
+    Returns the origin and the destination of a query whose arguments were
+    parsed by parse_args. Known places are replaced with their names as they
+    are known to the agencies, e.g. a bus stop whose name was typed in
+    lowercase. Only the gazetteer is used for this, never the network. This
+    reads the locations of the stops and buildings, so it is only done when a
+    query is actually answered, not when it is parsed or taken from a cache.
+    '''
+    return (
+        gazetteer.canonical_name(args_parsed.origin),
+        gazetteer.canonical_name(args_parsed.destination)
+        if args_parsed.destination else args_parsed.destination
     )
-    assert all(issubclass(a, agency_common.Agency) for a in agencies)
-    args_parsed = parse_args(agencies)
+def answers(
+    args_parsed,
+    context,
+    agencies=AGENCIES,
+    agencies_to_vary=AGENCIES_TO_VARY
+):
+    '''
+    Answers a query whose arguments were parsed by parse_args. The origin and
+    the destination must not be the same unless departures were asked for.
+
+    Returns a (kind, results) tuple. If kind is "departures", results is an
+    iterator of WeightedEdge objects. If kind is "itineraries", it is an
+    iterator of itineraries, which are lists of WeightedEdge objects. If kind
+    is "itinerary", it is an iterator of one itinerary, or of none if the
+    itinerary is not possible. If the origin and the destination turn out to
+    be names of the same place, there are no itineraries. The results are
+    found as they are iterated.
+    '''
+    origin, destination = canonical_names(args_parsed)
+    context.origin = origin
+    context.destination = destination
     if args_parsed.list_departures:
-        # The user asked for a list of departures from the origin.
-        print("Departures:")
-        for direction in departure_lister.departure_list(
+        return "departures", departure_lister.departure_list(
             agencies,
-            args_parsed.origin,
+            origin,
             args_parsed.datetime,
-            args_parsed.list_departures
-        ):
-            print_weighted_edge(direction, " -")
-    elif args_parsed.origin != args_parsed.destination:
-        # The user specified a destination.
+            args_parsed.list_departures,
+            context
+        )
+    if origin == destination:
         if args_parsed.number_of_itineraries:
-            # The user wants multiple itineraries.
-            print("Itineraries:")
-            for i, itinerary in enumerate(
-                itinerary_finder.find_itineraries(
-                    agencies_to_vary,
-                    agencies,
-                    args_parsed.origin,
-                    args_parsed.destination,
-                    args_parsed.datetime,
-                    args_parsed.depart,
-                    max_count=args_parsed.number_of_itineraries
-                ),
-                start=1
-            ):
-                print(" - Itinerary #{}:".format(i))
-                for i, direction in enumerate(itinerary, start=1):
-                    print_weighted_edge(direction, "   {:>3}.".format(i))
-                print(
-                    "   Total time:",
-                    itinerary[-1].datetime_arrive - 
-                    itinerary[0].datetime_depart
-                )
+            return "itineraries", iter(())
+        return "itinerary", iter(())
+    if args_parsed.number_of_itineraries:
+        return "itineraries", itinerary_finder.find_itineraries(
+            agencies_to_vary,
+            agencies,
+            origin,
+            destination,
+            args_parsed.datetime,
+            args_parsed.depart,
+            max_count=args_parsed.number_of_itineraries,
+            context=context
+        )
+    def itinerary():
+        try:
+            yield itinerary_finder.find_itinerary(
+                agencies,
+                origin,
+                destination,
+                args_parsed.datetime,
+                args_parsed.depart,
+                context=context
+            )
+        except itinerary_finder.ItineraryNotPossible:
+            pass
+    return "itinerary", itinerary()
+def parse_batch_args():
+    '''
+    Returns the parsed arguments if --batch was given, or None otherwise. In
+    batch mode, the arguments of a single query are not required.
+    '''
+    arg_parser = argparse.ArgumentParser(add_help=False)
+    arg_parser.add_argument("--batch")
+    arg_parser.add_argument("--processes", type=int)
+    arg_parser.add_argument("--unordered", action="store_true")
+    arg_parser.add_argument("--cache")
+    arg_parser.add_argument("--cache-bucket", type=int, default=0)
+    args_parsed, others = arg_parser.parse_known_args()
+    if args_parsed.batch is None:
+        return None
+    if others:
+        arg_parser.error(
+            "--batch cannot be used with these arguments: " +
+            " ".join(others)
+        )
+    if args_parsed.processes is not None and args_parsed.processes < 1:
+        arg_parser.error("--processes must be 1 or more")
+    if args_parsed.cache_bucket < 0:
+        arg_parser.error("--cache-bucket must be 0 or more")
+    return args_parsed
+def main():
+    agencies = AGENCIES
+    agencies_to_vary = AGENCIES_TO_VARY
+    assert all(issubclass(a, agency_common.Agency) for a in agencies)
+    batch_args = parse_batch_args()
+    if batch_args is not None:
+        # batch_queries is only imported when it is needed.
+        import batch_queries
+        batch_queries.main(
+            batch_args.batch,
+            batch_args.processes,
+            not batch_args.unordered,
+            batch_args.cache,
+            batch_args.cache_bucket
+        )
+        return
+    args_parsed = parse_args(agencies)
+    if args_parsed.trace:
+        metrics.add_sink(metrics.LogSink())
+    context = query_context(args_parsed)
+    if args_parsed.origin == args_parsed.destination and \
+        not args_parsed.list_departures:
+        if args_parsed.format == "text":
+            print("The origin and the destination are the same.")
         else:
-            # The user only wants one itinerary.
-            try:
-                itinerary = itinerary_finder.find_itinerary(
-                    agencies,
-                    args_parsed.origin,
-                    args_parsed.destination,
-                    args_parsed.datetime,
-                    args_parsed.depart
-                )
-            except itinerary_finder.ItineraryNotPossible:
-                print(
-                    "This itinerary is not possible either because there is "
-                    "no continuous path from the origin to the destination or "
-                    "because no agency recognized the origin or destination."
-                )
-            else:
-                print("Itinerary:")
-                for i, direction in enumerate(itinerary, start=1):
-                    print_weighted_edge(direction, "{:>3}.".format(i))
-                print(
-                    "Total time:",
-                    itinerary[-1].datetime_arrive - 
-                    itinerary[0].datetime_depart
-                )
+            print(
+                "The origin and the destination are the same.",
+                file=sys.stderr
+            )
+            sys.exit(1)
+        return
+    if args_parsed.cache:
+        # result_cache is only imported when it is needed.
+        import result_cache
+        kind, results = result_cache.DiskCache(
+            args_parsed.cache,
+            bucket_seconds=args_parsed.cache_bucket
+        ).answers(args_parsed, context, agencies, agencies_to_vary)
     else:
-        print("The origin and the destination are the same.")
+        kind, results = \
+            answers(args_parsed, context, agencies, agencies_to_vary)
+    if args_parsed.format != "text":
+        # itinerary_json is only imported when it is needed.
+        import itinerary_json
+        itinerary_json.write(kind, results, args_parsed.format)
+    elif kind == "departures":
+        # The user asked for a list of departures from the origin.
+        print("Departures:")
+        for direction in results:
+            print_weighted_edge(direction, " -")
+    elif kind == "itineraries":
+        # The user wants multiple itineraries.
+        print("Itineraries:")
+        for i, itinerary in enumerate(results, start=1):
+            print(" - Itinerary #{}:".format(i))
+            for i, direction in enumerate(itinerary, start=1):
+                print_weighted_edge(direction, "   {:>3}.".format(i))
+            print(
+                "   Total time:",
+                itinerary[-1].datetime_arrive - 
+                itinerary[0].datetime_depart
+            )
+    else:
+        # The user only wants one itinerary.
+        for itinerary in results:
+            print("Itinerary:")
+            for i, direction in enumerate(itinerary, start=1):
+                print_weighted_edge(direction, "{:>3}.".format(i))
+            print(
+                "Total time:",
+                itinerary[-1].datetime_arrive - 
+                itinerary[0].datetime_depart
+            )
+            break
+        else:
+            print(
+                "This itinerary is not possible either because there is "
+                "no continuous path from the origin to the destination or "
+                "because no agency recognized the origin or destination."
+            )
+    if context.stats is not None:
+        print(context.stats, file=sys.stderr)
 
 if __name__ == "__main__":
     main()
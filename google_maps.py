@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+'''
+This module is a client for the Google Maps Distance Matrix API. See
+https://developers.google.com/maps/documentation/distance-matrix/ for API
+information.
+
+Every call is given a deadline. Retries never wait past the deadline, so a
+slow or broken upstream cannot stall the caller for longer than its budget.
+Repeated failures open a circuit breaker; while it is open, no requests are
+sent at all, and callers are expected to fall back to estimates. Rate
+limiting (HTTP 429) and responses that are not Distance Matrix responses are
+retried like errors of the server.
+
+Every attempt is a span named distance_matrix_request (see metrics). Failed
+attempts and requests that the circuit breaker refused are counted.
+'''
+import atexit, json, multiprocessing.pool, os, threading, time
+import metrics
+
+# Google Distance Matrix base URL to which all other parameters are attached
+MATRIX_API_URL = "https://maps.googleapis.com/maps/api/distancematrix/json?"
+# These are the limits that the Distance Matrix API puts on each request.
+MATRIX_API_MAX_ORIGINS = 25
+MATRIX_API_MAX_DESTINATIONS = 25
+MATRIX_API_MAX_ELEMENTS = 100
+# This is the number of requests that may be in flight at the same time. It is
+# also the number of connections that the session keeps open.
+MATRIX_API_MAX_CONCURRENT_REQUESTS = 8
+# No single attempt may take longer than this many seconds, even if the
+# deadline is further away.
+MATRIX_API_ATTEMPT_TIMEOUT = 10.0
+# The delay before the first retry, in seconds. It doubles after every retry.
+MATRIX_API_INITIAL_RETRY_DELAY = 0.1
+# These statuses mean that the same request might succeed later.
+MATRIX_API_RETRYABLE_STATUSES = {"UNKNOWN_ERROR", "OVER_QUERY_LIMIT"}
+
+class CircuitBreaker:
+    '''
+    This class keeps track of consecutive failures of an upstream service.
+    After failure_threshold consecutive failures, the breaker opens, and
+    allow() returns False for reset_seconds. After that, the breaker is half
+    open: one trial request is allowed. If it succeeds, the breaker closes; if
+    it fails, the breaker opens again.
+
+    This class is thread-safe.
+    '''
+    def __init__(self, failure_threshold=5, reset_seconds=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+    def allow(self):
+        '''
+        Returns True if a request may be sent now.
+        '''
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial_in_flight or \
+                time.monotonic() - self._opened_at < self.reset_seconds:
+                return False
+            # Half open: let exactly one request through.
+            self._trial_in_flight = True
+            return True
+    def is_open(self):
+        '''
+        Returns True if requests are currently being refused.
+        '''
+        with self._lock:
+            return self._opened_at is not None and (
+                self._trial_in_flight or
+                time.monotonic() - self._opened_at < self.reset_seconds
+            )
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or \
+                self._failures >= self.failure_threshold:
+                # Open the breaker, or keep it open for another period.
+                self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+breaker = CircuitBreaker()
+_apikey = None
+_session = None
+_pool = None
+
+def get_apikey():
+    '''
+    Returns the API key, or None if there is none. It is looked up on first
+    use because importing keyring and asking it for a password is slow.
+    '''
+    global _apikey
+    if _apikey is None:
+        try:
+            _apikey = os.environ["GMAPS_DISTANCE_MATRIX_KEY"]
+        except KeyError:
+            try:
+                import keyring, keyring.errors
+            except ImportError:
+                return None
+            try:
+                _apikey = \
+                    keyring.get_password("google_maps", "distance_matrix") or \
+                    keyring.get_password("google_maps", "default")
+            except (keyring.errors.KeyringError, RuntimeError):
+                # There is no keyring backend, or it cannot be unlocked.
+                return None
+    return _apikey
+def get_session():
+    '''
+    Returns a requests.Session that is shared by all requests to the Distance
+    Matrix API so that connections are reused. It is created on first use.
+    '''
+    global _session
+    if _session is None:
+        # requests is slow to import, so it is only imported when the API is
+        # actually used.
+        import requests, requests.adapters
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=MATRIX_API_MAX_CONCURRENT_REQUESTS
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _session = session
+    return _session
+def get_pool():
+    '''
+    Returns the thread pool on which requests to the Distance Matrix API are
+    issued. It is created on first use.
+    '''
+    global _pool
+    if _pool is None:
+        _pool = multiprocessing.pool.ThreadPool(
+            MATRIX_API_MAX_CONCURRENT_REQUESTS
+        )
+        atexit.register(_pool.terminate)
+    return _pool
+def matrix_chunks(origins, destinations):
+    '''
+    Splits the origins and destinations into chunks that each fit in one
+    request to the Distance Matrix API. Yields (origins, destinations) tuples
+    of lists. Every pair of one origin and one destination is in exactly one
+    chunk.
+    '''
+    origins_per_chunk = min(
+        len(origins),
+        MATRIX_API_MAX_ORIGINS,
+        MATRIX_API_MAX_ELEMENTS
+    )
+    if origins_per_chunk == 0:
+        return
+    destinations_per_chunk = min(
+        MATRIX_API_MAX_DESTINATIONS,
+        MATRIX_API_MAX_ELEMENTS // origins_per_chunk
+    )
+    for o in range(0, len(origins), origins_per_chunk):
+        for d in range(0, len(destinations), destinations_per_chunk):
+            yield (
+                origins[o:o + origins_per_chunk],
+                destinations[d:d + destinations_per_chunk]
+            )
+def matrix_api_call(origins, destinations, deadline):
+    '''
+    Sends one request to the Distance Matrix API and returns the decoded
+    response. The origins and destinations must fit in one request; see
+    matrix_chunks.
+
+    Failed attempts are retried with exponential backoff until the deadline,
+    which is a value of time.monotonic(). If the deadline passes, if the error
+    cannot be fixed by a retry, or if the circuit breaker is open, then None is
+    returned.
+    '''
+    if len(origins) > MATRIX_API_MAX_ORIGINS or \
+        len(destinations) > MATRIX_API_MAX_DESTINATIONS or \
+        len(origins) * len(destinations) > MATRIX_API_MAX_ELEMENTS:
+        print("Too many origins/destinations")
+        return None
+    apikey = get_apikey()
+    if apikey is None:
+        # Like an open circuit breaker, this makes the caller estimate.
+        metrics.count("distance_matrix_failures", reason="no_key")
+        return None
+    payload = {
+        'units': 'imperial',
+        # It's most likely that the location is in the US so we give it
+        # precedence.
+        'region': 'us',
+        'origins': '|'.join(origins),
+        'destinations': '|'.join(destinations),
+        'mode': 'walking',
+        'api_key': apikey
+    }
+    current_delay = MATRIX_API_INITIAL_RETRY_DELAY
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0.0:
+            metrics.count("distance_matrix_failures", reason="deadline")
+            return None
+        if not breaker.allow():
+            metrics.count("distance_matrix_failures", reason="breaker_open")
+            return None
+        # True if the API answered, even if only to reject the request. Every
+        # attempt is recorded in the circuit breaker, even one that raised an
+        # unexpected exception, so that the trial request of a half-open
+        # breaker always ends.
+        answered = False
+        try:
+            try:
+                with metrics.span("distance_matrix_request"):
+                    r = get_session().get(
+                        MATRIX_API_URL,
+                        params=payload,
+                        timeout=min(remaining, MATRIX_API_ATTEMPT_TIMEOUT)
+                    )
+                    r.raise_for_status()
+                    matrix = r.json()
+            except (IOError, ValueError) as e:
+                status_code = getattr(
+                    getattr(e, "response", None),
+                    "status_code",
+                    None
+                )
+                if status_code == 429:
+                    # Too many requests. Back off and try again.
+                    metrics.count(
+                        "distance_matrix_failures",
+                        reason="rate_limited"
+                    )
+                elif status_code is not None and status_code < 500:
+                    # The server rejected this request, e.g. because it was
+                    # too long. That says nothing about other requests, so
+                    # the circuit breaker does not count it, and a retry
+                    # would fail in the same way.
+                    answered = True
+                    metrics.count(
+                        "distance_matrix_failures",
+                        reason="rejected"
+                    )
+                    return None
+                else:
+                    # The connection failed, the server returned an HTTP
+                    # error, or the response was not JSON. Try again.
+                    metrics.count("distance_matrix_failures", reason="error")
+            else:
+                status = \
+                    matrix.get('status') if isinstance(matrix, dict) else None
+                if status == 'OK':
+                    answered = True
+                    return matrix
+                # A response without a status is not from the API, e.g. from
+                # a proxy, so it is retried like an HTTP error.
+                metrics.count(
+                    "distance_matrix_failures",
+                    reason=status or "malformed"
+                )
+                if status is not None and \
+                    status not in MATRIX_API_RETRYABLE_STATUSES:
+                    # Many API errors only mean that this request is bad,
+                    # e.g. INVALID_REQUEST or MAX_ELEMENTS_EXCEEDED. The API
+                    # itself answered, so the circuit breaker does not count
+                    # them, and there is no point retrying these requests.
+                    answered = True
+                    print(matrix.get('error_message', status))
+                    return None
+        finally:
+            if answered:
+                breaker.record_success()
+            else:
+                breaker.record_failure()
+        # Wait before retrying, but do not wait past the deadline.
+        if deadline - time.monotonic() <= current_delay:
+            return None
+        time.sleep(current_delay)
+        current_delay *= 2
+def matrix_api_call_chunked(requested, deadline):
+    '''
+    Gets walking distances and durations from the Distance Matrix API. The
+    requested argument is an iterable of (origins, destinations) tuples; the
+    distance from every origin in a tuple to every destination in the same
+    tuple is requested. The pairs are split into chunks that fit in one request
+    each, and all of the chunks are requested concurrently. Each chunk is
+    retried on its own until the deadline, so one failed chunk does not cause
+    the others to be requested again.
+
+    Yields (origin, destination, cell, address) tuples, where cell is the
+    element of the response for that pair and address is the address of the
+    destination according to the API. For pairs in chunks that failed, cell
+    and address are None.
+    '''
+    chunks = [
+        chunk
+        for origins, destinations in requested
+        for chunk in matrix_chunks(origins, destinations)
+    ]
+    for (chunk_origins, chunk_destinations), matrix in zip(
+        chunks,
+        get_pool().imap(
+            lambda chunk: matrix_api_call(chunk[0], chunk[1], deadline),
+            chunks
+        )
+    ):
+        if matrix:
+            for origin, row in zip(chunk_origins, matrix['rows']):
+                for destination, address, cell in zip(
+                    chunk_destinations,
+                    matrix['destination_addresses'],
+                    row['elements']
+                ):
+                    yield origin, destination, cell, address
+        else:
+            for origin in chunk_origins:
+                for destination in chunk_destinations:
+                    yield origin, destination, None, None
+
+if __name__ == "__main__":
+    # Check the client against a fake server on this machine. The server
+    # answers normally, slowly, with errors or with bodies that are not
+    # Distance Matrix responses, depending on its mode.
+    import http.server, urllib.parse
+    class FakeDistanceMatrixHandler(http.server.BaseHTTPRequestHandler):
+        mode = "ok"
+        # The number of requests that are answered with HTTP 429 before the
+        # server answers normally again
+        rate_limited = 0
+        def log_message(self, *args):
+            pass
+        def send_json(self, value):
+            body = json.dumps(value).encode("UTF-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def do_GET(self):
+            query = urllib.parse.parse_qs(
+                urllib.parse.urlparse(self.path).query
+            )
+            if FakeDistanceMatrixHandler.rate_limited > 0:
+                FakeDistanceMatrixHandler.rate_limited -= 1
+                self.send_response(429)
+                self.end_headers()
+                return
+            if self.mode == "slow":
+                time.sleep(5.0)
+            if self.mode == "error":
+                self.send_response(503)
+                self.end_headers()
+                return
+            if self.mode == "bad":
+                self.send_json({"status": "INVALID_REQUEST"})
+                return
+            if self.mode == "malformed":
+                self.send_json(["not", "a", "matrix"])
+                return
+            origins = query["origins"][0].split("|")
+            destinations = query["destinations"][0].split("|")
+            self.send_json({
+                "status": "OK",
+                "origin_addresses": origins,
+                "destination_addresses": destinations,
+                "rows": [
+                    {
+                        "elements": [
+                            {
+                                "status": "OK",
+                                "distance": {"text": "0.1 mi", "value": 161},
+                                "duration": {"value": 120}
+                            }
+                            for _ in destinations
+                        ]
+                    }
+                    for _ in origins
+                ]
+            })
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0),
+        FakeDistanceMatrixHandler
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    MATRIX_API_URL = "http://127.0.0.1:{}/?".format(server.server_port)
+    os.environ.setdefault("GMAPS_DISTANCE_MATRIX_KEY", "test")
+    breaker = CircuitBreaker(failure_threshold=3, reset_seconds=0.5)
+    def call(mode, destination_count=60):
+        '''
+        Requests the walking times from one origin to destination_count
+        destinations from the fake server in the given mode and returns the
+        number of pairs that were answered.
+        '''
+        FakeDistanceMatrixHandler.mode = mode
+        started = time.monotonic()
+        cells = list(
+            matrix_api_call_chunked(
+                [
+                    (
+                        ["Origin"],
+                        ["Stop {}".format(i) for i in range(destination_count)]
+                    )
+                ],
+                time.monotonic() + 2.0
+            )
+        )
+        answered = sum(1 for cell in cells if cell[2] is not None)
+        print(
+            "Mode: {:<9} Answered: {:>2}/{} Breaker open: {!s:<5} "
+            "Seconds: {:.2f}".format(
+                mode,
+                answered,
+                len(cells),
+                breaker.is_open(),
+                time.monotonic() - started
+            )
+        )
+        return answered
+    assert call("ok") == 60 and not breaker.is_open()
+    # Bad requests must not open the circuit breaker.
+    assert call("bad") == 0 and not breaker.is_open()
+    assert call("bad") == 0 and not breaker.is_open()
+    # Rate limiting is retried with backoff.
+    FakeDistanceMatrixHandler.rate_limited = 2
+    assert call("ok", 1) == 1 and not breaker.is_open()
+    # Errors open it, and then no requests are sent.
+    assert call("error") == 0 and breaker.is_open()
+    assert call("ok") == 0 and breaker.is_open()
+    # After reset_seconds, one trial is sent. A malformed body is a failure,
+    # which opens the breaker again instead of leaving the trial in flight.
+    time.sleep(breaker.reset_seconds)
+    assert call("malformed", 1) == 0 and breaker.is_open()
+    # The next trial succeeds and closes the breaker.
+    time.sleep(breaker.reset_seconds)
+    assert call("ok", 1) == 1 and not breaker.is_open()
+    assert call("ok") == 60
+    # A slow server cannot keep the caller past the deadline.
+    started = time.monotonic()
+    assert call("slow", 1) == 0
+    assert time.monotonic() - started < 3.0
+    server.shutdown()
+    print("OK")
@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
 '''
-This module implements a uniform cost search.
+This module implements a uniform cost search. The search keeps its labels by
+the integer ids of stops.NodeIds, but it asks the agencies for edges by the
+names of the nodes.
 '''
-import attr, collections, datetime, heapq, itertools
-import stops
-from agency_common import Agency
+import attr, collections, datetime, heapq, itertools, time
+import data_snapshot, metrics, search_stats, stops
+from agency_common import Agency, QueryContext
 from common import WeightedEdge
 
 class ItineraryNotPossible(Exception):
@@ -22,13 +24,71 @@ class PreviousNode:
         default=0,
         validator=attr.validators.instance_of(int)
     )
+def weighted_edge(
+    agency,
+    known_node,
+    node,
+    datetime_trip,
+    depart,
+    consecutive_agency,
+    context=None
+):
+    '''
+    Returns the first WeightedEdge that the agency yields between known_node and
+    node, or None if it yields none. The arguments have the same meanings as
+    they do for weighted_edges.
+    '''
+    stats = None if context is None else context.stats
+    if stats is not None:
+        agency_stats = stats.agency(agency)
+        agency_stats.generators += 1
+        start = time.perf_counter()
+    try:
+        weight = next(
+            # depart = True: Only process edges from known_node.
+            # depart = False: Only process edges to known_node.
+            agency.get_edge(
+                known_node,
+                node,
+                datetime_depart=datetime_trip,
+                consecutive_agency=consecutive_agency,
+                context=context
+            ) if depart else agency.get_edge(
+                node,
+                known_node,
+                datetime_arrive=datetime_trip,
+                consecutive_agency=consecutive_agency,
+                context=context
+            )
+        )
+    except StopIteration:
+        weight = None
+    if stats is not None:
+        agency_stats.seconds += time.perf_counter() - start
+        if weight is not None:
+            agency_stats.edges_generated += 1
+    if weight is None:
+        return None
+    return WeightedEdge(
+        datetime_depart=weight.datetime_depart,
+        datetime_arrive=weight.datetime_arrive,
+        human_readable_instruction=weight.human_readable_instruction,
+        intermediate_nodes=weight.intermediate_nodes,
+        agency=agency,
+        from_node=node if depart else known_node,
+        to_node=known_node if depart else node
+    )
 def weighted_edges(
     agencies,
-    known_node,
+    node_ids,
+    known_node_id,
     datetime_trip,
     depart,
     consecutive_agency,
-    extra_nodes=frozenset()
+    extra_node_ids=frozenset(),
+    pending_agencies=frozenset(),
+    deferred=None,
+    context=None
 ):
     '''
     Generates directed, weighted edges from known_node.
@@ -39,8 +99,10 @@ def weighted_edges(
     Arguments:
         agencies:
             an iterable of subclasses of Agency
-        known_node:
-            the starting node
+        node_ids:
+            a stops.NodeIds of the nodes to consider
+        known_node_id:
+            the id of the starting node
         datetime_trip:
             the datetime that the user arrives at known_node and begins
             waiting
@@ -49,50 +111,56 @@ def weighted_edges(
         consecutive_agency:
             the agency that provided the edge leading to from_node if
             depart is True or to_node otherwise
-        extra_nodes:
-            a set or frozenset of nodes to consider in addition to the
-            nodes that are already in stops.neighbor_node_to_point.keys()
+        extra_node_ids:
+            a set or frozenset of the ids of the origin and destination
+        pending_agencies:
+            a container of agencies whose preparation for the origin and
+            destination is not ready; they are not asked for edges from or to
+            the nodes in extra_node_ids
+        deferred:
+            a list or None; for every edge that was not generated because its
+            agency is in pending_agencies, an (agency, node_id) tuple is
+            appended to it
+        context:
+            the QueryContext of the query
     Yields:
-        A WeightedEdge object
+        (node_id, WeightedEdge) tuples, where node_id is the id of the node at
+        the other end of the edge
     '''
-    for node in (stops.name_to_point.keys() | extra_nodes) - {known_node}:
+    known_node = node_ids.name(known_node_id)
+    known_node_is_extra = known_node_id in extra_node_ids
+    for node_id in range(len(node_ids)):
+        if node_id == known_node_id:
+            continue
+        node = node_ids.name(node_id)
+        node_is_extra = node_id in extra_node_ids
         for agency in agencies:
-            try:
-                weight = next(
-                    # depart = True: Only process edges from known_node.
-                    # depart = False: Only process edges to known_node.
-                    agency.get_edge(
-                        known_node,
-                        node,
-                        datetime_depart=datetime_trip,
-                        consecutive_agency=consecutive_agency
-                    ) if depart else agency.get_edge(
-                        node,
-                        known_node,
-                        datetime_arrive=datetime_trip,
-                        consecutive_agency=consecutive_agency
-                    )
-                )
-            except StopIteration:
-                pass
-            else:
-                edge = WeightedEdge(
-                    datetime_depart=weight.datetime_depart,
-                    datetime_arrive=weight.datetime_arrive,
-                    human_readable_instruction=weight.human_readable_instruction,
-                    intermediate_nodes=weight.intermediate_nodes,
-                    agency=agency,
-                    from_node=node if depart else known_node,
-                    to_node=known_node if depart else node
-                )
-                yield edge
+            if agency in pending_agencies and (
+                known_node_is_extra or node_is_extra
+            ):
+                if deferred is not None:
+                    deferred.append((agency, node_id))
+                continue
+            edge = weighted_edge(
+                agency,
+                known_node,
+                node,
+                datetime_trip,
+                depart,
+                consecutive_agency,
+                context
+            )
+            if edge is not None:
+                yield node_id, edge
+@data_snapshot.pinned()
 def find_itinerary(
     agencies,
     origin,
     destination,
     trip_datetime,
     depart,
-    disallowed_edges=()
+    disallowed_edges=(),
+    context=None
 ):
     '''
     Finds an itinerary that will take the user from the origin to the
@@ -108,6 +176,16 @@ def find_itinerary(
     The origin and destination must not be equal. If they are equal, then
     ItineraryNotPossible will be raised.
     
+    The whole search uses the same snapshot of the data of each agency, even
+    if the data is reloaded meanwhile (see data_snapshot).
+
+    Agencies may prepare for the origin and destination in the background
+    (see Agency.use_origin_destination_async). The search does not wait for
+    them until it needs one of their edges from or to the origin or the
+    destination. Until then, such edges are represented in the queue by their
+    earliest possible arrival (or latest possible departure), which
+    Agency.min_seconds provides, so the itinerary is still optimal.
+    
     Arguments:
         agencies:
             An iterable of subclasses of Agency
@@ -124,109 +202,291 @@ def find_itinerary(
             a container that supports the membership test operations and that
             contains instances of WeightedEdge, exact matches of which should
             not be yielded
+        context:
+            the agency_common.QueryContext of the query, or None to create
+            one; agencies keep their preparations for the origin and
+            destination in it, so queries with different contexts may run at
+            the same time; if its stats member is set, the statistics of the
+            search are added to it (see search_stats)
+    
+    If metrics are being recorded (see metrics), the search is a span, and
+    the time that each agency spent generating edges is recorded in the
+    histogram agency_edges_seconds.
     Returns:
         The itinerary is returned as a list of Direction objects.
     '''
+    if context is None:
+        context = QueryContext(origin, destination)
+    stats = context.stats
+    if stats is None and not metrics.enabled():
+        return _find_itinerary(
+            agencies,
+            origin,
+            destination,
+            trip_datetime,
+            depart,
+            disallowed_edges,
+            context,
+            None
+        )
+    # Collect the statistics of this search on their own so that they can be
+    # recorded as metrics, and then add them to those of the context.
+    search = search_stats.SearchStats(searches=1)
+    context.stats = search
+    start = time.perf_counter()
+    try:
+        with metrics.span("search"):
+            return _find_itinerary(
+                agencies,
+                origin,
+                destination,
+                trip_datetime,
+                depart,
+                disallowed_edges,
+                context,
+                search
+            )
+    finally:
+        search.seconds = time.perf_counter() - start
+        context.stats = stats
+        if stats is not None:
+            stats.add(search)
+        for name, agency_stats in search.agencies.items():
+            metrics.observe(
+                "agency_edges_seconds",
+                agency_stats.seconds,
+                agency=name
+            )
+            metrics.count(
+                "agency_edges_generated",
+                agency_stats.edges_generated,
+                agency=name
+            )
+        metrics.count("search_nodes_settled", search.nodes_settled)
+def _find_itinerary(
+    agencies,
+    origin,
+    destination,
+    trip_datetime,
+    depart,
+    disallowed_edges,
+    context,
+    stats
+):
+    # Every node is known by its id in node_ids, and nodes are only turned
+    # back into names for the agencies and for the itinerary. Every item in
+    # the queue is a tentative distance followed by a node id, a sequence
+    # number and a deferral. For nodes, the sequence number is zero and the
+    # deferral is None. For edges that could not be generated yet, the
+    # sequence number is unique, and the deferral is an (agency, known_node_id)
+    # tuple.
+    node_ids = stops.NodeIds((origin, destination))
+    origin_id = node_ids.id(origin)
+    destination_id = node_ids.id(destination)
     visit_queue = []
-    extra_nodes = {origin, destination}
+    deferral_sequence = itertools.count(1)
+    extra_node_ids = {origin_id, destination_id}
     # Pass the origin and destination to the agencies.
+    pending = {}
     for agency in agencies:
-        agency.use_origin_destination(origin, destination)
+        preparation = context.prepare(agency, origin, destination)
+        if preparation is not None:
+            pending[agency] = preparation
     # Assign to every node a tentative distance value.
     # Set it to zero for our initial node and to infinity for the rest.
-    previous_node = collections.defaultdict(PreviousNode)
+    previous_node = [PreviousNode()] * len(node_ids)
     # Set the initial node as current. Mark all other nodes unvisited.
     if depart:
-        previous_node[origin] = PreviousNode(
+        previous_node[origin_id] = PreviousNode(
             WeightedEdge(datetime_arrive=trip_datetime)
         )
         heapq.heappush(
             visit_queue,
-            (datetime.datetime.min, datetime.timedelta(0), 0, origin)
+            (datetime.datetime.min, datetime.timedelta(0), 0) +
+            (origin_id, 0, None)
         )
-        stop_algorithm = destination
+        stop_algorithm = destination_id
     else:
-        previous_node[destination] = PreviousNode(
+        previous_node[destination_id] = PreviousNode(
             WeightedEdge(datetime_depart=trip_datetime)
         )
         heapq.heappush(
             visit_queue,
-            (datetime.timedelta(0), datetime.datetime.min, 0, destination)
+            (datetime.timedelta(0), datetime.datetime.min, 0) +
+            (destination_id, 0, None)
+        )
+        stop_algorithm = origin_id
+    if stats is not None:
+        stats.heap_pushes += 1
+    def relax(current_node_id, neighbor_node_id, edge):
+        '''
+        Updates the tentative distance of the node at the other end of the edge
+        from current_node_id if the edge makes it shorter.
+        '''
+        num_stops_to_node_new = previous_node[
+            current_node_id
+        ].num_stops_to_node + 1
+        n = previous_node[neighbor_node_id]
+        # Calculate the unvisited neighbor's tentative distance.
+        if depart:
+            neighbor_distance_old = (
+                n.edge.datetime_arrive,
+                n.num_stops_to_node,
+                datetime.datetime.max - n.edge.datetime_depart
+            )
+            neighbor_distance_new = (
+                edge.datetime_arrive,
+                num_stops_to_node_new,
+                datetime.datetime.max - edge.datetime_depart
+            )
+        else:
+            neighbor_distance_old = (
+                datetime.datetime.max - n.edge.datetime_depart,
+                n.num_stops_to_node,
+                n.edge.datetime_arrive
+            )
+            neighbor_distance_new = (
+                datetime.datetime.max - edge.datetime_depart,
+                num_stops_to_node_new,
+                edge.datetime_arrive
+            )
+        # Compare the newly calculated tentative distance to the
+        # currently assigned value and assign the smaller one.
+        if neighbor_distance_new < neighbor_distance_old:
+            current_node = node_ids.name(current_node_id)
+            direction = WeightedEdge(
+                datetime_arrive=edge.datetime_arrive,
+                datetime_depart=edge.datetime_depart,
+                human_readable_instruction=
+                    edge.human_readable_instruction,
+                intermediate_nodes=edge.intermediate_nodes,
+                agency=edge.agency,
+                from_node=
+                    current_node if depart else edge.to_node,
+                to_node=edge.from_node if depart else current_node
+            )
+            if direction not in disallowed_edges:
+                previous_node[neighbor_node_id] = PreviousNode(
+                    direction,
+                    num_stops_to_node=num_stops_to_node_new
+                )
+                heapq.heappush(
+                    visit_queue,
+                    neighbor_distance_new + (neighbor_node_id, 0, None)
+                )
+                if stats is not None:
+                    stats.heap_pushes += 1
+                    stats.agency(edge.agency).edges_accepted += 1
+    def defer(current_node_id, agency, neighbor_node_id):
+        '''
+        Puts an edge between current_node_id and neighbor_node_id that could
+        not be generated yet into the queue at the earliest tentative distance
+        that it could give neighbor_node_id.
+        '''
+        p = previous_node[current_node_id]
+        current_node = node_ids.name(current_node_id)
+        neighbor_node = node_ids.name(neighbor_node_id)
+        bound = datetime.timedelta(
+            seconds=agency.min_seconds(current_node, neighbor_node, context)
+            if depart else
+            agency.min_seconds(neighbor_node, current_node, context)
         )
-        stop_algorithm = origin
+        if depart:
+            try:
+                earliest = p.edge.datetime_arrive + bound
+            except OverflowError:
+                earliest = p.edge.datetime_arrive
+            distance = (
+                earliest,
+                p.num_stops_to_node + 1,
+                datetime.timedelta(0)
+            )
+        else:
+            try:
+                latest = p.edge.datetime_depart - bound
+            except OverflowError:
+                latest = p.edge.datetime_depart
+            distance = (
+                datetime.datetime.max - latest,
+                p.num_stops_to_node + 1,
+                datetime.datetime.min
+            )
+        heapq.heappush(
+            visit_queue,
+            distance + (
+                neighbor_node_id,
+                next(deferral_sequence),
+                (agency, current_node_id)
+            )
+        )
+        if stats is not None:
+            stats.heap_pushes += 1
     # Visit each node at most once.
-    visited = set()
+    visited = bytearray(len(node_ids))
     while visit_queue:
-        current_node = heapq.heappop(visit_queue)[-1]
-        if current_node not in visited:
+        *_, current_node_id, _, deferral = heapq.heappop(visit_queue)
+        if stats is not None:
+            stats.heap_pops += 1
+        if deferral is not None:
+            # This is an edge to current_node_id (or from it, if depart is
+            # False) whose agency was not ready. If the node has already been
+            # visited, the edge cannot make its distance any shorter.
+            agency, known_node_id = deferral
+            if not visited[current_node_id]:
+                # Wait for the agency now that its edge is needed.
+                preparation = pending.pop(agency, None)
+                if preparation is not None:
+                    preparation.get()
+                known_node_edge = previous_node[known_node_id].edge
+                edge = weighted_edge(
+                    agency,
+                    node_ids.name(known_node_id),
+                    node_ids.name(current_node_id),
+                    known_node_edge.datetime_arrive
+                    if depart else
+                    known_node_edge.datetime_depart,
+                    depart,
+                    known_node_edge.agency,
+                    context
+                )
+                if edge is not None:
+                    relax(known_node_id, current_node_id, edge)
+            continue
+        if not visited[current_node_id]:
             # Mark the current node as visited.
             # A visited node will never be checked again.
-            visited.add(current_node)
+            visited[current_node_id] = True
+            if stats is not None:
+                stats.nodes_settled += 1
+            # Stop putting off agencies whose preparations are ready.
+            for agency, preparation in list(pending.items()):
+                if preparation.ready():
+                    preparation.get()
+                    del pending[agency]
             # For the current node, consider all of its unvisited neighbors.
-            previous_node_current_node_edge = previous_node[current_node].edge
-            for edge in weighted_edges(
+            previous_node_current_node_edge = \
+                previous_node[current_node_id].edge
+            deferred = []
+            for neighbor_node_id, edge in weighted_edges(
                 agencies,
-                current_node,
+                node_ids,
+                current_node_id,
                 previous_node_current_node_edge.datetime_arrive
                 if depart else
                 previous_node_current_node_edge.datetime_depart,
                 depart,
                 previous_node_current_node_edge.agency,
-                extra_nodes
+                extra_node_ids,
+                pending,
+                deferred,
+                context
             ):
-                neighbor_node = edge.from_node if depart else edge.to_node
-                num_stops_to_node_new = previous_node[
-                    current_node
-                ].num_stops_to_node + 1
-                n = previous_node[neighbor_node]
-                # Calculate the unvisited neighbor's tentative distance.
-                if depart:
-                    neighbor_distance_old = (
-                        n.edge.datetime_arrive,
-                        n.num_stops_to_node,
-                        datetime.datetime.max - n.edge.datetime_depart
-                    )
-                    neighbor_distance_new = (
-                        edge.datetime_arrive,
-                        num_stops_to_node_new,
-                        datetime.datetime.max - edge.datetime_depart
-                    )
-                else:
-                    neighbor_distance_old = (
-                        datetime.datetime.max - n.edge.datetime_depart,
-                        n.num_stops_to_node,
-                        n.edge.datetime_arrive
-                    )
-                    neighbor_distance_new = (
-                        datetime.datetime.max - edge.datetime_depart,
-                        num_stops_to_node_new,
-                        edge.datetime_arrive
-                    )
-                # Compare the newly calculated tentative distance to the
-                # currently assigned value and assign the smaller one.
-                if neighbor_distance_new < neighbor_distance_old:
-                    direction = WeightedEdge(
-                        datetime_arrive=edge.datetime_arrive,
-                        datetime_depart=edge.datetime_depart,
-                        human_readable_instruction=
-                            edge.human_readable_instruction,
-                        intermediate_nodes=edge.intermediate_nodes,
-                        agency=edge.agency,
-                        from_node=
-                            current_node if depart else edge.to_node,
-                        to_node=edge.from_node if depart else current_node
-                    )
-                    if direction not in disallowed_edges:
-                        previous_node[neighbor_node] = PreviousNode(
-                            direction,
-                            num_stops_to_node=num_stops_to_node_new
-                        )
-                        heapq.heappush(
-                            visit_queue,
-                            neighbor_distance_new + (neighbor_node,)
-                        )
+                relax(current_node_id, neighbor_node_id, edge)
+            for agency, neighbor_node_id in deferred:
+                if not visited[neighbor_node_id]:
+                    defer(current_node_id, agency, neighbor_node_id)
             # If the target node has been visited, then break.
-            if current_node == stop_algorithm:
+            if current_node_id == stop_algorithm:
                 break
     # If the destination node has been marked visited (when planning a
     # route between two specific nodes) or if the smallest tentative
@@ -234,9 +494,9 @@ def find_itinerary(
     # planning a complete traversal; occurs when there is no connection
     # between the initial node and remaining unvisited nodes), then stop.
     if (
-        previous_node[destination].edge.from_node
+        previous_node[destination_id].edge.from_node
         if depart else
-        previous_node[origin].edge.to_node
+        previous_node[origin_id].edge.to_node
     ) is None:
         raise ItineraryNotPossible
         return None
@@ -247,14 +507,14 @@ def find_itinerary(
     if depart:
         current_node = destination
         while current_node is not None:
-            n = previous_node[current_node]
+            n = previous_node[node_ids.id(current_node)]
             itinerary.append(n.edge)
             current_node = n.edge.from_node
         itinerary = itinerary[-2::-1]
     else:
         current_node = origin
         while current_node is not None:
-            n = previous_node[current_node]
+            n = previous_node[node_ids.id(current_node)]
             itinerary.append(n.edge)
             current_node = n.edge.to_node
         itinerary.pop()
@@ -272,6 +532,9 @@ def find_itineraries(
     itineraries are yielded. Each itinerary has one or more different edges
     than the others. The agency of every varied edge will be in
     agencies_to_vary. A maximum of max_count itineraries will be yielded.
+
+    All the searches use the same snapshot of the data of each agency (see
+    data_snapshot), but nothing is pinned while the generator is suspended.
     
     Arguments:
         agencies_to_vary:
@@ -288,25 +551,19 @@ def find_itineraries(
         *args and **kwargs:
             All other arguments will be forwarded to find_itinerary.
     '''
-    # Handle the maximum number of itineraries here while handling the rest of
-    # the computations in a recursive call.
-    if max_count is not None:
-        for itinerary in find_itineraries(
+    itineraries = data_snapshot.pinned_iterator(
+        _find_itineraries(
             agencies_to_vary,
-            *args,
-            max_count=None,
-            disallowed_edges=disallowed_edges,
-            **kwargs
-        ):
-            # We could use itertools.islice, but this is simpler.
-            max_count -= 1
-            if max_count < 0:
-                return
-            yield itinerary
-        return
+            args,
+            kwargs,
+            frozenset() if disallowed_edges is None else disallowed_edges
+        )
+    )
+    if max_count is not None:
+        itineraries = itertools.islice(itineraries, max_count)
+    yield from itineraries
+def _find_itineraries(agencies_to_vary, args, kwargs, disallowed_edges):
     # Find an itinerary normally.
-    if disallowed_edges is None:
-        disallowed_edges = frozenset()
     try:
         itinerary = find_itinerary(
             *args,
@@ -327,12 +584,11 @@ def find_itineraries(
     for i in range(1, len(edges_to_disallow) + 1):
         for de_combo in itertools.combinations(edges_to_disallow, i):
             generators.append(
-                find_itineraries(
+                _find_itineraries(
                     agencies_to_vary,
-                    *args,
-                    max_count=None,
-                    disallowed_edges=disallowed_edges.union(de_combo),
-                    **kwargs
+                    args,
+                    kwargs,
+                    disallowed_edges.union(de_combo)
                 )
             )
     # Yield itineraries from the generators, breadth-first.
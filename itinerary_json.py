@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+'''
+This module turns itineraries and departures into objects that can be encoded
+as JSON or MessagePack, and writes them while they are being found.
+
+A direction, i.e. a WeightedEdge, becomes an object with these keys:
+    agency:
+        the name of the agency class, e.g. "AgencyNYU", or null
+    from, to:
+        the nodes that the direction goes from and to
+    depart, arrive:
+        the departure and arrival times in ISO 8601 format
+    instruction:
+        the human-readable instruction, or null
+    intermediate_stops:
+        a list of objects with the keys stop and time, for the stops that the
+        vehicle makes in between
+An itinerary becomes an object with the keys directions, which is a list of
+directions, and total_seconds.
+
+Formats:
+    json:
+        one JSON object with the key itinerary (an itinerary or null),
+        itineraries (a list) or departures (a list of directions). The list
+        is written item by item.
+    jsonl:
+        one line of JSON for every itinerary or departure. If an itinerary
+        is not possible, the line is null.
+    msgpack:
+        the same objects as jsonl, encoded one after another with
+        MessagePack. This needs the msgpack package.
+'''
+import json, sys
+
+def edge_to_json(edge):
+    return {
+        "agency": None if edge.agency is None else edge.agency.__name__,
+        "from": edge.from_node,
+        "to": edge.to_node,
+        "depart": edge.datetime_depart.isoformat(),
+        "arrive": edge.datetime_arrive.isoformat(),
+        "instruction": edge.get_human_readable_instruction(),
+        "intermediate_stops": [
+            {"stop": n.node, "time": n.time.isoformat()}
+            for n in edge.intermediate_nodes
+        ]
+    }
+def itinerary_to_json(itinerary):
+    return {
+        "directions": [edge_to_json(edge) for edge in itinerary],
+        "total_seconds": (
+            itinerary[-1].datetime_arrive - itinerary[0].datetime_depart
+        ).total_seconds()
+    }
+def results_to_json(kind, results):
+    '''
+    Yields the results of get_itinerary.answers as objects. For the kind
+    "itinerary", exactly one object is yielded, which is None if the
+    itinerary is not possible.
+    '''
+    if kind == "departures":
+        for edge in results:
+            yield edge_to_json(edge)
+    elif kind == "itineraries":
+        for itinerary in results:
+            yield itinerary_to_json(itinerary)
+    else:
+        for itinerary in results:
+            yield itinerary_to_json(itinerary)
+            break
+        else:
+            yield None
+def to_json(kind, results):
+    '''
+    Returns the results of get_itinerary.answers as one object in the format
+    of json.
+    '''
+    objects = results_to_json(kind, results)
+    if kind == "itinerary":
+        return {kind: next(objects)}
+    return {kind: list(objects)}
+def write(kind, results, output_format, stream=None):
+    '''
+    Writes the results of get_itinerary.answers to the stream, or to
+    standard output if stream is None, in the given format. Every object is
+    written and flushed as soon as it has been found.
+    '''
+    objects = results_to_json(kind, results)
+    if output_format == "msgpack":
+        import msgpack
+        if stream is None:
+            stream = sys.stdout.buffer
+        packer = msgpack.Packer()
+        for o in objects:
+            stream.write(packer.pack(o))
+            stream.flush()
+        return
+    if stream is None:
+        stream = sys.stdout
+    if output_format == "jsonl":
+        for o in objects:
+            stream.write(json.dumps(o) + "\n")
+            stream.flush()
+    elif kind == "itinerary":
+        stream.write(json.dumps({kind: next(objects)}) + "\n")
+    else:
+        stream.write("{" + json.dumps(kind) + ": [")
+        for i, o in enumerate(objects):
+            if i:
+                stream.write(", ")
+            stream.write(json.dumps(o))
+            stream.flush()
+        stream.write("]}\n")
@@ -0,0 +1,521 @@
+#!/usr/bin/env python3
+'''
+This module serves itineraries and departure lists over HTTP so that clients
+do not have to start get_itinerary.py for every query.
+
+The schedules and walking times are loaded once, before the worker processes
+are forked, so they stay in memory between queries. Queries are searched in
+the worker processes, and the HTTP server only parses requests and waits for
+the results.
+
+Requests:
+    POST /
+        The body is a JSON object. origin, destination and datetime are the
+        arguments of get_itinerary.py; datetime defaults to "now". The other
+        keys are the options of get_itinerary.py that affect the query, i.e.
+        those in QUERY_OPTIONS and the options of the agencies, with
+        underscores instead of dashes, e.g. {"list_departures": 3} or
+        {"walking_max": 10}. Set flags to true. The arguments are checked the
+        same way as on the command line. The response is a JSON object in
+        the json format of itinerary_json. If the stats option is set, the
+        response also has the key stats with the statistics of the search
+        (see search_stats). Invalid queries, including queries with other
+        keys, such as format or cache, get status 400 and {"error": message}.
+    GET /stats
+        Returns the number of queries that are waiting for a worker, the
+        latencies of the recent queries and how many queries were answered
+        from the caches of the workers.
+    GET /metrics
+        Returns the latency histograms of the stages of queries, e.g. the
+        search and the Distance Matrix API requests, and other counters from
+        all workers, in the text format of Prometheus (see metrics).
+
+A query that takes longer than the timeout gets status 504, but its worker
+keeps running it, and it is counted as abandoned until the worker finishes.
+While as many abandoned queries as there are workers are still running, new
+queries get status 503 at once instead of waiting behind them.
+
+Every response has an X-Latency-Ms header. The answers of recent queries are
+kept in a result_cache.ResultCache in every worker, which can be backed by a
+result_cache.DiskCache that the workers share; the answers to queries have an
+X-Cache header, which is "hit" if the answer was taken from a cache and "miss"
+otherwise.
+'''
+import argparse, collections, http.server, json, multiprocessing, statistics, \
+    sys, threading, time
+import agency_nyu, agency_walking_static, data_snapshot, gazetteer, \
+    get_itinerary, itinerary_json, metrics, result_cache, search_stats, \
+    stops, walking_estimator
+DEFAULT_PORT = 8080
+# A query that takes longer than this many seconds is abandoned.
+DEFAULT_TIMEOUT_SECONDS = 60.0
+# This is the number of recent latencies that /stats summarizes.
+LATENCY_WINDOW = 1000
+MAX_REQUEST_BYTES = 65536
+# These options of get_itinerary.py may be set by queries, as well as the
+# options of the agencies. The others, e.g. --batch or --cache, are about the
+# process rather than the query.
+QUERY_OPTIONS = ("depart", "list_departures", "number_of_itineraries", "stats")
+# The result_cache.ResultCache that run_query uses, or None to not cache
+# answers. serve sets it before the workers are forked, so every worker has
+# its own.
+cache = None
+# The metrics.MemorySink that records the metrics of this process, or None.
+# serve sets it before the workers are forked. Every worker sends what it
+# recorded for a query along with the answer, and the server adds it to its
+# own.
+metrics_sink = None
+
+class QueryError(Exception):
+    '''
+    This exception is raised when a query is invalid. Its message is sent to
+    the client.
+    '''
+class QueryArgumentParser(argparse.ArgumentParser):
+    '''
+    An argument parser that raises QueryError instead of exiting
+    '''
+    def error(self, message):
+        raise QueryError(message)
+    def exit(self, status=0, message=None):
+        raise QueryError(message or "invalid query")
+
+def query_keys():
+    '''
+    Returns the set of the keys that queries may have.
+    '''
+    keys = {"origin", "destination", "datetime"}
+    keys.update(QUERY_OPTIONS)
+    def add_argument(*names, **kwargs):
+        keys.update(
+            name[2:].replace("-", "_")
+            for name in names if name.startswith("--")
+        )
+    for agency in get_itinerary.AGENCIES:
+        agency.add_arguments(add_argument)
+    return keys
+def query_to_args(query):
+    '''
+    Turns a query, which is a dictionary decoded from JSON, into a list of
+    arguments for get_itinerary.parse_args.
+    '''
+    if not isinstance(query, dict):
+        raise QueryError("The query must be a JSON object.")
+    unknown = sorted(set(query) - query_keys())
+    if unknown:
+        raise QueryError("Unknown keys: " + ", ".join(unknown))
+    if not isinstance(query.get("origin"), str):
+        raise QueryError("The origin is required and must be a string.")
+    positionals = [query["origin"]]
+    destination = query.get("destination")
+    if destination:
+        if not isinstance(destination, str):
+            raise QueryError("The destination must be a string.")
+        positionals.append(destination)
+    positionals.append(str(query.get("datetime", "now")))
+    options = []
+    for key, value in query.items():
+        if key in ("origin", "destination", "datetime"):
+            continue
+        option = "--" + key.replace("_", "-")
+        if value is True:
+            options.append(option)
+        elif value is not False and value is not None:
+            options.extend((option, str(value)))
+    # The positional arguments come after "--" so that they are never taken
+    # for options.
+    return options + ["--"] + positionals
+def run_query(args_parsed, context=None):
+    '''
+    Answers a query whose arguments have been parsed by
+    get_itinerary.parse_args, like get_itinerary.main does, and returns the
+    answer as a dictionary that can be encoded as JSON (see itinerary_json).
+    If context is None, a new agency_common.QueryContext is used. If cache
+    is set, the answer may be taken from it.
+    '''
+    if context is None:
+        context = get_itinerary.query_context(args_parsed)
+    if args_parsed.origin == args_parsed.destination and \
+        not args_parsed.list_departures:
+        raise QueryError("The origin and the destination are the same.")
+    if args_parsed.stats:
+        # The context may be shared with other queries, but the statistics
+        # are only about this one.
+        context.stats = search_stats.SearchStats()
+    if cache is None:
+        answer = itinerary_json.to_json(
+            *get_itinerary.answers(args_parsed, context)
+        )
+    else:
+        answer = itinerary_json.to_json(*cache.answers(args_parsed, context))
+    if args_parsed.stats:
+        answer["stats"] = context.stats.to_json()
+    return answer
+def warm():
+    '''
+    Loads everything that queries need so that the first query is not slow.
+    '''
+    agency_nyu.schedules.current()
+    agency_walking_static.walking_times.current()
+    stops.load()
+    gazetteer.get_gazetteer()
+    walking_estimator.get_estimator()
+def init_worker():
+    warm()
+    # Forget the metrics that were copied from the server when this worker
+    # was forked.
+    if metrics_sink is not None:
+        metrics_sink.take()
+def handle_query(query):
+    '''
+    Answers a query in a worker process. Returns an (HTTP status, dictionary,
+    whether the answer was taken from the cache, metrics) tuple, where metrics
+    is what metrics_sink.take returned or None.
+    '''
+    status, body, cached = _handle_query(query)
+    return (
+        status,
+        body,
+        cached,
+        None if metrics_sink is None else metrics_sink.take()
+    )
+def _handle_query(query):
+    # Pick up rebuilt schedules between queries.
+    data_snapshot.reload_all_if_changed()
+    try:
+        args_parsed = get_itinerary.parse_args(
+            get_itinerary.AGENCIES,
+            query_to_args(query),
+            QueryArgumentParser
+        )
+        hits = 0 if cache is None else cache.hits
+        body = run_query(args_parsed)
+        return 200, body, cache is not None and cache.hits > hits
+    except QueryError as e:
+        return 400, {"error": str(e)}, False
+
+class Job:
+    '''
+    A query that was sent to a worker
+    '''
+    def __init__(self):
+        # True until the worker finishes the query
+        self.running = True
+        # True if the client was answered before the worker finished
+        self.abandoned = False
+class Stats:
+    '''
+    This class counts the queries that are waiting or running, including
+    those that timed out but that the workers are still running, and keeps
+    the latencies of the recent queries. It is thread-safe.
+    '''
+    def __init__(self, processes, max_abandoned=None):
+        '''
+        Arguments:
+            max_abandoned:
+                the number of queries that timed out that may still be
+                running before new queries are rejected, or None for the
+                number of processes, i.e. until every worker is busy with
+                one
+        '''
+        self.processes = processes
+        self.max_abandoned = processes if max_abandoned is None else \
+            max_abandoned
+        self._lock = threading.Lock()
+        self._outstanding = 0
+        self._abandoned = 0
+        self._rejected = 0
+        self._completed = 0
+        self._cache_hits = 0
+        self._latencies = collections.deque(maxlen=LATENCY_WINDOW)
+    def started(self):
+        '''
+        Counts a query that is about to be sent to a worker and returns its
+        Job. If too many abandoned queries are still running, the query is not
+        counted, and None is returned; it must be rejected.
+        '''
+        with self._lock:
+            if self._abandoned >= self.max_abandoned:
+                self._rejected += 1
+                return None
+            self._outstanding += 1
+            return Job()
+    def worker_finished(self, job):
+        '''
+        Called when a worker has finished a query, even if it was abandoned.
+        '''
+        with self._lock:
+            self._outstanding -= 1
+            job.running = False
+            if job.abandoned:
+                self._abandoned -= 1
+    def abandon(self, job):
+        '''
+        Called when the client is answered without waiting for the worker any
+        longer. The query is counted until the worker finishes it.
+        '''
+        with self._lock:
+            if job.running and not job.abandoned:
+                job.abandoned = True
+                self._abandoned += 1
+    def finished(self, latency_seconds, cached=False):
+        '''
+        Called when the client has been answered.
+        '''
+        with self._lock:
+            self._completed += 1
+            if cached:
+                self._cache_hits += 1
+            self._latencies.append(latency_seconds)
+    def to_json(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            result = {
+                "outstanding": self._outstanding,
+                # The queries that are not running because every worker is
+                # busy
+                "queue_depth": max(0, self._outstanding - self.processes),
+                # The queries that timed out but are still running or waiting
+                "abandoned": self._abandoned,
+                # The queries that were rejected because of them
+                "rejected": self._rejected,
+                "completed": self._completed,
+                "cache_hits": self._cache_hits,
+                "processes": self.processes
+            }
+        if latencies:
+            result["latency_ms"] = {
+                "mean": statistics.mean(latencies) * 1000.0,
+                "p50": latencies[len(latencies) // 2] * 1000.0,
+                "p90": latencies[len(latencies) * 9 // 10] * 1000.0,
+                "p99": latencies[len(latencies) * 99 // 100] * 1000.0,
+                "max": latencies[-1] * 1000.0
+            }
+        return result
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    # These are set by serve.
+    pool = None
+    stats = None
+    timeout_seconds = DEFAULT_TIMEOUT_SECONDS
+    def send_json(self, status, body, start, headers=()):
+        self.send_data(
+            status,
+            json.dumps(body).encode("UTF-8"),
+            "application/json",
+            start,
+            headers
+        )
+    def send_data(self, status, data, content_type, start, headers=()):
+        latency = time.monotonic() - start
+        latency_ms = latency * 1000.0
+        metrics.observe(
+            "http_request_seconds",
+            latency,
+            path=self.path if status != 404 else "other",
+            status=status
+        )
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("X-Latency-Ms", "{:.1f}".format(latency_ms))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+        self.log_message(
+            '"%s" %d %.1f ms',
+            self.requestline,
+            status,
+            latency_ms
+        )
+    def log_request(self, code="-", size="-"):
+        # send_json logs every request along with its latency.
+        pass
+    def do_GET(self):
+        start = time.monotonic()
+        if self.path == "/stats":
+            self.send_json(200, self.stats.to_json(), start)
+        elif self.path == "/metrics" and metrics_sink is not None:
+            self.send_data(
+                200,
+                metrics_sink.prometheus_text().encode("UTF-8"),
+                "text/plain; version=0.0.4",
+                start
+            )
+        else:
+            self.send_json(404, {"error": "not found"}, start)
+    def do_POST(self):
+        start = time.monotonic()
+        if self.path != "/":
+            self.send_json(404, {"error": "not found"}, start)
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            if not 0 < length <= MAX_REQUEST_BYTES:
+                raise QueryError("The body must be a JSON object.")
+            query = json.loads(self.rfile.read(length).decode("UTF-8"))
+        except (QueryError, ValueError) as e:
+            self.send_json(400, {"error": str(e)}, start)
+            return
+        job = self.stats.started()
+        cached = False
+        try:
+            if job is None:
+                status, body = 503, {
+                    "error": "Too many queries that took too long are still "
+                        "running."
+                }
+            else:
+                status, body, cached, taken = self.pool.apply_async(
+                    handle_query,
+                    (query,),
+                    callback=lambda result: self.stats.worker_finished(job),
+                    error_callback=
+                        lambda error: self.stats.worker_finished(job)
+                ).get(self.timeout_seconds)
+                if taken is not None:
+                    metrics_sink.merge(taken)
+        except multiprocessing.TimeoutError:
+            # The worker keeps running the query, so it is counted until the
+            # worker finishes it.
+            self.stats.abandon(job)
+            status, body = 504, {"error": "The query took too long."}
+        except Exception as e:
+            status, body = 500, {"error": str(e)}
+        finally:
+            self.stats.finished(time.monotonic() - start, cached)
+            metrics.count("queries", cache="hit" if cached else "miss")
+        self.send_json(
+            status,
+            body,
+            start,
+            (("X-Cache", "hit" if cached else "miss"),)
+        )
+def serve(
+    host="127.0.0.1",
+    port=DEFAULT_PORT,
+    processes=None,
+    timeout_seconds=DEFAULT_TIMEOUT_SECONDS,
+    cache_entries=result_cache.DEFAULT_MAX_ENTRIES,
+    cache_bucket_seconds=result_cache.DEFAULT_BUCKET_SECONDS,
+    cache_path=None
+):
+    '''
+    Loads the data, forks the worker processes and serves requests until the
+    process is interrupted. Every worker caches up to cache_entries answers;
+    if it is 0, answers are not cached. If cache_path is set, the workers
+    also share answers through a result_cache.DiskCache at that path.
+    '''
+    global cache, metrics_sink
+    if cache_entries:
+        cache = result_cache.ResultCache(
+            cache_entries,
+            cache_bucket_seconds,
+            None if cache_path is None else
+                result_cache.DiskCache(cache_path)
+        )
+    else:
+        cache = None
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if metrics_sink is None:
+        metrics_sink = metrics.MemorySink()
+        metrics.add_sink(metrics_sink)
+    # Load the data before forking so that the workers share its pages.
+    warm()
+    try:
+        context = multiprocessing.get_context("fork")
+    except ValueError:
+        context = multiprocessing.get_context()
+    pool = context.Pool(processes, initializer=init_worker)
+    RequestHandler.pool = pool
+    RequestHandler.stats = Stats(processes)
+    RequestHandler.timeout_seconds = timeout_seconds
+    server = http.server.ThreadingHTTPServer((host, port), RequestHandler)
+    print(
+        "Serving on http://{}:{}/ with {} processes".format(
+            host,
+            server.server_address[1],
+            processes
+        ),
+        file=sys.stderr
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.terminate()
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description="Serves itineraries and departure lists over HTTP."
+    )
+    arg_parser.add_argument(
+        "--host",
+        default="127.0.0.1",
+        help="the address to listen on"
+    )
+    arg_parser.add_argument(
+        "--port",
+        type=int,
+        default=DEFAULT_PORT,
+        help="the port to listen on"
+    )
+    arg_parser.add_argument(
+        "--processes",
+        type=int,
+        metavar="N",
+        help="the number of worker processes (default: the number of CPUs)"
+    )
+    arg_parser.add_argument(
+        "--timeout",
+        type=float,
+        default=DEFAULT_TIMEOUT_SECONDS,
+        metavar="seconds",
+        help="the longest period of time that one query may take"
+    )
+    arg_parser.add_argument(
+        "--cache-entries",
+        type=int,
+        default=result_cache.DEFAULT_MAX_ENTRIES,
+        metavar="N",
+        help=
+            "the number of answers that every worker caches (0 to not cache "
+            "answers)"
+    )
+    arg_parser.add_argument(
+        "--cache-bucket",
+        type=int,
+        default=result_cache.DEFAULT_BUCKET_SECONDS,
+        metavar="seconds",
+        help=
+            "queries for times in the same bucket of this many seconds share "
+            "cached answers (0 for exactly the same time only)"
+    )
+    arg_parser.add_argument(
+        "--cache-file",
+        metavar="FILE",
+        help=
+            "also keeps answers in the SQLite database FILE, which the "
+            "workers share and which is kept between runs"
+    )
+    args_parsed = arg_parser.parse_args()
+    if args_parsed.processes is not None and args_parsed.processes < 1:
+        arg_parser.error("--processes must be 1 or more")
+    if args_parsed.cache_entries < 0:
+        arg_parser.error("--cache-entries must be 0 or more")
+    if args_parsed.cache_bucket < 0:
+        arg_parser.error("--cache-bucket must be 0 or more")
+    serve(
+        args_parsed.host,
+        args_parsed.port,
+        args_parsed.processes,
+        args_parsed.timeout,
+        args_parsed.cache_entries,
+        args_parsed.cache_bucket,
+        args_parsed.cache_file
+    )
+
+if __name__ == "__main__":
+    main()
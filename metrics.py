@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+'''
+This module records how long the stages of queries and builds take and how
+often things happen, so that operators can see where the time goes, e.g.
+whether a slow query waited for the Distance Matrix API or for the search.
+
+Code marks a stage with a span:
+    with metrics.span("search"):
+        ...
+and counts events with count. What is recorded goes to every sink that has
+been added with add_sink:
+    LogSink:
+        writes every span, indented under the spans that it is in, to a
+        stream, e.g. for get_itinerary.py --trace
+    MemorySink:
+        keeps a latency histogram of every span and the total of every
+        counter, and formats them for Prometheus, e.g. for the /metrics page
+        of itinerary_server
+Other sinks can subclass Sink. While there are no sinks, span returns a
+shared object that does nothing, and count and observe return at once, so
+the spans cost almost nothing.
+
+Spans, histograms and counters can have labels, which are keyword arguments,
+e.g. metrics.span("use_origin_destination", agency="AgencyNYU"). The
+histogram of a span is named after the span with "_seconds" appended.
+'''
+import bisect, sys, threading, time
+# The upper bounds of the buckets of the latency histograms, in seconds
+BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+    5.0, 10.0, float("inf")
+)
+sinks = []
+_local = threading.local()
+
+class Sink:
+    '''
+    The base class of sinks. Its methods do nothing.
+    '''
+    def span(self, name, labels, seconds, parents):
+        '''
+        Called when a span ends.
+
+        Arguments:
+            name:
+                the name of the span
+            labels:
+                a tuple of (name, value) tuples, sorted by name
+            seconds:
+                how long the span took
+            parents:
+                a tuple of the names of the spans that this span is in on the
+                same thread, from the outermost
+        '''
+    def observe(self, name, labels, value):
+        '''
+        Called with a value for a histogram.
+        '''
+    def count(self, name, labels, n):
+        '''
+        Called when n is added to a counter.
+        '''
+class LogSink(Sink):
+    '''
+    A sink that writes every span and counter to a stream as it happens
+    '''
+    def __init__(self, stream=None):
+        '''
+        Arguments:
+            stream:
+                a text file, or None for standard error
+        '''
+        self.stream = stream
+        self._lock = threading.Lock()
+    def _write(self, depth, text, labels):
+        stream = sys.stderr if self.stream is None else self.stream
+        if labels:
+            text += " (" + ", ".join(
+                "{}={}".format(name, value) for name, value in labels
+            ) + ")"
+        with self._lock:
+            print("  " * depth + text, file=stream)
+    def span(self, name, labels, seconds, parents):
+        self._write(
+            len(parents),
+            "{}: {:.1f} ms".format(name, seconds * 1000.0),
+            labels
+        )
+    def observe(self, name, labels, value):
+        depth = len(getattr(_local, "stack", ()))
+        self._write(depth, "{}: {}".format(name, value), labels)
+    def count(self, name, labels, n):
+        depth = len(getattr(_local, "stack", ()))
+        self._write(depth, "{}: +{}".format(name, n), labels)
+class Histogram:
+    '''
+    The number of values in each bucket of BUCKETS, with their sum
+    '''
+    def __init__(self):
+        self.bucket_counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+    def add(self, value):
+        self.bucket_counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+    def merge(self, bucket_counts, count, total):
+        for i, n in enumerate(bucket_counts):
+            self.bucket_counts[i] += n
+        self.count += count
+        self.sum += total
+    def quantile(self, q):
+        '''
+        Returns the upper bound of the bucket that contains the value at the
+        quantile q, or None if there are no values.
+        '''
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS, self.bucket_counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return BUCKETS[-1]
+class MemorySink(Sink):
+    '''
+    A thread-safe sink that keeps a Histogram of every span and value and the
+    total of every counter
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Dictionaries from (name, labels) tuples to Histograms and totals
+        self.histograms = {}
+        self.counters = {}
+    def span(self, name, labels, seconds, parents):
+        self.observe(name + "_seconds", labels, seconds)
+    def observe(self, name, labels, value):
+        with self._lock:
+            try:
+                histogram = self.histograms[name, labels]
+            except KeyError:
+                histogram = Histogram()
+                self.histograms[name, labels] = histogram
+            histogram.add(value)
+    def count(self, name, labels, n):
+        with self._lock:
+            self.counters[name, labels] = \
+                self.counters.get((name, labels), 0) + n
+    def take(self):
+        '''
+        Returns everything that was recorded as an object that can be pickled
+        and passed to merge, e.g. in another process, and forgets it.
+        '''
+        with self._lock:
+            histograms = self.histograms
+            counters = self.counters
+            self.histograms = {}
+            self.counters = {}
+        return (
+            {
+                key: (h.bucket_counts, h.count, h.sum)
+                for key, h in histograms.items()
+            },
+            counters
+        )
+    def merge(self, taken):
+        '''
+        Adds what take returned to this sink.
+        '''
+        histograms, counters = taken
+        with self._lock:
+            for key, (bucket_counts, count, total) in histograms.items():
+                try:
+                    histogram = self.histograms[key]
+                except KeyError:
+                    histogram = Histogram()
+                    self.histograms[key] = histogram
+                histogram.merge(bucket_counts, count, total)
+            for key, n in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + n
+    def to_json(self):
+        with self._lock:
+            return {
+                "histograms": [
+                    {
+                        "name": name,
+                        "labels": dict(labels),
+                        "count": h.count,
+                        "sum": h.sum,
+                        "p50": h.quantile(0.5),
+                        "p90": h.quantile(0.9),
+                        "p99": h.quantile(0.99)
+                    }
+                    for (name, labels), h in sorted(self.histograms.items())
+                ],
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": n}
+                    for (name, labels), n in sorted(self.counters.items())
+                ]
+            }
+    def prometheus_text(self, prefix="nyu_"):
+        '''
+        Returns the histograms and counters in the text format of Prometheus.
+        '''
+        def label_text(labels, *extra):
+            parts = [
+                '{}="{}"'.format(
+                    name,
+                    str(value).replace("\\", "\\\\").replace('"', '\\"')
+                )
+                for name, value in labels + extra
+            ]
+            return "{" + ",".join(parts) + "}" if parts else ""
+        lines = []
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+            last_name = None
+            for (name, labels), h in histograms:
+                name = prefix + name
+                if name != last_name:
+                    lines.append("# TYPE {} histogram".format(name))
+                    last_name = name
+                cumulative = 0
+                for bound, n in zip(BUCKETS, h.bucket_counts):
+                    cumulative += n
+                    lines.append("{}_bucket{} {}".format(
+                        name,
+                        label_text(
+                            labels,
+                            ("le", "+Inf" if bound == BUCKETS[-1] else bound)
+                        ),
+                        cumulative
+                    ))
+                lines.append(
+                    "{}_sum{} {}".format(name, label_text(labels), h.sum)
+                )
+                lines.append(
+                    "{}_count{} {}".format(name, label_text(labels), h.count)
+                )
+            for (name, labels), n in counters:
+                name = prefix + name
+                if name != last_name:
+                    lines.append("# TYPE {} counter".format(name))
+                    last_name = name
+                lines.append("{}{} {}".format(name, label_text(labels), n))
+        return "\n".join(lines) + "\n"
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc_info):
+        return False
+_null_span = _NullSpan()
+class Span:
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+    def __enter__(self):
+        try:
+            stack = _local.stack
+        except AttributeError:
+            stack = _local.stack = []
+        self.parents = tuple(stack)
+        stack.append(self.name)
+        self.start = time.perf_counter()
+        return self
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        _local.stack.pop()
+        for sink in sinks:
+            sink.span(self.name, self.labels, seconds, self.parents)
+        return False
+
+def enabled():
+    '''
+    Returns True if anything is being recorded.
+    '''
+    return bool(sinks)
+def add_sink(sink):
+    sinks.append(sink)
+def remove_sink(sink):
+    sinks.remove(sink)
+def span(name, **labels):
+    '''
+    Returns a context manager that records how long its block takes.
+    '''
+    if not sinks:
+        return _null_span
+    return Span(name, tuple(sorted(labels.items())))
+def observe(name, value, **labels):
+    '''
+    Adds a value to a histogram.
+    '''
+    if sinks:
+        labels = tuple(sorted(labels.items()))
+        for sink in sinks:
+            sink.observe(name, labels, value)
+def count(name, n=1, **labels):
+    '''
+    Adds n to a counter.
+    '''
+    if sinks:
+        labels = tuple(sorted(labels.items()))
+        for sink in sinks:
+            sink.count(name, labels, n)
@@ -0,0 +1,512 @@
+#!/usr/bin/env python3
+'''
+This module reads and writes compiled network files. pickle_nyu writes the bus
+schedules to NYU.network, and pickle_walking_static writes the walking times
+to WalkingStatic.network. The agencies load these files instead of the
+pickles when they exist.
+
+A compiled network file is memory-mapped instead of being read. Loading one
+takes almost no time because nothing is decoded until it is used, and
+processes that load the same file share its pages through the page cache. The
+checksum is checked when the file is written, but not when it is loaded,
+because that would read every page. Run network_file.py FILE... to check it
+again.
+
+File layout (all integers are little-endian):
+    magic           8 bytes, MAGIC
+    version         uint32, VERSION
+    kind            uint32, KIND_NYU or KIND_WALKING
+    section count   uint32
+    checksum        uint32, CRC-32 of everything after the section table
+    section table   for each section: its name (16 bytes, padded with NUL),
+                    its offset from the start of the file (uint64), and its
+                    length in bytes (uint64)
+    sections        each one starts at a multiple of 8 bytes
+
+Sections of arrays are arrays of int32 values. A string table is stored in
+two sections: NAME.offsets, which holds the start of every string and the end
+of the last one, and NAME.text, which holds the strings in UTF-8.
+
+Sections of NYU.network:
+    stops           string table of the stop names
+    routes          string table of the route letters
+    schedules       seven values for each schedule: the route, a bit mask of
+                    the days of the week, the number of columns, the number of
+                    rows, the offset of its stops in columns, the offset of its
+                    cells in cells, and a reserved value
+    columns         for each schedule, the stop of each column
+    cells           for each schedule, a matrix of rows by columns. A cell is
+                    -1 if it is blank or else the number of seconds after
+                    midnight times 4, plus 1 for pickup, plus 2 for soft.
+    days.offsets    for each day of the week, the offset of its first schedule
+                    in days, and then the total number of values in days
+    days            the schedules on each day of the week, in order
+    serving.offsets, serving
+                    the same for the schedules that serve each stop
+
+Sections of WalkingStatic.network:
+    stops           string table of the stop names
+    walking         a matrix of stops by stops where each value is the number
+                    of seconds that it takes to walk from one to the other, or
+                    -1 if that is not known
+'''
+import argparse, array, datetime, mmap, os, struct, sys, tempfile, zlib
+from common_nyu import NYUSchedule, NYUTime
+MAGIC = b"ITINNET\0"
+# Increase this number whenever the layout changes. Files with other versions
+# are not loaded.
+VERSION = 1
+KIND_NYU = 1
+KIND_WALKING = 2
+HEADER = struct.Struct("<8sIIII")
+SECTION = struct.Struct("<16sQQ")
+ALIGNMENT = 8
+BLANK = -1
+ROUTE, DAYS, COLUMNS, ROWS, COLUMNS_OFFSET, CELLS_OFFSET, _ = range(7)
+SCHEDULE_FIELDS = 7
+
+class NetworkFileError(Exception):
+    '''
+    This exception is raised when a compiled network file is damaged, was
+    written by a different version of this module, or is of the wrong kind.
+    '''
+
+def int_array(values):
+    result = array.array("i", values)
+    if sys.byteorder != "little":
+        result.byteswap()
+    return result.tobytes()
+def string_sections(name, strings):
+    '''
+    Returns a dictionary of the two sections of a string table.
+    '''
+    offsets = [0]
+    text = bytearray()
+    for s in strings:
+        text += s.encode("UTF-8")
+        offsets.append(len(text))
+    return {name + ".offsets": int_array(offsets), name + ".text": bytes(text)}
+def write(path, kind, sections):
+    '''
+    Writes a compiled network file. The file is replaced atomically, so that
+    processes that are reading the old file are not affected.
+
+    Arguments:
+        path: the path of the file
+        kind: KIND_NYU or KIND_WALKING
+        sections: a dictionary from section names to bytes
+    '''
+    names = sorted(sections)
+    for name in names:
+        if len(name.encode("UTF-8")) > 16:
+            raise ValueError("The section name " + name + " is too long.")
+    start = HEADER.size + SECTION.size * len(names)
+    body = bytearray()
+    table = bytearray()
+    for name in names:
+        body += bytes(-(start + len(body)) % ALIGNMENT)
+        table += SECTION.pack(
+            name.encode("UTF-8"),
+            start + len(body),
+            len(sections[name])
+        )
+        body += sections[name]
+    checksum = zlib.crc32(body)
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(
+        dir=directory,
+        suffix=".tmp",
+        delete=False
+    ) as f:
+        f.write(HEADER.pack(MAGIC, VERSION, kind, len(names), checksum))
+        f.write(table)
+        f.write(body)
+    # Read the file back, so that a file that was not written completely,
+    # e.g. because the disk is full, never replaces a good one.
+    try:
+        NetworkFile(f.name, kind, verify=True).close()
+    except BaseException:
+        os.remove(f.name)
+        raise
+    os.replace(f.name, path)
+def verify(path):
+    '''
+    Checks the header and the checksum of a compiled network file of any
+    kind. NetworkFileError is raised if the file is not usable, and OSError is
+    raised if it cannot be opened.
+    '''
+    with open(path, "rb") as f:
+        header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise NetworkFileError("The file is too short.")
+    NetworkFile(path, HEADER.unpack(header)[2], verify=True).close()
+
+class NetworkFile:
+    '''
+    A memory-mapped compiled network file.
+    '''
+    def __init__(self, path, kind, verify=False):
+        '''
+        Opens the file and checks its header. If verify is True, the checksum
+        is also checked, which reads the whole file once.
+
+        NetworkFileError is raised if the file is not usable, and OSError is
+        raised if it cannot be opened.
+        '''
+        with open(path, "rb") as f:
+            try:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise NetworkFileError("The file is empty.")
+        self._view = memoryview(self._mmap)
+        if len(self._view) < HEADER.size:
+            raise NetworkFileError("The file is too short.")
+        magic, version, file_kind, count, checksum = \
+            HEADER.unpack_from(self._view)
+        if magic != MAGIC:
+            raise NetworkFileError("This is not a compiled network file.")
+        if version != VERSION:
+            raise NetworkFileError(
+                "The file has version {}, but version {} is needed. Build it "
+                "again.".format(version, VERSION)
+            )
+        if file_kind != kind:
+            raise NetworkFileError("The file contains the wrong network.")
+        start = HEADER.size + SECTION.size * count
+        if verify and zlib.crc32(self._view[start:]) != checksum:
+            raise NetworkFileError("The file is damaged.")
+        self._sections = {}
+        for i in range(count):
+            name, offset, length = SECTION.unpack_from(
+                self._view,
+                HEADER.size + SECTION.size * i
+            )
+            if offset + length > len(self._view):
+                raise NetworkFileError("The file is damaged.")
+            self._sections[name.rstrip(b"\0").decode("UTF-8")] = \
+                (offset, length)
+    def close(self):
+        '''
+        Unmaps the file. Sections that were returned must not be used
+        anymore.
+        '''
+        self._view.release()
+        self._mmap.close()
+    def bytes(self, name):
+        '''
+        Returns a memoryview of the section with the given name.
+        '''
+        try:
+            offset, length = self._sections[name]
+        except KeyError:
+            raise NetworkFileError("The file has no " + name + " section.")
+        return self._view[offset:offset + length]
+    def ints(self, name):
+        '''
+        Returns the section with the given name as a sequence of integers.
+        '''
+        view = self.bytes(name)
+        if sys.byteorder == "little":
+            return view.cast("i")
+        result = array.array("i")
+        result.frombytes(view)
+        result.byteswap()
+        return result
+    def strings(self, name):
+        return StringTable(
+            self.ints(name + ".offsets"),
+            self.bytes(name + ".text")
+        )
+
+class StringTable:
+    '''
+    A sequence of the strings in a string table. Strings are decoded when
+    they are used.
+    '''
+    def __init__(self, offsets, text):
+        self._offsets = offsets
+        self._text = text
+        self._strings = [None] * (len(offsets) - 1)
+        self._ids = None
+    def __len__(self):
+        return len(self._strings)
+    def __getitem__(self, i):
+        s = self._strings[i]
+        if s is None:
+            s = str(
+                self._text[self._offsets[i]:self._offsets[i + 1]],
+                "UTF-8"
+            )
+            self._strings[i] = s
+        return s
+    def id(self, s):
+        '''
+        Returns the index of the string. KeyError is raised if it is not in
+        the table.
+        '''
+        if self._ids is None:
+            self._ids = {self[i]: i for i in range(len(self))}
+        return self._ids[s]
+
+def write_nyu(path, schedule_by_day):
+    '''
+    Writes the schedules in the format that pickle_nyu pickles, i.e. a list of
+    the NYUSchedule objects on each day of the week, to a compiled network
+    file.
+    '''
+    schedules = []
+    schedule_ids = {}
+    day_schedules = []
+    for schedules_on_day in schedule_by_day:
+        ids = []
+        for schedule in schedules_on_day:
+            if id(schedule) not in schedule_ids:
+                schedule_ids[id(schedule)] = len(schedules)
+                schedules.append(schedule)
+            ids.append(schedule_ids[id(schedule)])
+        day_schedules.append(ids)
+    stop_names = sorted({h for s in schedules for h in s.header_row})
+    stop_ids = {name: i for i, name in enumerate(stop_names)}
+    route_names = sorted({s.route for s in schedules})
+    route_ids = {name: i for i, name in enumerate(route_names)}
+    table = []
+    columns = []
+    cells = []
+    stop_schedules = [[] for name in stop_names]
+    for i, schedule in enumerate(schedules):
+        width = len(schedule.header_row)
+        table.extend((
+            route_ids[schedule.route],
+            sum(1 << dow for dow in schedule.days_of_week),
+            width,
+            len(schedule.other_rows),
+            len(columns),
+            len(cells),
+            0
+        ))
+        columns.extend(stop_ids[h] for h in schedule.header_row)
+        for stop in sorted({stop_ids[h] for h in schedule.header_row}):
+            stop_schedules[stop].append(i)
+        for row in schedule.other_rows:
+            if len(row) > width:
+                raise ValueError("A row is longer than the header row.")
+            for cell in row:
+                if cell is None:
+                    cells.append(BLANK)
+                else:
+                    seconds = cell.time // datetime.timedelta(seconds=1)
+                    cells.append(
+                        seconds * 4 + (1 if cell.pickup else 0) +
+                        (2 if cell.soft else 0)
+                    )
+            cells.extend([BLANK] * (width - len(row)))
+    sections = {}
+    sections.update(string_sections("stops", stop_names))
+    sections.update(string_sections("routes", route_names))
+    sections["schedules"] = int_array(table)
+    sections["columns"] = int_array(columns)
+    sections["cells"] = int_array(cells)
+    for name, lists in (
+        ("days", day_schedules),
+        ("serving", stop_schedules)
+    ):
+        offsets = [0]
+        for l in lists:
+            offsets.append(offsets[-1] + len(l))
+        sections[name + ".offsets"] = int_array(offsets)
+        sections[name] = int_array(v for l in lists for v in l)
+    write(path, KIND_NYU, sections)
+def cell_to_nyu_time(value):
+    return NYUTime(
+        datetime.timedelta(seconds=value >> 2),
+        bool(value & 1),
+        bool(value & 2)
+    )
+class NYUNetwork:
+    '''
+    The bus schedules in a compiled network file. Schedules are turned into
+    NYUSchedule objects when they are first used.
+    '''
+    def __init__(self, path, verify=False):
+        self.file = NetworkFile(path, KIND_NYU, verify)
+        self.stops = self.file.strings("stops")
+        self.routes = self.file.strings("routes")
+        self._table = self.file.ints("schedules")
+        self._columns = self.file.ints("columns")
+        self._cells = self.file.ints("cells")
+        self._days_offsets = self.file.ints("days.offsets")
+        self._days = self.file.ints("days")
+        self._stop_offsets = self.file.ints("serving.offsets")
+        self._stop_schedules = self.file.ints("serving")
+        self._schedules = [None] * (len(self._table) // SCHEDULE_FIELDS)
+        self._serving = {}
+        self.schedule_by_day = ScheduleDays(self)
+    def schedule(self, i):
+        '''
+        Returns the schedule with the given index as an NYUSchedule.
+        '''
+        schedule = self._schedules[i]
+        if schedule is None:
+            fields = self._table[i * SCHEDULE_FIELDS:(i + 1) * SCHEDULE_FIELDS]
+            width = fields[COLUMNS]
+            header_row = [
+                self.stops[stop] for stop in self._columns[
+                    fields[COLUMNS_OFFSET]:fields[COLUMNS_OFFSET] + width
+                ]
+            ]
+            other_rows = []
+            offset = fields[CELLS_OFFSET]
+            for r in range(fields[ROWS]):
+                row = [
+                    None if value == BLANK else cell_to_nyu_time(value)
+                    for value in self._cells[offset:offset + width]
+                ]
+                while row and row[-1] is None:
+                    row.pop()
+                other_rows.append(row)
+                offset += width
+            schedule = NYUSchedule(
+                self.routes[fields[ROUTE]],
+                header_row,
+                other_rows,
+                tuple(dow for dow in range(7) if fields[DAYS] >> dow & 1)
+            )
+            schedule.index_header()
+            self._schedules[i] = schedule
+        return schedule
+    def schedule_ids_on(self, dow):
+        return self._days[self._days_offsets[dow]:self._days_offsets[dow + 1]]
+    def schedules_serving(self, dow, stop):
+        '''
+        Returns a list of the schedules on the given day of the week that
+        include the given stop, in the same order as in schedule_by_day.
+        '''
+        key = (dow, stop)
+        try:
+            return self._serving[key]
+        except KeyError:
+            pass
+        try:
+            stop_id = self.stops.id(stop)
+        except KeyError:
+            result = []
+        else:
+            serving = set(
+                self._stop_schedules[
+                    self._stop_offsets[stop_id]:self._stop_offsets[stop_id + 1]
+                ]
+            )
+            result = [
+                self.schedule(i)
+                for i in self.schedule_ids_on(dow)
+                if i in serving
+            ]
+        self._serving[key] = result
+        return result
+class ScheduleDays:
+    '''
+    A sequence of the lists of schedules on each day of the week, like the
+    list that pickle_nyu pickles
+    '''
+    def __init__(self, network):
+        self._network = network
+        self._days = [None] * 7
+    def __len__(self):
+        return 7
+    def __getitem__(self, dow):
+        schedules = self._days[dow]
+        if schedules is None:
+            schedules = [
+                self._network.schedule(i)
+                for i in self._network.schedule_ids_on(dow)
+            ]
+            self._days[dow] = schedules
+        return schedules
+
+def write_walking(path, walking_times):
+    '''
+    Writes the walking times in the format that pickle_walking_static pickles,
+    i.e. a dictionary from (from, to) tuples to (seconds, filename) tuples, to
+    a compiled network file. The filenames are not included.
+    '''
+    stop_names = sorted({name for pair in walking_times for name in pair})
+    stop_ids = {name: i for i, name in enumerate(stop_names)}
+    matrix = array.array("i", [BLANK]) * (len(stop_names) ** 2)
+    for (from_name, to_name), (seconds, filename) in walking_times.items():
+        matrix[stop_ids[from_name] * len(stop_names) + stop_ids[to_name]] = \
+            round(seconds)
+    if sys.byteorder != "little":
+        matrix.byteswap()
+    sections = string_sections("stops", stop_names)
+    sections["walking"] = matrix.tobytes()
+    write(path, KIND_WALKING, sections)
+class WalkingNetwork:
+    '''
+    The walking times in a compiled network file
+    '''
+    def __init__(self, path, verify=False):
+        self.file = NetworkFile(path, KIND_WALKING, verify)
+        self.stops = self.file.strings("stops")
+        self.matrix = self.file.ints("walking")
+        self.walking_times = WalkingTimes(self)
+    def seconds(self, from_node, to_node):
+        '''
+        Returns the number of seconds that it takes to walk from one stop to
+        another. KeyError is raised if that is not known.
+        '''
+        value = self.matrix[
+            self.stops.id(from_node) * len(self.stops) +
+            self.stops.id(to_node)
+        ]
+        if value == BLANK:
+            raise KeyError((from_node, to_node))
+        return value
+class WalkingTimes:
+    '''
+    A read-only mapping that looks like the dictionary that
+    pickle_walking_static pickles, except that the filenames are None
+    '''
+    def __init__(self, network):
+        self._network = network
+    def __getitem__(self, key):
+        return self._network.seconds(*key), None
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    def items(self):
+        '''
+        Yields the ((from, to), (seconds, None)) tuples of all the known
+        walking times, which reads the whole matrix.
+        '''
+        network = self._network
+        count = len(network.stops)
+        for i, seconds in enumerate(network.matrix):
+            if seconds != BLANK:
+                yield (
+                    (network.stops[i // count], network.stops[i % count]),
+                    (seconds, None)
+                )
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(
+        description="Checks the checksums of compiled network files."
+    )
+    arg_parser.add_argument("file", nargs="+")
+    failed = False
+    for path in arg_parser.parse_args().file:
+        try:
+            verify(path)
+        except (OSError, NetworkFileError) as e:
+            print(path + ":", e)
+            failed = True
+        else:
+            print(path + ": OK")
+    sys.exit(1 if failed else 0)
@@ -5,41 +5,39 @@
 # - Blank cells in PDFs are still blank in the output
 # - No words like "Arrival," "Arrive," "Depart," or "Departure" in titles
 # - Randomly select some schedules, compare output to original PDF
-import cgi, collections, copy, csv, datetime, dateutil.parser, io, itertools, \
-    multiprocessing.pool, os, pickle, re, requests, subprocess, sys, \
-    urllib.parse
+import argparse, collections, copy, csv, datetime, dateutil.parser, hashlib, \
+    heapq, html, io, itertools, json, multiprocessing.pool, operator, os, \
+    pickle, re, requests, requests.adapters, subprocess, sys, tempfile, \
+    threading, urllib.parse
 from common import NODE_LIST_TXT, file_in_this_dir
-from common_nyu import DAYS_OF_WEEK, NYU_PICKLE, NYUSchedule, NYUTime
-import pickle_nyu_unwritten_times
+from common_nyu import ABBREVIATION_EXPANSION, DAYS_OF_WEEK, NYU_NETWORK, \
+    NYU_PICKLE, NYUSchedule, NYUTime
+import metrics, network_file, pickle_nyu_unwritten_times
 NYU_HTML = file_in_this_dir("NYU.html")
 SCHEDULES = file_in_this_dir("NYU Bus Schedules.csv")
 REPLACEMENTS = file_in_this_dir("NYU Bus Stop Replacements.csv")
+# Exported sheets are kept here, one file for each sheet, so that they only
+# need to be downloaded again when they change.
+SHEET_CACHE = file_in_this_dir("NYU Sheet Cache")
+SHEET_EXPORT_URL = \
+    "https://spreadsheets.google.com/feeds/download/spreadsheets/Export"
+# This is the number of sheets that are downloaded at the same time. It is also
+# the number of connections that the session keeps open.
+MAX_CONCURRENT_DOWNLOADS = 8
+# No download may take longer than this many seconds.
+SHEET_DOWNLOAD_TIMEOUT = 60.0
+# Parsed sheets and built routes are kept here so that they are not parsed or
+# built again if their inputs have not changed.
+BUILD_CACHE = file_in_this_dir("NYU Build Cache")
+# Increase this number whenever a change to this file changes how sheets are
+# parsed or how routes are built. This invalidates everything in the cache.
+BUILD_CACHE_VERSION = 3
 IGNORED_TIMES = {
     # Cells with these exact times will be treated as blank.
     datetime.time(0, 0),
     datetime.time(0, 4),
     datetime.time(0, 7),
 }
-ABBREVIATION_EXPANSION = {
-    "&": "At",
-    "at": "At",
-    "N": "North",
-    "E": "East",
-    "S": "South",
-    "W": "West",
-    "NB": "Northbound",
-    "EB": "Eastbound",
-    "SB": "Southbound",
-    "WB": "Westbound",
-    "Ave": "Avenue",
-    "St": "Street",
-    "street": "Street",
-    "Pl": "Place",
-    "Metrotech": "MetroTech",
-    "First": "1st",
-    "Second": "2nd",
-    "Third": "3rd",
-}
 DIRECTIONAL_WORDS = {
     "Northbound",
     "Southbound",
@@ -69,12 +67,30 @@ DAYS_OF_WEEK_REVERSE = {
     "Satur": 5,
 }
 WHITESPACE = re.compile(r"\s+")
+# These are the formats of times that NYU uses, e.g. "7:45 AM", "7 PM",
+# "12:05a" and "19:45". Cells in other formats are parsed by dateutil.
+TIME_OF_DAY = re.compile(
+    r"(\d{1,2})(?::(\d\d)(?::(\d\d))?)? ?(?:([AaPp])\.?(?:[Mm]\.?)?)?"
+)
 FILENAME = re.compile(
     r"Route (\w) Schedules? \- ([A-Z][a-z]*)(\-([A-Z][a-z]*))?\.(csv|CSV)"
 )
 ONE_DAY = datetime.timedelta(days=1)
 BLANK_ROW = itertools.repeat("")
+# Sheets are parsed in worker processes. These variables are set once in each
+# worker by init_parse_worker and are not changed while sheets are parsed.
 header_replacements = {}
+# Known driving times; see pickle_nyu_unwritten_times.snapshot
+driving_times = None
+# Parsed times by the text of the cell. None means that the text is not a time.
+_parsed_times = {}
+# The texts in _parsed_times that were parsed by dateutil
+_parsed_times_fallbacks = set()
+# The number of time cells that had to be parsed by dateutil, by the text of
+# the cell, since the last sheet began to be parsed
+time_parse_fallbacks = collections.Counter()
+_session = None
+_session_lock = threading.Lock()
 
 def any_multi(iterable, at_least=1):
     '''
@@ -159,7 +175,113 @@ def find_column(row, needle):
     result = len(row)
     row.append(needle)
     return result
-def parse_schedule_row(header_row, row, show_parse_error=True):
+def content_hash(*parts):
+    '''
+    Returns the hexadecimal SHA-256 digest of the given strings.
+    '''
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode("UTF-8"))
+        # Separate the parts so that ("ab", "c") and ("a", "bc") differ.
+        h.update(b"\0")
+    return h.hexdigest()
+def cache_path(kind, key):
+    return os.path.join(BUILD_CACHE, kind, key + ".pickle")
+def cache_load(kind, key):
+    '''
+    Returns the object that is stored in the build cache under the given kind
+    and key, or None if there is no such object.
+    '''
+    try:
+        with open(cache_path(kind, key), "rb") as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+def cache_store(kind, key, value):
+    '''
+    Stores the object in the build cache under the given kind and key.
+    '''
+    path = cache_path(kind, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temporary file first so that an interrupted build never leaves
+    # a truncated entry behind.
+    with tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(path),
+        suffix=".tmp",
+        delete=False
+    ) as f:
+        pickle.dump(value, f)
+    os.replace(f.name, path)
+def cache_prune(kind, keys):
+    '''
+    Deletes the objects of the given kind whose keys are not in keys.
+    '''
+    directory = os.path.join(BUILD_CACHE, kind)
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return
+    for name in names:
+        key, extension = os.path.splitext(name)
+        if extension == ".pickle" and key not in keys:
+            os.remove(os.path.join(directory, name))
+def get_minutes(last_header, curr_header, lookups=None):
+    '''
+    Returns the driving time in minutes from last_header to curr_header, or
+    None if it is not known. If lookups is a dictionary, the result is also
+    stored in it, so that the process that asked for the sheet to be parsed can
+    find out which driving times are missing.
+    '''
+    global driving_times
+    if driving_times is None:
+        driving_times = pickle_nyu_unwritten_times.snapshot()
+    minutes = driving_times.get((last_header, curr_header))
+    if lookups is not None:
+        lookups[(last_header, curr_header)] = minutes
+    return minutes
+def parse_time_uncached(text):
+    '''
+    Returns the datetime.time that the text represents, or None if it does not
+    represent a time. Times in the formats in TIME_OF_DAY are parsed directly;
+    other text is parsed by dateutil, which is much slower.
+    '''
+    match = TIME_OF_DAY.fullmatch(text)
+    if match is not None:
+        hour, minute, second, meridiem = match.groups()
+        hour = int(hour)
+        minute = int(minute or 0)
+        second = int(second or 0)
+        if minute < 60 and second < 60:
+            if meridiem is not None:
+                if 1 <= hour <= 12:
+                    hour %= 12
+                    if meridiem in "Pp":
+                        hour += 12
+                    return datetime.time(hour, minute, second)
+            elif match.group(2) is not None and hour < 24:
+                return datetime.time(hour, minute, second)
+    # This is not a format that we know. Maybe dateutil knows it. Note that
+    # dateutil understands things that are not times, like dates, and returns
+    # midnight for them.
+    _parsed_times_fallbacks.add(text)
+    try:
+        return dateutil.parser.parse(text).time()
+    except ValueError:
+        return None
+def parse_time(text):
+    '''
+    Returns the datetime.time that the text represents. The result is cached.
+    If the text does not represent a time, ValueError is raised.
+    '''
+    try:
+        result = _parsed_times[text]
+    except KeyError:
+        result = parse_time_uncached(text)
+        _parsed_times[text] = result
+    if result is None:
+        raise ValueError("Not a time: " + repr(text))
+    return result
+def parse_schedule_row(header_row, row, show_parse_error=True, lookups=None):
     '''
     This function parses a single row of strings from the schedule table into
     datetime.timedelta objects. It is assumed that the length of header_row is
@@ -170,6 +292,8 @@ def parse_schedule_row(header_row, row, show_parse_error=True):
     Arguments:
         header_row: an iterable representing the stop names
         row: an iterable representing the row of strings to parse
+        lookups: if a dictionary, every driving time that is looked up is
+            stored in it; see get_minutes
     Returns:
         A list where every item is either None or a datetime.timedelta object.
         None means that the bus does not stop at that stop.
@@ -187,10 +311,7 @@ def parse_schedule_row(header_row, row, show_parse_error=True):
             # Check for strings that represent times but that are not times.
             if v == "Soft Stop":
                 if last_delta is not None:
-                    minutes = pickle_nyu_unwritten_times.get_minutes(
-                        last_header,
-                        h
-                    )
+                    minutes = get_minutes(last_header, h, lookups)
                     if minutes is not None:
                         result_cell = NYUTime(
                             last_delta.time +
@@ -203,10 +324,7 @@ def parse_schedule_row(header_row, row, show_parse_error=True):
             elif v.startswith("Continues to "):
                 if last_delta is not None:
                     destination = clean_header(v[13:])
-                    minutes = pickle_nyu_unwritten_times.get_minutes(
-                        last_header,
-                        destination
-                    )
+                    minutes = get_minutes(last_header, destination, lookups)
                     if minutes is not None:
                         result_cell = NYUTime(
                             last_delta.time +
@@ -234,13 +352,16 @@ def parse_schedule_row(header_row, row, show_parse_error=True):
                     # We have checked for all know strings that represent times
                     # but that are not actually times. We will now parse the
                     # string as a time.
-                    parsed = dateutil.parser.parse(v)
+                    parsed = parse_time(v)
                 except ValueError:
                     if show_parse_error:
                         print("Unknown time value:", repr(v))
-                else:
-                    # Get just the time.
-                    parsed = parsed.time()
+                    parsed = None
+                if show_parse_error and v in _parsed_times_fallbacks:
+                    # Keep track of cells in formats that parse_time does not
+                    # know so that they can be added.
+                    time_parse_fallbacks[v] += 1
+                if parsed is not None:
                     if parsed not in IGNORED_TIMES:
                         # Convert this to the timedelta after midnight.
                         parsed = datetime.datetime.combine(
@@ -262,20 +383,123 @@ def parse_schedule_row(header_row, row, show_parse_error=True):
     while result_row and result_row[-1] is None:
         result_row.pop()
     return result_row, via_other_route
-def read_google_sheet(workbook_key, sheet_gid):
-    r = requests.get(
-        "https://spreadsheets.google.com/feeds/download/spreadsheets/Export",
-        params={"key": workbook_key, "gid": sheet_gid, "exportFormat": "csv"}
+def get_session():
+    '''
+    Returns a requests.Session that is shared by all downloads of sheets so
+    that connections are reused. It is created on first use.
+    '''
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=MAX_CONCURRENT_DOWNLOADS
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+    return _session
+def sheet_cache_path(workbook_key, sheet_gid):
+    return os.path.join(
+        SHEET_CACHE,
+        urllib.parse.quote(workbook_key, safe="") + " " +
+        urllib.parse.quote(sheet_gid, safe="") + ".json"
     )
-    if r.ok:
-        filename = None
-        for part in r.headers["Content-Disposition"].split(";"):
-            part = part.strip()
-            if part.startswith("filename*=UTF-8''"):
-                filename =  urllib.parse.unquote(part[17:])
-        return io.StringIO(r.text), filename
-    return None, None
-def read_csv_io(csv_io):
+def read_cached_sheet(workbook_key, sheet_gid):
+    '''
+    Returns the cached export of a sheet as a dictionary with the keys "text",
+    "filename", "etag" and "last_modified", or None if it is not cached.
+    '''
+    try:
+        with open(
+            sheet_cache_path(workbook_key, sheet_gid),
+            "r",
+            encoding="UTF-8"
+        ) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+def write_cached_sheet(workbook_key, sheet_gid, cached):
+    os.makedirs(SHEET_CACHE, exist_ok=True)
+    path = sheet_cache_path(workbook_key, sheet_gid)
+    # Write to a temporary file first so that an interrupted download never
+    # leaves a truncated file behind.
+    with tempfile.NamedTemporaryFile(
+        "w",
+        encoding="UTF-8",
+        dir=SHEET_CACHE,
+        suffix=".tmp",
+        delete=False
+    ) as f:
+        json.dump(cached, f)
+    os.replace(f.name, path)
+def read_google_sheet(workbook_key, sheet_gid, offline=False):
+    '''
+    Downloads a sheet in CSV format. The download is cached. If the cached copy
+    has an ETag or a last modified date, the request is conditional, and the
+    sheet is only sent again if it changed. If the download fails, the cached
+    copy is used.
+
+    Arguments:
+        workbook_key: the key of the Google Sheets workbook
+        sheet_gid: the GID of the sheet in the workbook
+        offline: if True, only the cached copy is used
+    Returns:
+        A tuple of a file-like object with the CSV text and the filename, or
+        (None, None) if the sheet is neither available nor cached.
+    '''
+    cached = read_cached_sheet(workbook_key, sheet_gid)
+    if not offline:
+        headers = {}
+        if cached is not None:
+            if cached["etag"]:
+                headers["If-None-Match"] = cached["etag"]
+            if cached["last_modified"]:
+                headers["If-Modified-Since"] = cached["last_modified"]
+        try:
+            r = get_session().get(
+                SHEET_EXPORT_URL,
+                params={
+                    "key": workbook_key,
+                    "gid": sheet_gid,
+                    "exportFormat": "csv"
+                },
+                headers=headers,
+                timeout=SHEET_DOWNLOAD_TIMEOUT
+            )
+        except IOError as e:
+            error = e
+        else:
+            error = None
+            if r.status_code == 304 and cached is not None:
+                # The sheet has not changed.
+                pass
+            elif r.ok:
+                filename = None
+                for part in r.headers["Content-Disposition"].split(";"):
+                    part = part.strip()
+                    if part.startswith("filename*=UTF-8''"):
+                        filename =  urllib.parse.unquote(part[17:])
+                cached = {
+                    "text": r.text,
+                    "filename": filename,
+                    "etag": r.headers.get("ETag"),
+                    "last_modified": r.headers.get("Last-Modified")
+                }
+                write_cached_sheet(workbook_key, sheet_gid, cached)
+            else:
+                error = "HTTP {}".format(r.status_code)
+        if error is not None:
+            print(
+                "Cannot download sheet ", sheet_gid, ": ", error,
+                "" if cached is None else " (using the cached copy)",
+                sep=""
+            )
+    if cached is None:
+        return None, None
+    return io.StringIO(cached["text"]), cached["filename"]
+def read_csv_io(csv_io, lookups=None):
     header_row = []
     other_rows = []
     other_routes = collections.defaultdict(list)
@@ -314,7 +538,7 @@ def read_csv_io(csv_io):
             # Skip rows that have only one non-empty cell.
             if any_multi(row, 2):
                 result_row, via_other_route = \
-                    parse_schedule_row(header_row, row)
+                    parse_schedule_row(header_row, row, lookups=lookups)
                 if result_row:
                     if via_other_route:
                         other_routes[via_other_route].append(result_row)
@@ -340,117 +564,192 @@ def read_csv_io(csv_io):
                 if i < len(row):
                     row.pop(i)
     return header_row, other_rows, other_routes
-def main():
-    # Read the table of schedules.
-    schedules = []
-    try:
-        with open(SCHEDULES, "r", newline="", encoding="UTF-8") as f:
-            for i, row in enumerate(csv.DictReader(f), start=1):
-                try:
-                    schedules.append({
-                        "workbook_key": row["Key"],
-                        "sheet_gid": row["GID"],
-                        "filename_override": row["Filename Override"]
-                    })
-                except KeyError as e:
-                    print(
-                        "The table of schedules is missing this column:",
-                        repr(e.args[0])
-                    )
-                    return
-                except ValueError as e:
-                    print("Error on line ", i, ": ", e, sep="")
-    except OSError as e:
-        print("Cannot open table of schedules:", e)
-    # Read the table of string replacements for the header row.
-    try:
-        with open(REPLACEMENTS, "r", newline="", encoding="UTF-8") as f:
-            for row in csv.DictReader(f):
-                try:
-                    header_replacements[row["Find"]] = row["Replace"]
-                except KeyError as e:
-                    print(
-                        "The table of header string replacements is missing "
-                        "this column:",
-                        repr(e.args[0])
-                    )
-                    return
-    except OSError as e:
-        print("Cannot open table of header string replacements", e)
-    # Save a list of nodes for finding walking times later.
-    node_list = set()
-    # Keep track of rows that need to be added to other routes.
-    other_routes_all = []
-    # Organize schedules by the day of the week.
-    schedule_by_day = [[] for i in range(7)]
-    # Parse the schedules.
-    schedules_parsed = []
-    with multiprocessing.pool.ThreadPool() as pool:
-        # Process every schedule.
-        print(
-            "It is assumed that all schedules are sorted from earliest to "
-            "latest."
+def init_parse_worker(replacements, known_driving_times):
+    '''
+    Prepares a worker process to parse sheets with parse_sheet.
+    '''
+    global driving_times
+    header_replacements.clear()
+    header_replacements.update(replacements)
+    driving_times = known_driving_times
+def parse_sheet(csv_text, replacements_hash):
+    '''
+    Parses the text of an exported sheet with read_csv_io. The result is cached
+    by the content of the sheet, so a sheet that has not changed is not parsed
+    again.
+
+    This function only reads header_replacements and driving_times, so sheets
+    can be parsed in parallel in worker processes. Anything that the calling
+    process needs to know is returned.
+
+    Arguments:
+        csv_text: the sheet in CSV format
+        replacements_hash: a hash of header_replacements
+    Returns:
+        A tuple of:
+        - the key under which the result is cached, which only depends on
+          the sheet and header_replacements
+        - a key that identifies the result, which also depends on the
+          driving times that were looked up
+        - a dictionary of the driving times that were looked up, where None
+          means that the driving time is not known
+        - a collections.Counter of the cells that were parsed by dateutil
+        - the header row, the other rows, and the rows for other routes
+    '''
+    key = content_hash(str(BUILD_CACHE_VERSION), replacements_hash, csv_text)
+    def result_key(lookups):
+        # The driving times are part of the key, so that the routes and the
+        # output files are built again when one of them is filled in.
+        return content_hash(
+            key,
+            *(repr(item) for item in sorted(lookups.items()))
         )
-        def callback(schedule):
-            print("Processing:", schedule)
-            filename_override = schedule.pop("filename_override")
-            csv_io, filename = read_google_sheet(**schedule)
-            header_row, other_rows, other_routes = read_csv_io(csv_io)
-            if filename_override:
-                filename = filename_override
-            return filename, header_row, other_rows, other_routes
-        for filename, header_row, other_rows, other_routes in pool.imap(
-            callback,
-            schedules
+    cached = cache_load("parsed", key)
+    if cached is not None:
+        lookups, fallbacks, result = cached
+        # The times in the result depend on the driving times that were looked
+        # up while parsing. If any of them changed, parse the sheet again.
+        if all(
+            get_minutes(last_header, curr_header) == minutes
+            for (last_header, curr_header), minutes in lookups.items()
         ):
-            print("Completed: ", filename)
-            # Get the route letter and days of the week from the filename.
-            match = FILENAME.fullmatch(filename)
-            if match is None:
-                print("Bad filename format:", repr(filename))
+            return (key, result_key(lookups), lookups, fallbacks) + result
+    lookups = {}
+    time_parse_fallbacks.clear()
+    result = read_csv_io(io.StringIO(csv_text), lookups)
+    fallbacks = time_parse_fallbacks.copy()
+    cache_store("parsed", key, (lookups, fallbacks, result))
+    return (key, result_key(lookups), lookups, fallbacks) + result
+def parse_filename(filename):
+    '''
+    Gets the route letter and days of the week from the filename of a sheet.
+    Returns a (route, days_of_week) tuple, or None if the filename does not
+    have the expected format.
+    '''
+    match = FILENAME.fullmatch(filename)
+    if match is None:
+        print("Bad filename format:", repr(filename))
+        return None
+    route, dow_start, _, dow_end, _ = match.groups()
+    try:
+        if dow_end is None:
+            if dow_start == "Weekend" or dow_start == "Weekends":
+                days_of_week = (5, 6)
+            elif dow_start == "Weekday" or dow_start == "Weekdays":
+                days_of_week = range(0, 5)
             else:
-                route, dow_start, _, dow_end, _ = match.groups()
-                try:
-                    if dow_end is None:
-                        if dow_start == "Weekend" or dow_start == "Weekends":
-                            days_of_week = (5, 6)
-                        elif dow_start == "Weekday" or dow_start == "Weekdays":
-                            days_of_week = range(0, 5)
-                        else:
-                            days_of_week = (DAYS_OF_WEEK_REVERSE[dow_start],)
-                    else:
-                        days_of_week = range(
-                            DAYS_OF_WEEK_REVERSE[dow_start],
-                            DAYS_OF_WEEK_REVERSE[dow_end] + 1
-                        )
-                except KeyError as e:
-                    print("Unknown day of week:", repr(e.args[0]))
+                days_of_week = (DAYS_OF_WEEK_REVERSE[dow_start],)
+        else:
+            days_of_week = range(
+                DAYS_OF_WEEK_REVERSE[dow_start],
+                DAYS_OF_WEEK_REVERSE[dow_end] + 1
+            )
+    except KeyError as e:
+        print("Unknown day of week:", repr(e.args[0]))
+        return None
+    return route, days_of_week
+def time_key(nyu_time):
+    '''
+    Returns a hashable value that is equal for equal NYUTime objects.
+    '''
+    return nyu_time.time, nyu_time.pickup, nyu_time.soft
+class RowIndex:
+    '''
+    An index of the rows of a schedule. For a row of another schedule, it finds
+    all rows of this schedule for which one_equal_others_one_true would return
+    True at once, without looking at each row.
+
+    Sets of rows are represented as integers in which bit i is set if the set
+    contains row i. The rows must not be changed while the index is in use.
+    '''
+    def __init__(self, rows):
+        self.all = (1 << len(rows)) - 1
+        # The rows by the column and the time in that column
+        self.times = collections.defaultdict(int)
+        # The rows by the column that is None in them
+        self.blanks = collections.defaultdict(int)
+        # The rows by the column that is truthy in them
+        self.truthy = collections.defaultdict(int)
+        by_length = collections.defaultdict(int)
+        for i, row in enumerate(rows):
+            bit = 1 << i
+            by_length[len(row)] |= bit
+            for column, value in enumerate(row):
+                if value is None:
+                    self.blanks[column] |= bit
                 else:
-                    if days_of_week:
-                        # Create the schedule object.
-                        schedule = NYUSchedule(
-                            route,
-                            header_row,
-                            other_rows,
-                            days_of_week
-                        )
-                        schedules_parsed.append((filename, schedule))
-                        # Assign it to the specified days of the week.
-                        for dow in days_of_week:
-                            schedule_by_day[dow].append(schedule)
-                        # Store the rows that need to be added to other routes.
-                        for route, rows in other_routes.items():
-                            other_routes_all.append(
-                                NYUSchedule(
-                                    route,
-                                    header_row,
-                                    rows,
-                                    days_of_week
-                                )
-                            )
-            # Save any new nodes for the walking agency.
-            node_list.update(header_row)
-    # Add to other routes the rows that need to be added to other routes.
+                    self.times[(column, time_key(value))] |= bit
+                    if value:
+                        self.truthy[column] |= bit
+        # ended[column] is the set of rows that are not long enough to have
+        # that column.
+        self.ended = list(
+            itertools.accumulate(
+                (
+                    by_length[length]
+                    for length in range(max(by_length, default=0) + 1)
+                ),
+                operator.or_
+            )
+        )
+    def ended_before(self, column):
+        if column < len(self.ended):
+            return self.ended[column]
+        return self.all
+    def matches(self, row, column_indices):
+        '''
+        Returns the set of rows for which this is True:
+            one_equal_others_one_true(
+                row,
+                (
+                    row_index[index] if index < len(row_index) else False
+                    for index in column_indices
+                )
+            )
+        '''
+        # The rows with at least one and at least two equal positions
+        once = 0
+        twice = 0
+        # The rows where a position is not equal but truthy in both rows
+        violated = 0
+        for position, column in enumerate(column_indices):
+            if position < len(row):
+                value = row[position]
+                if value is None:
+                    equal = self.blanks.get(column, 0)
+                else:
+                    equal = self.times.get((column, time_key(value)), 0)
+                    if value:
+                        violated |= self.truthy.get(column, 0) & ~equal
+            else:
+                # one_equal_others_one_true fills the row with False, which
+                # equals the False that stands in for missing columns.
+                equal = self.ended_before(column)
+            twice |= once & equal
+            once |= equal
+        # Positions after the end of column_indices are never equal and are
+        # truthy in at most one row, so they do not matter.
+        return once & ~twice & ~violated
+def find_migrations(schedule_by_day, other_routes_all, indexed=True):
+    '''
+    Finds the rows of the schedules in schedule_by_day that the rows of the
+    schedules in other_routes_all continue. The header rows of the destination
+    schedules are extended with the header rows of the source schedules where
+    necessary.
+
+    Arguments:
+        schedule_by_day: the destination schedules for each day of the week
+        other_routes_all: the source schedules
+        indexed: if True, the destination rows are found with RowIndex.
+            Otherwise, every destination row is checked.
+    Returns:
+        A list of tuples of the source schedule index, the source row index,
+        the destination schedule index, the destination row index, and the
+        destination column of each source column, in ascending order of the
+        source indices
+    '''
+    # The indices of the destination schedules by their IDs
+    row_indices = {}
     migrations = []
     for schedule_source_index, schedule_source in enumerate(other_routes_all):
         # Find rows in the source schedule that can fit into a destination
@@ -484,6 +783,34 @@ def main():
                         # - the time for one stop matches both schedules.
                         # - the times for all other stops are in one schedule
                         #   schedule but not both.
+                        if indexed:
+                            try:
+                                row_index = \
+                                    row_indices[id(schedule_destination)]
+                            except KeyError:
+                                row_index = RowIndex(
+                                    schedule_destination.other_rows
+                                )
+                                row_indices[id(schedule_destination)] = \
+                                    row_index
+                            matches = row_index.matches(
+                                row_source,
+                                column_indices
+                            )
+                            if matches:
+                                # Take the first matching row.
+                                migrations.append(
+                                    (
+                                        schedule_source_index,
+                                        row_source_index,
+                                        schedule_destination_index,
+                                        (matches & -matches).bit_length() - 1,
+                                        column_indices
+                                    )
+                                )
+                                found = True
+                                break
+                            continue
                         for row_destination_index, row_destination in \
                             enumerate(schedule_destination.other_rows):
                             if one_equal_others_one_true(
@@ -518,6 +845,29 @@ def main():
                             break
                     if found:
                         break
+    return migrations
+def migrate_other_routes(schedule_by_day, other_routes_all, check=False):
+    '''
+    Copies the rows of the schedules in other_routes_all into rows of the
+    schedules in schedule_by_day that they continue. Rows that are copied are
+    removed from their schedules in other_routes_all.
+
+    If check is True, the rows are also matched by checking every destination
+    row, and a message is printed if the results differ.
+    '''
+    if check:
+        scanned = copy.deepcopy((schedule_by_day, other_routes_all))
+        migrations_scanned = find_migrations(*scanned, indexed=False)
+    migrations = find_migrations(schedule_by_day, other_routes_all)
+    if check and (
+        migrations != migrations_scanned or
+        (schedule_by_day, other_routes_all) != scanned
+    ):
+        print(
+            "The indexed migration of rows to route",
+            other_routes_all[0].route,
+            "differs from the migration that checks every row."
+        )
     for schedule_source_index, row_source_index, \
         schedule_destination_index, row_destination_index, \
         column_indices in reversed(migrations):
@@ -547,6 +897,179 @@ def main():
             row_destination[index_destination] = row_source[index_source]
         # Now that the source row has been copied, delete it.
         schedule_source.other_rows.pop(row_source_index)
+def without_empty_columns(header_row, rows):
+    '''
+    Returns a copy of the header row and the rows without the columns that
+    contain no data, not counting the header row. The rows do not end with
+    None.
+    '''
+    columns = list(itertools.zip_longest(*rows))
+    keep = [
+        i for i, column in enumerate(columns)
+        if any(cell is not None for cell in column)
+    ]
+    header_row = [
+        header_row[i] if i < len(header_row) else "" for i in keep
+    ]
+    rows = [list(row) for row in zip(*(columns[i] for i in keep))]
+    for row in rows:
+        while row and row[-1] is None:
+            row.pop()
+    return header_row, rows
+def first_time(row):
+    return next(cell.time for cell in row if cell is not None)
+def row_order(rows):
+    '''
+    Returns a list of the indices of the rows in an order in which the times in
+    every column do not decrease. Rows that depart earlier come first where the
+    order does not matter. If there is no such order, e.g. because one bus
+    overtakes another, the list does not contain some of the indices.
+    '''
+    keys = [(first_time(row), i) for i, row in enumerate(rows)]
+    # In each column, the rows with a time must come in the order of the
+    # times. It is enough to require this of neighbours.
+    successors = [[] for row in rows]
+    predecessors = [0] * len(rows)
+    for column in itertools.zip_longest(*rows):
+        timed = sorted(
+            (cell.time, keys[i], i)
+            for i, cell in enumerate(column)
+            if cell is not None
+        )
+        for (_, _, i), (_, _, j) in zip(timed, timed[1:]):
+            successors[i].append(j)
+            predecessors[j] += 1
+    ready = [keys[i] for i in range(len(rows)) if not predecessors[i]]
+    heapq.heapify(ready)
+    order = []
+    while ready:
+        _, i = heapq.heappop(ready)
+        order.append(i)
+        for j in successors[i]:
+            predecessors[j] -= 1
+            if not predecessors[j]:
+                heapq.heappush(ready, keys[j])
+    return order
+def compile_schedule(schedule, name):
+    '''
+    Prepares a schedule for agency_nyu, which finds trips with a binary search
+    and therefore needs the times in every column to increase from row to row.
+    The rows are changed like this:
+    - Rows are split where a time is earlier than the time before it.
+    - Rows with fewer than two times are removed. Nobody can ride them.
+    - Rows that are the same as an earlier row are removed.
+    - The rows are sorted so that the times in every column increase. Where
+      that is not possible, some rows are moved to another schedule.
+    - Columns that contain no data, not counting the header row, are removed.
+
+    Arguments:
+        schedule: the NYUSchedule
+        name: the name of the schedule in messages
+    Returns:
+        A list of NYUSchedule objects that together contain every trip
+    '''
+    rows = []
+    seen = set()
+    split = 0
+    short = 0
+    duplicate = 0
+    for row in schedule.other_rows:
+        pieces = [[]]
+        last = None
+        for cell in row:
+            if cell is not None:
+                if last is not None and cell.time < last.time:
+                    pieces.append([None] * len(pieces[-1]))
+                last = cell
+            pieces[-1].append(cell)
+        if len(pieces) > 1:
+            split += 1
+        for piece in pieces:
+            while piece and piece[-1] is None:
+                piece.pop()
+            if sum(cell is not None for cell in piece) < 2:
+                short += 1
+                continue
+            key = tuple(
+                None if cell is None else time_key(cell) for cell in piece
+            )
+            if key in seen:
+                duplicate += 1
+                continue
+            seen.add(key)
+            rows.append(piece)
+    parts = []
+    while rows:
+        rows_next = []
+        order = row_order(rows)
+        while len(order) < len(rows):
+            # Some rows cannot be ordered. Move the earliest of them to the
+            # next schedule and try again.
+            ordered = set(order)
+            moved = min(
+                (i for i in range(len(rows)) if i not in ordered),
+                key=lambda i: (first_time(rows[i]), i)
+            )
+            rows_next.append(rows.pop(moved))
+            order = row_order(rows)
+        header_row, other_rows = without_empty_columns(
+            schedule.header_row,
+            [rows[i] for i in order]
+        )
+        parts.append(
+            NYUSchedule(
+                schedule.route,
+                header_row,
+                other_rows,
+                schedule.days_of_week
+            )
+        )
+        rows = rows_next
+    if split:
+        print(name, "has", split, "rows that go back in time; they were split.")
+    if short:
+        print(name, "has", short, "rows with fewer than two times; removed.")
+    if duplicate:
+        print(name, "has", duplicate, "duplicate rows; removed.")
+    if len(parts) > 1:
+        print(
+            name, "has trips that overtake each other; it was split into",
+            len(parts), "schedules."
+        )
+    return parts
+def build_route(route, sheets, found, check_migrations=False):
+    '''
+    Builds the schedules of one route from the parsed sheets. Routes do not
+    depend on each other, so a route only needs to be built again if one of
+    its inputs changed.
+
+    Arguments:
+        route: the route letter
+        sheets: a list of (filename, days_of_week, header_row, other_rows)
+            tuples, one for each sheet of this route
+        found: a list of (days_of_week, header_row, rows) tuples, one for each
+            sheet of another route that has rows for this route
+        check_migrations: passed to migrate_other_routes as check
+    Returns:
+        A tuple of a list of the schedules of this route for each day of the
+        week and a list of (filename, schedule) tuples for the HTML file.
+    '''
+    # The parsed sheets share lists with each other and with the cache, so
+    # work on copies.
+    sheets, found = copy.deepcopy((sheets, found))
+    schedule_by_day = [[] for i in range(7)]
+    schedules_parsed = []
+    for filename, days_of_week, header_row, other_rows in sheets:
+        schedule = NYUSchedule(route, header_row, other_rows, days_of_week)
+        schedules_parsed.append((filename, schedule))
+        for dow in days_of_week:
+            schedule_by_day[dow].append(schedule)
+    other_routes_all = [
+        NYUSchedule(route, header_row, rows, days_of_week)
+        for days_of_week, header_row, rows in found
+    ]
+    # Add to this route the rows from other routes that belong to it.
+    migrate_other_routes(schedule_by_day, other_routes_all, check_migrations)
     for schedule_source in other_routes_all:
         # If there are rows that were not copied, then accept the
         # source schedule as an extra schedule. Only include the rows
@@ -555,27 +1078,33 @@ def main():
             for dow in schedule_source.days_of_week:
                 schedule_by_day[dow].append(schedule_source)
             schedules_parsed.append(("<Found>", schedule_source))
-    # Delete columns that contain no data, not counting the header row.
-    for schedule in itertools.chain.from_iterable(schedule_by_day):
-        for index in reversed(
-            range(
-                max(
-                    len(schedule.header_row),
-                    max(len(row) for row in schedule.other_rows)
+    # Compile the schedules. A schedule may become several schedules, and each
+    # of them replaces it on every day on which it runs.
+    compiled = {}
+    schedules_compiled = []
+    for filename, schedule in schedules_parsed:
+        parts = compile_schedule(
+            schedule,
+            "Route {} ({})".format(route, filename)
+        )
+        compiled[id(schedule)] = parts
+        for i, part in enumerate(parts):
+            schedules_compiled.append(
+                (
+                    filename if i == 0 else
+                    "{} (part {})".format(filename, i + 1),
+                    part
                 )
             )
-        ):
-            empty = True
-            for row in schedule.other_rows:
-                if index < len(row) and row[index]:
-                    empty = False
-                    break
-            if empty:
-                schedule.header_row.pop(index)
-                for row in schedule.other_rows:
-                    if index < len(row):
-                        row.pop(index)
-    # Create an HTML file that humans can use to double-check our work.
+    schedule_by_day = [
+        [part for schedule in schedules for part in compiled[id(schedule)]]
+        for schedules in schedule_by_day
+    ]
+    return schedule_by_day, schedules_compiled
+def write_html(schedules_parsed):
+    '''
+    Creates an HTML file that humans can use to double-check our work.
+    '''
     with open(NYU_HTML, "w", encoding="UTF-8") as f:
         f.write(
             '<!DOCTYPE HTML>\n<html>\n\t<head>\n\t\t<meta charset="UTF-8">\n'
@@ -589,7 +1118,7 @@ def main():
         for filename, schedule in schedules_parsed:
             # Save our work for humans to check.
             f.write('\t\t<h1>')
-            f.write(cgi.escape(filename))
+            f.write(html.escape(filename, quote=False))
             f.write('</h1>\n\t\t<p>Schedule for Route ')
             f.write(schedule.route)
             f.write(" (")
@@ -601,7 +1130,7 @@ def main():
             f.write(')</p>\n\t\t<table>\n\t\t\t<tr>\n')
             for h in schedule.header_row:
                 f.write('\t\t\t\t<th>')
-                f.write(cgi.escape(str(h)))
+                f.write(html.escape(str(h), quote=False))
                 f.write('</th>\n')
             f.write('\t\t\t</tr>\n')
             for row in schedule.other_rows:
@@ -609,7 +1138,7 @@ def main():
                 for c in row:
                     f.write('\t\t\t\t<td>')
                     if c is not None:
-                        f.write(cgi.escape(str(c)))
+                        f.write(html.escape(str(c), quote=False))
                     f.write('</td>\n')
                 for _ in range(len(schedule.header_row) - len(row)):
                     f.write('\t\t\t\t<td></td>\n')
@@ -617,19 +1146,244 @@ def main():
             f.write('\t\t</table>\n')
         # Finish it up for the humans.
         f.write('\t</body>\n</html>\n')
-    # Output the pickled schedule.
-    with open(NYU_PICKLE, "wb") as f:
-        pickle.dump(schedule_by_day, f)
-    # Remove the unnamed node if it is present.
+def main(offline=False, check_migrations=False):
+    '''
+    Builds the schedules. If offline is True, sheets are not downloaded, and
+    only the copies in SHEET_CACHE are used. If check_migrations is True,
+    every route is built again, and the indexed migration of rows between
+    routes is compared to the migration that checks every row.
+
+    The stages of the build are spans named pickle_nyu_stage (see metrics).
+    '''
+    # Read the table of schedules.
+    schedules = []
     try:
-        node_list.remove("")
-    except KeyError:
-        pass
-    # Output the list for the walking agency.
-    with open(NODE_LIST_TXT, "w", encoding="UTF-8") as f:
-        for node in sorted(node_list):
-            print(node, file=f)
+        with open(SCHEDULES, "r", newline="", encoding="UTF-8") as f:
+            for i, row in enumerate(csv.DictReader(f), start=1):
+                try:
+                    schedules.append({
+                        "workbook_key": row["Key"],
+                        "sheet_gid": row["GID"],
+                        "filename_override": row["Filename Override"]
+                    })
+                except KeyError as e:
+                    print(
+                        "The table of schedules is missing this column:",
+                        repr(e.args[0])
+                    )
+                    return
+                except ValueError as e:
+                    print("Error on line ", i, ": ", e, sep="")
+    except OSError as e:
+        print("Cannot open table of schedules:", e)
+    # Read the table of string replacements for the header row.
+    try:
+        with open(REPLACEMENTS, "r", newline="", encoding="UTF-8") as f:
+            for row in csv.DictReader(f):
+                try:
+                    header_replacements[row["Find"]] = row["Replace"]
+                except KeyError as e:
+                    print(
+                        "The table of header string replacements is missing "
+                        "this column:",
+                        repr(e.args[0])
+                    )
+                    return
+    except OSError as e:
+        print("Cannot open table of header string replacements", e)
+    # The replacements affect how every sheet is parsed.
+    replacements_hash = content_hash(
+        *itertools.chain.from_iterable(header_replacements.items())
+    )
+    # Save a list of nodes for finding walking times later.
+    node_list = set()
+    # Collect the inputs of each route. The key parts identify the inputs;
+    # if they are unchanged, the route is not built again.
+    route_sheets = collections.defaultdict(list)
+    route_found = collections.defaultdict(list)
+    route_key_parts = {}
+    # The keys of the results of all parsed sheets, which identify the whole
+    # build
+    parsed_keys = []
+    # The keys under which the parsed sheets are cached
+    parsed_cache_keys = set()
+    # The cells that were parsed by dateutil in all sheets
+    fallbacks_all = collections.Counter()
+    # Sheets are downloaded in threads and parsed in processes. The workers get
+    # their own copies of the replacements and the driving times.
+    with metrics.span("pickle_nyu_stage", stage="download_and_parse"), \
+        multiprocessing.pool.ThreadPool(MAX_CONCURRENT_DOWNLOADS) as pool, \
+        multiprocessing.Pool(
+            initializer=init_parse_worker,
+            initargs=(
+                header_replacements,
+                pickle_nyu_unwritten_times.snapshot()
+            )
+        ) as parse_pool:
+        # Process every schedule.
+        def callback(schedule):
+            print("Processing:", schedule)
+            filename_override = schedule.pop("filename_override")
+            with metrics.span("pickle_nyu_download"):
+                csv_io, filename = \
+                    read_google_sheet(offline=offline, **schedule)
+            if filename_override:
+                filename = filename_override
+            if csv_io is None:
+                return filename, None
+            return filename, csv_io.getvalue()
+        # Start parsing each sheet as soon as it has been downloaded.
+        parsing = [
+            (
+                filename,
+                None if csv_text is None else parse_pool.apply_async(
+                    parse_sheet,
+                    (csv_text, replacements_hash)
+                )
+            )
+            for filename, csv_text in pool.imap(callback, schedules)
+        ]
+        for filename, parsed in parsing:
+            if parsed is None:
+                print("Cannot download:", repr(filename))
+                continue
+            (
+                cache_key,
+                key,
+                lookups,
+                fallbacks,
+                header_row,
+                other_rows,
+                other_routes
+            ) = parsed.get()
+            print("Completed: ", filename)
+            # Ask for the driving times that the worker did not know.
+            for (last_header, curr_header), minutes in lookups.items():
+                if minutes is None:
+                    pickle_nyu_unwritten_times.get_minutes(
+                        last_header,
+                        curr_header
+                    )
+            fallbacks_all.update(fallbacks)
+            parsed_keys.append(filename or "")
+            parsed_keys.append(key)
+            parsed_cache_keys.add(cache_key)
+            # Save any new nodes for the walking agency.
+            node_list.update(header_row)
+            # Get the route letter and days of the week from the filename.
+            route_days = None if filename is None else parse_filename(filename)
+            if route_days is None:
+                continue
+            route, days_of_week = route_days
+            if not days_of_week:
+                continue
+            for r in itertools.chain((route,), other_routes):
+                route_key_parts.setdefault(
+                    r,
+                    [str(BUILD_CACHE_VERSION), r]
+                )
+            route_sheets[route].append(
+                (filename, days_of_week, header_row, other_rows)
+            )
+            route_key_parts[route].extend(("sheet", filename, key))
+            # Store the rows that need to be added to other routes.
+            for r, rows in other_routes.items():
+                route_found[r].append((days_of_week, header_row, rows))
+                route_key_parts[r].extend(("found", filename, key))
+    # Build every route that changed. Load the others from the cache.
+    schedule_by_day = [[] for i in range(7)]
+    schedules_parsed = []
+    route_keys = []
+    for route, key_parts in route_key_parts.items():
+        key = content_hash(*key_parts)
+        route_keys.append(key)
+        built = None if check_migrations else cache_load("routes", key)
+        if built is None:
+            print("Building route", route)
+            with metrics.span("pickle_nyu_stage", stage="build_route"):
+                built = build_route(
+                    route,
+                    route_sheets[route],
+                    route_found[route],
+                    check_migrations
+                )
+            cache_store("routes", key, built)
+        route_schedule_by_day, route_schedules_parsed = built
+        for dow, schedules_on_day in enumerate(route_schedule_by_day):
+            schedule_by_day[dow].extend(schedules_on_day)
+        schedules_parsed.extend(route_schedules_parsed)
+    # Only write the output files if something changed.
+    build_key = content_hash(*parsed_keys, *route_keys)
+    last_build_path = os.path.join(BUILD_CACHE, "Last Build.txt")
+    try:
+        with open(last_build_path, "r", encoding="UTF-8") as f:
+            last_build_key = f.read().strip()
+    except OSError:
+        last_build_key = None
+    if build_key == last_build_key and all(
+        map(
+            os.path.exists,
+            (NYU_HTML, NYU_PICKLE, NYU_NETWORK, NODE_LIST_TXT)
+        )
+    ):
+        print("Nothing changed.")
+    else:
+        with metrics.span("pickle_nyu_stage", stage="write_html"):
+            write_html(schedules_parsed)
+        # Output the pickled schedule.
+        with metrics.span("pickle_nyu_stage", stage="write_pickle"), \
+            open(NYU_PICKLE, "wb") as f:
+            pickle.dump(schedule_by_day, f)
+        # Output the compiled network file, which the agency loads faster.
+        with metrics.span("pickle_nyu_stage", stage="write_network"):
+            network_file.write_nyu(NYU_NETWORK, schedule_by_day)
+        # Remove the unnamed node if it is present.
+        try:
+            node_list.remove("")
+        except KeyError:
+            pass
+        # Output the list for the walking agency.
+        with open(NODE_LIST_TXT, "w", encoding="UTF-8") as f:
+            for node in sorted(node_list):
+                print(node, file=f)
+        os.makedirs(BUILD_CACHE, exist_ok=True)
+        with open(last_build_path, "w", encoding="UTF-8") as f:
+            print(build_key, file=f)
+    if fallbacks_all:
+        print(
+            sum(fallbacks_all.values()),
+            "cells were not in a known time format and were parsed by "
+            "dateutil. The most common ones were:"
+        )
+        for text, count in fallbacks_all.most_common(10):
+            print("   ", count, repr(text))
+    # Forget cached results that this build did not use.
+    cache_prune("parsed", parsed_cache_keys)
+    cache_prune("routes", set(route_keys))
     print("Done.")
 
 if __name__ == "__main__":
-    main()
+    arg_parser = argparse.ArgumentParser(
+        description="Downloads and parses the NYU bus schedules."
+    )
+    arg_parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="build only from sheets that were downloaded before"
+    )
+    arg_parser.add_argument(
+        "--check-migrations",
+        action="store_true",
+        help=
+            "build every route, and check that rows that are marked as being "
+            "via another route are moved the same way as by the slow method"
+    )
+    arg_parser.add_argument(
+        "--trace",
+        action="store_true",
+        help="print how long each stage of the build took"
+    )
+    args = arg_parser.parse_args()
+    if args.trace:
+        metrics.add_sink(metrics.LogSink())
+    main(args.offline, args.check_migrations)
@@ -61,12 +61,25 @@ def read():
         )
         return
     atexit.register(save)
-def get_minutes(last_header, curr_header):
-    global unwritten_times
-    # If the driving times have not been loaded, load them.
+def load():
+    '''
+    This function calls read if it has not been called already.
+    '''
     with linit:
         if unwritten_times is None:
             read()
+def snapshot():
+    '''
+    This function returns a copy of the known driving times as a dictionary
+    from (from, to) tuples to minutes. Driving times that are not known are not
+    included. The copy can be sent to other processes; those processes should
+    give the pairs that they did not find to get_minutes in this process.
+    '''
+    load()
+    return {k: v for k, v in unwritten_times.items() if v != "?"}
+def get_minutes(last_header, curr_header):
+    # If the driving times have not been loaded, load them.
+    load()
     # Get the time from the dictionary.
     try:
         minutes = unwritten_times[(last_header, curr_header)]
@@ -7,8 +7,8 @@ and run match_stops_locations.
 '''
 import errno, itertools, json, os, pickle, sys
 from common import file_in_this_dir, LineSegment
-from common_walking_static import WALKING_TIMES_PICKLE
-import bing_maps, stops
+from common_walking_static import WALKING_TIMES_NETWORK, WALKING_TIMES_PICKLE
+import bing_maps, network_file, stops
 WALKING_DIRECTORY = file_in_this_dir("Walking")
 
 def walking_directions_filename(line):
@@ -78,6 +78,8 @@ def main():
         print("Saving pickle...")
         with open(WALKING_TIMES_PICKLE, "wb") as f:
             pickle.dump(walking_times, f)
+        print("Saving compiled network file...")
+        network_file.write_walking(WALKING_TIMES_NETWORK, walking_times)
     print("Done.")
 
 if __name__ == "__main__":
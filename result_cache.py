@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+'''
+This module keeps the answers of recent queries so that a query that is asked
+again, e.g. by many clients of itinerary_server in the same minute or by a
+script that runs get_itinerary.py over and over, is answered without
+searching.
+
+ResultCache keeps answers in the memory of one process. DiskCache keeps them
+in an SQLite database, which any number of processes can read and write at the
+same time. A ResultCache can be backed by a DiskCache, so answers that another
+process found are copied into memory when they are first asked for.
+
+The key of an answer is made of the arguments of the query that affect it,
+i.e. the origin, the destination, depart, the number of itineraries or
+departures and the options of the agencies, such as --walking-max, along with
+the agencies, the time bucket and the signatures of the data files (see
+data_snapshot.signatures). When the data is rebuilt, its signature changes, so
+answers that were found in old schedules are never returned. Every ResultCache
+is also cleared when data is reloaded.
+
+Times are put in buckets of bucket_seconds. A departure time is rounded up to
+the end of its bucket, and an arrival time is rounded down to the start of
+its bucket, so an answer is valid for every time in the bucket: it never
+departs earlier or arrives later than was asked for. The query is searched
+with the rounded time.
+'''
+import argparse, collections, datetime, os, pickle, sqlite3, threading, time
+import weakref
+import data_snapshot, get_itinerary
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_BUCKET_SECONDS = 60
+# These arguments are not part of the key. The datetime is put in a bucket
+# instead, and the others do not affect the answer.
+IGNORED_ARGUMENTS = (
+    "datetime",
+    "format",
+    "batch",
+    "processes",
+    "unordered",
+    "cache",
+    "cache_bucket",
+    "stats",
+    "trace"
+)
+
+def bucket_datetime(datetime_trip, depart, bucket_seconds):
+    '''
+    Rounds datetime_trip up to the end of its bucket if depart is True, or
+    down to the start of its bucket otherwise. If bucket_seconds is 0,
+    datetime_trip is returned as it is.
+    '''
+    if not bucket_seconds:
+        return datetime_trip
+    midnight = datetime_trip.replace(hour=0, minute=0, second=0, microsecond=0)
+    offset = (datetime_trip - midnight) / datetime.timedelta(seconds=1)
+    bucket = offset // bucket_seconds * bucket_seconds
+    if depart and bucket < offset:
+        bucket += bucket_seconds
+    return midnight + datetime.timedelta(seconds=bucket)
+
+class Cache:
+    '''
+    The base class of the caches. Subclasses implement get and put.
+    '''
+    def __init__(self, bucket_seconds):
+        self.bucket_seconds = bucket_seconds
+        self.hits = 0
+        self.misses = 0
+    def get(self, key):
+        '''
+        Returns the answer that is cached under key, or None if there is
+        none.
+        '''
+        raise NotImplementedError
+    def put(self, key, answer):
+        raise NotImplementedError
+    def key(self, args_parsed, datetime_trip, agencies):
+        return (
+            datetime_trip,
+            tuple(agency.__name__ for agency in agencies),
+            tuple(sorted(
+                (name, repr(value))
+                for name, value in vars(args_parsed).items()
+                if name not in IGNORED_ARGUMENTS
+            )),
+            data_snapshot.signatures()
+        )
+    def answers(
+        self,
+        args_parsed,
+        context,
+        agencies=get_itinerary.AGENCIES,
+        agencies_to_vary=get_itinerary.AGENCIES_TO_VARY
+    ):
+        '''
+        Returns the same (kind, results) tuple as get_itinerary.answers, but
+        results is a list, which is taken from the cache if the query was
+        answered before.
+        '''
+        depart = args_parsed.depart or bool(args_parsed.list_departures)
+        datetime_trip = bucket_datetime(
+            args_parsed.datetime,
+            depart,
+            self.bucket_seconds
+        )
+        key = self.key(args_parsed, datetime_trip, agencies)
+        answer = self.get(key)
+        if answer is not None:
+            return answer
+        if datetime_trip != args_parsed.datetime:
+            args_parsed = argparse.Namespace(**vars(args_parsed))
+            args_parsed.datetime = datetime_trip
+        kind, results = get_itinerary.answers(
+            args_parsed,
+            context,
+            agencies,
+            agencies_to_vary
+        )
+        answer = (kind, list(results))
+        self.put(key, answer)
+        return answer
+class ResultCache(Cache):
+    '''
+    A thread-safe cache of answers in memory that evicts the least recently
+    used answer when it is full
+    '''
+    def __init__(
+        self,
+        max_entries=DEFAULT_MAX_ENTRIES,
+        bucket_seconds=DEFAULT_BUCKET_SECONDS,
+        backing=None
+    ):
+        '''
+        Arguments:
+            max_entries:
+                the number of answers that are kept at most
+            bucket_seconds:
+                the length of the time buckets; 0 to only reuse answers for
+                exactly the same time
+            backing:
+                a DiskCache that answers are also looked up in and written
+                to, or None
+        '''
+        super().__init__(bucket_seconds)
+        self.max_entries = max_entries
+        self.backing = backing
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self.evictions = 0
+        # The listener does not keep the cache alive, so a cache that is
+        # dropped is freed and stops being cleared.
+        self._listener = weakref.WeakMethod(self._data_reloaded)
+        data_snapshot.reload_listeners.append(self._listener)
+    def _data_reloaded(self, data):
+        self.clear()
+    def close(self):
+        '''
+        Stops clearing the cache when data is reloaded.
+        '''
+        try:
+            data_snapshot.reload_listeners.remove(self._listener)
+        except ValueError:
+            pass
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+    def __len__(self):
+        return len(self._entries)
+    def get(self, key):
+        '''
+        Returns the answer that is cached under key and marks it as the most
+        recently used, or returns None if there is none.
+        '''
+        with self._lock:
+            try:
+                answer = self._entries[key]
+            except KeyError:
+                pass
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return answer
+        answer = None if self.backing is None else self.backing.get(key)
+        if answer is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._put(key, answer)
+        return answer
+    def _put(self, key, answer):
+        with self._lock:
+            self._entries[key] = answer
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    def put(self, key, answer):
+        self._put(key, answer)
+        if self.backing is not None:
+            self.backing.put(key, answer)
+    def to_json(self):
+        with self._lock:
+            result = {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+        if self.backing is not None:
+            result["disk"] = self.backing.to_json()
+        return result
+class DiskCache(Cache):
+    '''
+    A cache of answers in an SQLite database in WAL mode, so readers do not
+    wait for writers. When the answers take up more than max_bytes, the least
+    recently used ones are deleted.
+
+    Answers are stored with pickle, so the database must only be writable by
+    users that are trusted to run code. The cache never raises an exception
+    because the database is busy or broken; the answer is searched instead.
+    '''
+    def __init__(
+        self,
+        path,
+        max_bytes=DEFAULT_MAX_BYTES,
+        bucket_seconds=DEFAULT_BUCKET_SECONDS
+    ):
+        '''
+        Arguments:
+            path:
+                the path of the database, which is created if it does not
+                exist
+            max_bytes:
+                the total size of the answers that are kept at most
+            bucket_seconds:
+                the length of the time buckets; 0 to only reuse answers for
+                exactly the same time
+        '''
+        super().__init__(bucket_seconds)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.errors = 0
+        # Connections cannot be shared between threads or across fork, so
+        # every thread of every process opens its own.
+        self._local = threading.local()
+    def _connection(self):
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(
+                self.path,
+                timeout=5.0,
+                isolation_level=None
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(
+                "CREATE TABLE IF NOT EXISTS answers ("
+                "key TEXT PRIMARY KEY, "
+                "answer BLOB NOT NULL, "
+                "size INTEGER NOT NULL, "
+                "used REAL NOT NULL);"
+                "CREATE INDEX IF NOT EXISTS answers_used ON answers (used);"
+            )
+            local.connection = connection
+            local.pid = os.getpid()
+        return local.connection
+    def get(self, key):
+        try:
+            connection = self._connection()
+            row = connection.execute(
+                "SELECT answer FROM answers WHERE key = ?",
+                (repr(key),)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            # An answer that was pickled by older code may refer to classes
+            # or attributes that no longer exist.
+            answer = pickle.loads(row[0])
+        except (
+            sqlite3.Error,
+            pickle.UnpicklingError,
+            EOFError,
+            AttributeError,
+            ImportError,
+            TypeError
+        ):
+            self.errors += 1
+            self.misses += 1
+            return None
+        self.hits += 1
+        # Marking the answer as recently used only affects which answers are
+        # evicted, so the answer is returned even if the database is busy.
+        try:
+            connection.execute(
+                "UPDATE answers SET used = ? WHERE key = ?",
+                (time.time(), repr(key))
+            )
+        except sqlite3.Error:
+            self.errors += 1
+        return answer
+    def put(self, key, answer):
+        data = pickle.dumps(answer, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            return
+        try:
+            connection = self._connection()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute(
+                    "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?)",
+                    (repr(key), data, len(data), time.time())
+                )
+                self._evict(connection)
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        except sqlite3.Error:
+            self.errors += 1
+    def _evict(self, connection):
+        total, = connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM answers"
+        ).fetchone()
+        if total <= self.max_bytes:
+            return
+        # Delete down to 90% of the limit so that the next few answers that
+        # are written do not each delete one more.
+        excess = total - self.max_bytes * 9 // 10
+        for key, size in connection.execute(
+            "SELECT key, size FROM answers ORDER BY used"
+        ).fetchall():
+            if excess <= 0:
+                break
+            connection.execute("DELETE FROM answers WHERE key = ?", (key,))
+            excess -= size
+    def clear(self):
+        try:
+            self._connection().execute("DELETE FROM answers")
+        except sqlite3.Error:
+            self.errors += 1
+    def to_json(self):
+        return {
+            "path": self.path,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors
+        }
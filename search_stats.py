@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+'''
+This module counts what a query does so that slow queries can be explained.
+
+Statistics are only collected for queries whose agency_common.QueryContext
+has a SearchStats object in its stats member, e.g.
+    context = agency_common.QueryContext(
+        origin,
+        destination,
+        stats=SearchStats()
+    )
+    itinerary = itinerary_finder.find_itinerary(..., context=context)
+    print(context.stats)
+Otherwise, the search and the agencies skip the counting entirely. If several
+searches use the same context, e.g. in itinerary_finder.find_itineraries, the
+statistics of all of them are added up.
+'''
+import attr, time
+
+@attr.s
+class AgencyStats:
+    # The number of times get_edge or get_pickup was called
+    generators = attr.ib(default=0)
+    # The number of edges that the agency yielded
+    edges_generated = attr.ib(default=0)
+    # The number of edges that shortened the distance to a node
+    edges_accepted = attr.ib(default=0)
+    # The number of trips that were put in the buffer of upcoming trips
+    trips_materialized = attr.ib(default=0)
+    # The time spent in get_edge or get_pickup
+    seconds = attr.ib(default=0.0)
+    # The time spent preparing for the origin and destination, not counting
+    # the part of it that runs in the background
+    prepare_seconds = attr.ib(default=0.0)
+    def add(self, other):
+        '''
+        Adds the statistics of another AgencyStats to this one.
+        '''
+        for name, value in attr.asdict(other).items():
+            setattr(self, name, getattr(self, name) + value)
+@attr.s
+class SearchStats:
+    # The number of calls to find_itinerary
+    searches = attr.ib(default=0)
+    heap_pushes = attr.ib(default=0)
+    heap_pops = attr.ib(default=0)
+    nodes_settled = attr.ib(default=0)
+    # The time spent in find_itinerary
+    seconds = attr.ib(default=0.0)
+    # A dictionary from the names of the agencies to AgencyStats objects
+    agencies = attr.ib(factory=dict)
+    def agency(self, agency):
+        '''
+        Returns the AgencyStats of the agency, which is a subclass of
+        agency_common.Agency.
+        '''
+        try:
+            return self.agencies[agency.__name__]
+        except KeyError:
+            agency_stats = AgencyStats()
+            self.agencies[agency.__name__] = agency_stats
+            return agency_stats
+    def add(self, other):
+        '''
+        Adds the statistics of another SearchStats to this one.
+        '''
+        for name, value in attr.asdict(other, recurse=False).items():
+            if name == "agencies":
+                for agency_name, agency_stats in value.items():
+                    self.agencies.setdefault(
+                        agency_name,
+                        AgencyStats()
+                    ).add(agency_stats)
+            else:
+                setattr(self, name, getattr(self, name) + value)
+    def to_json(self):
+        return attr.asdict(self)
+    def __str__(self):
+        lines = [
+            "Searches: {}".format(self.searches),
+            "Search time: {:.1f} ms".format(self.seconds * 1000.0),
+            "Nodes settled: {}".format(self.nodes_settled),
+            "Heap pushes: {}".format(self.heap_pushes),
+            "Heap pops: {}".format(self.heap_pops)
+        ]
+        for name, agency_stats in sorted(self.agencies.items()):
+            lines.append(
+                "{}: {} generators, {} edges generated, {} accepted, {} trips "
+                "materialized, {:.1f} ms, {:.1f} ms preparing".format(
+                    name,
+                    agency_stats.generators,
+                    agency_stats.edges_generated,
+                    agency_stats.edges_accepted,
+                    agency_stats.trips_materialized,
+                    agency_stats.seconds * 1000.0,
+                    agency_stats.prepare_seconds * 1000.0
+                )
+            )
+        return "\n".join(lines)
+
+def counted(agency_stats, iterator):
+    '''
+    Yields the items of the iterator, which an agency returned, and adds the
+    number of items and the time spent getting them to agency_stats.
+    '''
+    agency_stats.generators += 1
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            agency_stats.seconds += time.perf_counter() - start
+            return
+        agency_stats.seconds += time.perf_counter() - start
+        agency_stats.edges_generated += 1
+        yield item
@@ -10,12 +10,90 @@ properties:
     geo_str_to_name:
         A dictionary where the keys are string representations of Point
         objects and the values are the stop names
+    names_sorted:
+        A sorted list of the stop names
+    name_to_id:
+        A dictionary where the keys are the stop names and the values are
+        their indices in names_sorted. These are the ids of the stops in
+        NodeIds, which only itinerary_finder uses; the agencies still look
+        stops up by name.
+
+The CSV file is read when one of these properties is first used, so that
+importing this module is fast.
 '''
-name_to_point = {}
-geo_str_to_name = {}
-with open(STOP_LOCATIONS_CSV, "r", newline="", encoding="UTF-8") as f:
-    for row in csv.DictReader(f):
-        p = Point(lat=row["Latitude"], lng=row["Longitude"])
-        name_to_point[row["From PDFs"]] = p
-        geo_str_to_name[str(p)] = row["From PDFs"]
-names_sorted = sorted(name_to_point.keys())
+_PROPERTIES = (
+    "name_to_point",
+    "geo_str_to_name",
+    "names_sorted",
+    "name_to_id"
+)
+
+def load():
+    '''
+    Reads the CSV file and sets the properties. It does nothing if they have
+    already been set.
+    '''
+    global name_to_point, geo_str_to_name, names_sorted, name_to_id
+    if "names_sorted" in globals():
+        return
+    name_to_point_new = {}
+    geo_str_to_name_new = {}
+    with open(STOP_LOCATIONS_CSV, "r", newline="", encoding="UTF-8") as f:
+        for row in csv.DictReader(f):
+            p = Point(lat=row["Latitude"], lng=row["Longitude"])
+            name_to_point_new[row["From PDFs"]] = p
+            geo_str_to_name_new[str(p)] = row["From PDFs"]
+    name_to_point = name_to_point_new
+    geo_str_to_name = geo_str_to_name_new
+    names_sorted_new = sorted(name_to_point.keys())
+    name_to_id = {name: i for i, name in enumerate(names_sorted_new)}
+    names_sorted = names_sorted_new
+def __getattr__(name):
+    if name in _PROPERTIES:
+        load()
+        return globals()[name]
+    raise AttributeError(
+        "module {!r} has no attribute {!r}".format(__name__, name)
+    )
+
+class NodeIds:
+    '''
+    Assigns dense integer ids to the nodes of one query. The bus stops have
+    the ids from 0 to len(names_sorted) - 1, in the order of names_sorted. The
+    other nodes that are passed to the constructor, e.g. an origin and a
+    destination that are not bus stops, have the ids after them. Because
+    every query has its own NodeIds, queries do not share the ids of their
+    other nodes.
+
+    Only itinerary_finder uses these ids, for its labels and its visited set.
+    Agencies are still asked for edges by name, because they look stops up in
+    tables of their own, e.g. the stop table of a compiled network file, which
+    are built separately and are not in the same order.
+    '''
+    def __init__(self, nodes=()):
+        load()
+        self.stop_count = len(names_sorted)
+        self._extra_names = []
+        self._extra_ids = {}
+        for node in nodes:
+            if node not in name_to_id and node not in self._extra_ids:
+                self._extra_ids[node] = self.stop_count + \
+                    len(self._extra_names)
+                self._extra_names.append(node)
+    def __len__(self):
+        return self.stop_count + len(self._extra_names)
+    def id(self, node):
+        '''
+        Returns the id of the node. KeyError is raised if it has none.
+        '''
+        try:
+            return name_to_id[node]
+        except KeyError:
+            return self._extra_ids[node]
+    def name(self, node_id):
+        '''
+        Returns the node that has the id.
+        '''
+        if node_id < self.stop_count:
+            return names_sorted[node_id]
+        return self._extra_names[node_id - self.stop_count]
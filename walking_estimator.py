@@ -0,0 +1,515 @@
+#!/usr/bin/env python3
+'''
+This module estimates walking times without asking any API. The estimates are
+calibrated against the walking times that pickle_walking_static measured
+between bus stops.
+
+The model is linear in two distances: the straight-line distance and the
+distance along a rectangular street grid, whose angle is also fitted. Each
+neighbourhood then gets a detour factor, which accounts for things like parks,
+highways and rivers that make walking there slower than the grid suggests. A
+neighbourhood is a square of NEIGHBOURHOOD_METERS on each side.
+
+Run this module to see how far the estimates are from the measured times.
+The errors are cross-validated: the walks are split into CROSS_VALIDATION_FOLDS
+folds, and each fold is estimated by a model that was fitted to the others, so
+that the errors show how well walks that were never measured are estimated.
+'''
+import array, math, pickle, random, re, statistics
+from common import Point
+from common_walking_static import WALKING_TIMES_PICKLE
+import gazetteer, stops
+
+EARTH_RADIUS_METERS = 6371008.8
+METERS_PER_DEGREE = EARTH_RADIUS_METERS * math.pi / 180.0
+METERS_PER_MILE = 1609.344
+NEIGHBOURHOOD_METERS = 800.0
+# A neighbourhood needs at least this many measured walks that start or end in
+# it before it gets its own detour factor.
+NEIGHBOURHOOD_MIN_SAMPLES = 10
+# The grid angle is searched for on at most about this many samples.
+ANGLE_SEARCH_SAMPLES = 2000
+# This is used when there are no measured walking times to calibrate against.
+# It corresponds to walking 1.25 meters per second along a path that is 30%
+# longer than the straight line.
+DEFAULT_SECONDS_PER_METER = 1.3 / 1.25
+# Nobody walks faster than this, so walking times are at least the
+# straight-line distance divided by it. The straight-line distance is
+# multiplied by LOWER_BOUND_DISTANCE_FACTOR first to allow for rounding and for
+# errors in the flat projection.
+MAX_METERS_PER_SECOND = 3.0
+LOWER_BOUND_DISTANCE_FACTOR = 0.95
+# This is the walking speed that is used to turn an estimated duration back
+# into a distance for humans to read.
+NOMINAL_METERS_PER_SECOND = 1.34
+# The walks are split into this many folds to cross-validate the errors.
+CROSS_VALIDATION_FOLDS = 5
+COORDINATES = re.compile(
+    r"\s*(-?\d+(?:\.\d*)?)\s*,\s*(-?\d+(?:\.\d*)?)\s*"
+)
+
+def haversine_meters(point_A, point_B):
+    '''
+    Returns the great-circle distance between two Point objects in meters.
+    '''
+    lat_A = math.radians(point_A.lat)
+    lat_B = math.radians(point_B.lat)
+    a = math.sin((lat_B - lat_A) / 2.0) ** 2 + \
+        math.cos(lat_A) * math.cos(lat_B) * \
+        math.sin(math.radians(point_B.lng - point_A.lng) / 2.0) ** 2
+    return 2.0 * EARTH_RADIUS_METERS * math.asin(math.sqrt(a))
+def min_seconds(point_A, point_B):
+    '''
+    Returns a lower bound on the number of seconds that it takes to walk from
+    point_A to point_B.
+    '''
+    return haversine_meters(point_A, point_B) * \
+        LOWER_BOUND_DISTANCE_FACTOR / MAX_METERS_PER_SECOND
+def node_to_point(node):
+    '''
+    Returns the location of a node as a Point. The node may be the name of a
+    bus stop, a place that the gazetteer knows, or a string of coordinates in
+    the format of str(Point). If the location is not known, None is returned.
+    '''
+    try:
+        return stops.name_to_point[node]
+    except KeyError:
+        pass
+    place = gazetteer.resolve(node)
+    if place is not None:
+        return place.point
+    match = COORDINATES.fullmatch(node)
+    if match is not None:
+        lat, lng = float(match.group(1)), float(match.group(2))
+        if -90.0 <= lat <= 90.0 and -180.0 <= lng <= 180.0:
+            return Point(lat, lng)
+    return None
+def distance_text(seconds):
+    '''
+    Returns a human-readable distance for an estimated walking duration.
+    '''
+    return "about {:.1f} mi".format(
+        seconds * NOMINAL_METERS_PER_SECOND / METERS_PER_MILE
+    )
+def _solve(matrix, vector):
+    '''
+    Solves a small system of linear equations by Gaussian elimination with
+    partial pivoting. Returns None if the system is singular.
+    '''
+    n = len(vector)
+    rows = [list(row) + [v] for row, v in zip(matrix, vector)]
+    for column in range(n):
+        pivot = max(range(column, n), key=lambda r: abs(rows[r][column]))
+        if abs(rows[pivot][column]) < 1e-12:
+            return None
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+        for r in range(n):
+            if r != column:
+                factor = rows[r][column] / rows[column][column]
+                for c in range(column, n + 1):
+                    rows[r][c] -= factor * rows[column][c]
+    return [rows[r][n] / rows[r][r] for r in range(n)]
+
+class WalkingEstimator:
+    '''
+    Estimates walking times between points. Create one with calibrated()
+    instead of calling the constructor directly.
+
+    Points are projected onto a flat plane around reference, measured in
+    meters. The estimate in seconds between two points is
+        (intercept + per_meter * straight + per_grid_meter * grid) * detour
+    where straight is the straight-line distance, grid is the distance along
+    streets that run at grid_angle radians from north, and detour is the
+    geometric mean of the detour factors of the neighbourhoods of both points.
+    '''
+    def __init__(
+        self,
+        reference=Point(0.0, 0.0),
+        intercept=0.0,
+        per_meter=DEFAULT_SECONDS_PER_METER,
+        per_grid_meter=0.0,
+        grid_angle=0.0,
+        detour_factors=None
+    ):
+        self.reference = reference
+        self.intercept = intercept
+        self.per_meter = per_meter
+        self.per_grid_meter = per_grid_meter
+        self.grid_angle = grid_angle
+        self.detour_factors = detour_factors or {}
+        self._meters_per_degree_lng = \
+            METERS_PER_DEGREE * math.cos(math.radians(reference.lat))
+        self._cos = math.cos(grid_angle)
+        self._sin = math.sin(grid_angle)
+        self._stop_names = None
+    def project(self, point):
+        '''
+        Returns the (x, y) coordinates of a point in meters east and north of
+        the reference point.
+        '''
+        return (
+            (point.lng - self.reference.lng) * self._meters_per_degree_lng,
+            (point.lat - self.reference.lat) * METERS_PER_DEGREE
+        )
+    def neighbourhood(self, x, y):
+        return (
+            math.floor(x / NEIGHBOURHOOD_METERS),
+            math.floor(y / NEIGHBOURHOOD_METERS)
+        )
+    def _features(self, x_A, y_A, x_B, y_B):
+        dx = x_B - x_A
+        dy = y_B - y_A
+        return (
+            math.hypot(dx, dy),
+            abs(dx * self._cos - dy * self._sin) +
+            abs(dx * self._sin + dy * self._cos)
+        )
+    def estimate_seconds(self, point_A, point_B):
+        '''
+        Returns the estimated number of seconds that it takes to walk from
+        point_A to point_B. It is never less than min_seconds(point_A,
+        point_B).
+        '''
+        x_A, y_A = self.project(point_A)
+        x_B, y_B = self.project(point_B)
+        return max(
+            self._predict(x_A, y_A, x_B, y_B) * math.sqrt(
+                self.detour_factors.get(self.neighbourhood(x_A, y_A), 1.0) *
+                self.detour_factors.get(self.neighbourhood(x_B, y_B), 1.0)
+            ),
+            min_seconds(point_A, point_B)
+        )
+    def _prepare_stops(self):
+        '''
+        Projects every bus stop once and stores the coordinates in arrays so
+        that the walking times from or to all stops can be computed in one
+        pass.
+        '''
+        self._stop_names = stops.names_sorted
+        points = [stops.name_to_point[name] for name in self._stop_names]
+        xy = [self.project(p) for p in points]
+        self._stop_x = array.array("d", (x for x, _ in xy))
+        self._stop_y = array.array("d", (y for _, y in xy))
+        # Rotate the stops into the grid so that the grid distance is just
+        # the sum of the absolute differences.
+        self._stop_u = array.array(
+            "d",
+            (x * self._cos - y * self._sin for x, y in xy)
+        )
+        self._stop_v = array.array(
+            "d",
+            (x * self._sin + y * self._cos for x, y in xy)
+        )
+        self._stop_detour = array.array(
+            "d",
+            (
+                math.sqrt(
+                    self.detour_factors.get(self.neighbourhood(x, y), 1.0)
+                )
+                for x, y in xy
+            )
+        )
+    def estimate_stops(self, point):
+        '''
+        Returns a list of (stop_name, seconds) tuples, one for every bus stop.
+        Walking times are symmetric in this model, so the same numbers apply
+        from point to each stop and from each stop to point.
+        '''
+        if self._stop_names is not stops.names_sorted:
+            self._prepare_stops()
+        x, y = self.project(point)
+        u = x * self._cos - y * self._sin
+        v = x * self._sin + y * self._cos
+        detour = math.sqrt(
+            self.detour_factors.get(self.neighbourhood(x, y), 1.0)
+        )
+        intercept = self.intercept
+        per_meter = self.per_meter
+        per_grid_meter = self.per_grid_meter
+        # The lower bound is computed from the flat distance here. That is why
+        # min_seconds leaves room for errors in the projection.
+        per_meter_min = 1.0 / MAX_METERS_PER_SECOND
+        hypot = math.hypot
+        return list(zip(
+            self._stop_names,
+            [
+                max(
+                    (
+                        intercept +
+                        per_meter * straight +
+                        per_grid_meter * (abs(su - u) + abs(sv - v))
+                    ) * sd * detour,
+                    per_meter_min * straight
+                )
+                for straight, su, sv, sd in zip(
+                    [
+                        hypot(sx - x, sy - y)
+                        for sx, sy in zip(self._stop_x, self._stop_y)
+                    ],
+                    self._stop_u,
+                    self._stop_v,
+                    self._stop_detour
+                )
+            ]
+        ))
+    def _predict(self, x_A, y_A, x_B, y_B):
+        '''
+        Returns the estimate between two projected points without the detour
+        factors.
+        '''
+        straight, grid = self._features(x_A, y_A, x_B, y_B)
+        return self.intercept + \
+            self.per_meter * straight + \
+            self.per_grid_meter * grid
+    def _fit_linear(self, projected, fit_grid):
+        '''
+        Sets the coefficients of the linear model by least squares. Returns
+        None if they cannot be determined.
+        '''
+        n = 3 if fit_grid else 2
+        ata = [[0.0] * n for _ in range(n)]
+        atb = [0.0] * n
+        for (x_A, y_A), (x_B, y_B), seconds in projected:
+            features = (1.0,) + self._features(x_A, y_A, x_B, y_B)[:n - 1]
+            for i in range(n):
+                atb[i] += features[i] * seconds
+                for j in range(n):
+                    ata[i][j] += features[i] * features[j]
+        coefficients = _solve(ata, atb)
+        if coefficients is None:
+            return None
+        coefficients += [0.0] * (3 - n)
+        self.intercept, self.per_meter, self.per_grid_meter = coefficients
+        return coefficients
+    def _residual(self, projected):
+        return sum(
+            (self._predict(x_A, y_A, x_B, y_B) - seconds) ** 2
+            for (x_A, y_A), (x_B, y_B), seconds in projected
+        )
+    @classmethod
+    def calibrated(
+        cls,
+        walking_times,
+        name_to_point,
+        fit_grid=True,
+        fit_detours=True
+    ):
+        '''
+        Returns an estimator fitted to measured walking times by least squares.
+        The grid angle is chosen from whole degrees between 0 and 89.
+
+        Arguments:
+            walking_times:
+                a dictionary like the one in WALKING_TIMES_PICKLE, where each
+                key is a (from_name, to_name) tuple and each value is a
+                (seconds, directions_file) tuple
+            name_to_point:
+                a dictionary like stops.name_to_point
+            fit_grid:
+                if False, only the straight-line distance is used
+            fit_detours:
+                if False, every neighbourhood has a detour factor of 1
+        '''
+        samples = [
+            (name_to_point[from_name], name_to_point[to_name], seconds)
+            for (from_name, to_name), (seconds, _) in walking_times.items()
+            if from_name in name_to_point and to_name in name_to_point
+        ]
+        if not samples:
+            return cls()
+        reference = Point(
+            statistics.fmean(p.lat for p, _, _ in samples),
+            statistics.fmean(p.lng for p, _, _ in samples)
+        )
+        projector = cls(reference)
+        projected = [
+            (projector.project(p_A), projector.project(p_B), seconds)
+            for p_A, p_B, seconds in samples
+        ]
+        if fit_grid:
+            # Search for the grid angle on a subset of the samples, first in
+            # steps of 5 degrees and then in steps of 1 degree around the best
+            # one. Then fit the coefficients to all of the samples.
+            subset = projected[::max(1, len(projected) // ANGLE_SEARCH_SAMPLES)]
+            def residual_at(degrees):
+                estimator = cls(reference, grid_angle=math.radians(degrees))
+                if estimator._fit_linear(subset, fit_grid) is None:
+                    return math.inf
+                return estimator._residual(subset)
+            coarse = min(range(0, 90, 5), key=residual_at)
+            degrees = min(
+                (d % 90 for d in range(coarse - 4, coarse + 5)),
+                key=residual_at
+            )
+        else:
+            degrees = 0
+        estimator = cls(reference, grid_angle=math.radians(degrees))
+        if estimator._fit_linear(projected, fit_grid) is None:
+            return cls()
+        if fit_detours:
+            # The detour factor of a neighbourhood is the median ratio of the
+            # measured time to the estimated time of walks that start or end
+            # in it.
+            ratios = {}
+            for (x_A, y_A), (x_B, y_B), seconds in projected:
+                predicted = estimator._predict(x_A, y_A, x_B, y_B)
+                if predicted > 0.0:
+                    for neighbourhood in {
+                        estimator.neighbourhood(x_A, y_A),
+                        estimator.neighbourhood(x_B, y_B)
+                    }:
+                        ratios.setdefault(neighbourhood, []).append(
+                            seconds / predicted
+                        )
+            estimator.detour_factors = {
+                neighbourhood: statistics.median(r)
+                for neighbourhood, r in ratios.items()
+                if len(r) >= NEIGHBOURHOOD_MIN_SAMPLES
+            }
+        return estimator
+    def errors(self, walking_times, name_to_point):
+        '''
+        Compares the estimates to measured walking times. Returns a dictionary
+        with the number of samples, the mean absolute error in seconds, the
+        root-mean-square error in seconds and the median and 90th percentile
+        absolute percentage error.
+        '''
+        absolute = []
+        relative = []
+        self._add_errors(walking_times, name_to_point, absolute, relative)
+        return _summarize_errors(absolute, relative)
+    def _add_errors(self, walking_times, name_to_point, absolute, relative):
+        '''
+        Appends the absolute errors in seconds and the absolute percentage
+        errors of the estimates of the measured walking times to the lists.
+        '''
+        for (from_name, to_name), (seconds, _) in walking_times.items():
+            try:
+                estimate = self.estimate_seconds(
+                    name_to_point[from_name],
+                    name_to_point[to_name]
+                )
+            except KeyError:
+                continue
+            absolute.append(abs(estimate - seconds))
+            if seconds > 0:
+                relative.append(abs(estimate - seconds) / seconds * 100.0)
+
+def _summarize_errors(absolute, relative):
+    if not absolute:
+        return {"samples": 0}
+    relative = sorted(relative)
+    return {
+        "samples": len(absolute),
+        "mean_absolute_seconds": statistics.fmean(absolute),
+        "rms_seconds": math.sqrt(statistics.fmean(e * e for e in absolute)),
+        "median_percent": statistics.median(relative) if relative else 0.0,
+        "p90_percent":
+            relative[int(0.9 * (len(relative) - 1))] if relative else 0.0
+    }
+def cross_validated_errors(
+    walking_times,
+    name_to_point,
+    folds=CROSS_VALIDATION_FOLDS,
+    seed=0,
+    **kwargs
+):
+    '''
+    Returns the errors like WalkingEstimator.errors, but every walk is
+    estimated by a model that was not fitted to it. The walks are split into
+    folds at random; both directions between two places are always in the same
+    fold, because they take almost the same time. For every fold, a model is
+    fitted to the other folds and compared to the walks in the fold. The other
+    arguments are passed to WalkingEstimator.calibrated.
+    '''
+    pairs = sorted({frozenset(key) for key in walking_times}, key=sorted)
+    random.Random(seed).shuffle(pairs)
+    fold_of = {pair: i % folds for i, pair in enumerate(pairs)}
+    absolute = []
+    relative = []
+    for fold in range(folds):
+        training = {}
+        testing = {}
+        for key, value in walking_times.items():
+            if fold_of[frozenset(key)] == fold:
+                testing[key] = value
+            else:
+                training[key] = value
+        WalkingEstimator.calibrated(
+            training,
+            name_to_point,
+            **kwargs
+        )._add_errors(testing, name_to_point, absolute, relative)
+    return _summarize_errors(absolute, relative)
+
+_estimator = None
+
+def load_walking_times():
+    '''
+    Returns the measured walking times from WALKING_TIMES_PICKLE, or an empty
+    dictionary if they are not available.
+    '''
+    try:
+        with open(WALKING_TIMES_PICKLE, "rb") as f:
+            return pickle.load(f)
+    except OSError:
+        return {}
+def get_estimator():
+    '''
+    Returns a WalkingEstimator that has been calibrated against the measured
+    walking times. It is created on first use. If the measured walking times
+    are not available, the estimator uses default values.
+    '''
+    global _estimator
+    if _estimator is None:
+        _estimator = WalkingEstimator.calibrated(
+            load_walking_times(),
+            stops.name_to_point
+        )
+    return _estimator
+
+if __name__ == "__main__":
+    walking_times = load_walking_times()
+    print("Measured walking times:", len(walking_times))
+    for description, kwargs in (
+        ("Straight line", {"fit_grid": False, "fit_detours": False}),
+        ("Straight line and grid", {"fit_detours": False}),
+        ("With neighbourhood detours", {}),
+    ):
+        print(description + ":")
+        for label, errors in (
+            (
+                "cross-validated on {} folds".format(CROSS_VALIDATION_FOLDS),
+                cross_validated_errors(
+                    walking_times,
+                    stops.name_to_point,
+                    **kwargs
+                )
+            ),
+            (
+                "on the walks that the model was fitted to",
+                WalkingEstimator.calibrated(
+                    walking_times,
+                    stops.name_to_point,
+                    **kwargs
+                ).errors(walking_times, stops.name_to_point)
+            )
+        ):
+            print("    Errors " + label + ":")
+            for k, v in errors.items():
+                print(
+                    "        {}: {:.2f}".format(k, v)
+                    if isinstance(v, float) else
+                    "        {}: {}".format(k, v)
+                )
+    estimator = get_estimator()
+    print(
+        "Model: {:.1f} s + {:.4f} s/m straight + {:.4f} s/m grid at {:.0f} "
+        "degrees, {} neighbourhood detour factors".format(
+            estimator.intercept,
+            estimator.per_meter,
+            estimator.per_grid_meter,
+            math.degrees(estimator.grid_angle),
+            len(estimator.detour_factors)
+        )
+    )